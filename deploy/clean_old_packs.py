@@ -1,5 +1,11 @@
 """
 Script to clean up old conda pack relics
+
+The unpacked envs share unchanged files through hardlinks to the object
+store in .objects, see dedup_env.py. Removing an env only removes its
+links, and the stored files that no env links to anymore are removed at
+the end. Because files are shared, unpacked envs must be treated as
+read-only: writing to a file in one env in place changes it in all of them.
 """
 import argparse
 import os
@@ -10,9 +16,13 @@ import socket
 from dataclasses import dataclass
 from typing import List, Tuple
 
+from dedup_env import OBJECTS_DIR, collect_garbage, gib
+
 HUTCH_PYTHON_ENV = '/cds/group/pcds/pyps/apps/hutch-python/{hutch}/{hutch}env'
 UNPACK_DIRECTORY = '/u1/{hutch}opr/conda_envs'
 VER_MATCH = re.compile(r'^[^#].*CONDA_ENVNAME.*pcds-(\d\.\d\.\d)')
+# Unpacked envs are e.g. pcds-5.8.4, anything else in the directory is not ours
+ENV_DIR_MATCH = re.compile(r'^[^.][^-]*-(\d+\.\d+\.\d+)$')
 
 
 @dataclass
@@ -66,7 +76,10 @@ def get_saved_envs(hutch: str) -> List[UnpackedEnv]:
     filenames = os.listdir(directory)
     output = []
     for fname in filenames:
-        ver = fname.split('-')[1]
+        match = ENV_DIR_MATCH.match(fname)
+        if not match:
+            continue
+        ver = match.group(1)
         ver_tuple = tuple(int(num) for num in ver.split('.'))
         output.append(
             UnpackedEnv(
@@ -126,13 +139,20 @@ def main(dry_run=True):
             print(env)
     else:
         print('Did not find any paths to clean up')
-        return
-    if dry_run:
+    if dry_run and remove:
         print('Dry run: not deleting envs')
-    else:
+    elif remove:
         for env in remove:
             print(f'Deleting {env}')
             shutil.rmtree(env.path)
+    # Stored files are shared by hardlinks, see dedup_env.py.
+    # Only the ones that no remaining env links to can go.
+    objects_dir = os.path.join(UNPACK_DIRECTORY.format(hutch=hutch), OBJECTS_DIR)
+    count, size = collect_garbage(objects_dir, dry_run=dry_run)
+    if dry_run:
+        print(f'Dry run: not deleting {count} unused stored files ({gib(size)})')
+    else:
+        print(f'Deleted {count} unused stored files ({gib(size)})')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,322 @@
+"""
+Share identical files between unpacked envs using hardlinks.
+
+Each release of the pcds env is mostly the same files as the one before it.
+Files are kept in a content-addressed object store next to the envs, in a
+directory named .objects, and every env links to the stored copies. The
+disk usage of each new env is then just the files that changed.
+
+With the env's manifest, see env_manifest.py, the pack can be extracted
+through this script. The manifest has the hash of every file, so a file
+that is already in the store is linked without being written at all, and
+only the files that changed since earlier releases are written to disk.
+Files that conda-unpack rewrites are always written, since conda-unpack
+changes them in place.
+
+Without a manifest, the env is unpacked as usual and this runs after
+conda-unpack instead. Every file is hashed, a file that is already in the
+store is replaced by a link to the stored copy, and a new file is linked
+into the store for the next release to find. conda-unpack rewrites the
+prefix inside many files to the real install path, which differs for each
+env, so those files only match other files with the same final contents.
+
+The file mode is part of each object's key, because hardlinked files share
+a single mode. Stored objects with a link count of 1 are no longer used by
+any env, and are removed by clean_old_packs.py.
+
+Files in a deduplicated env are shared with other envs, so the env must be
+treated as read-only: writing to a file in place changes it in every env
+that links to it. Install into a new env instead.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import os.path
+import stat
+import sys
+import tarfile
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from env_manifest import EnvManifest
+
+OBJECTS_DIR = '.objects'
+CHUNK_SIZE = 1024 * 1024
+WORKERS = 8
+# Our own packs are trusted, so keep e.g. absolute symlinks as they are
+if hasattr(tarfile, 'fully_trusted_filter'):
+    EXTRACT_ARGS = {'filter': 'fully_trusted'}
+else:
+    EXTRACT_ARGS = {}
+
+
+@dataclass
+class DedupStats:
+    files: int = 0
+    # Files replaced with a link to a stored object
+    linked: int = 0
+    linked_bytes: int = 0
+    # Files added to the object store
+    stored: int = 0
+    stored_bytes: int = 0
+    # Files that could not be linked, e.g. on another filesystem
+    skipped: int = 0
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def object_path(objects_dir: str, digest: str, mode: int) -> str:
+    """
+    Where a file with this content and mode is kept in the store.
+
+    Objects are spread over 256 subdirectories to keep each one small.
+    """
+    key = f'{digest}-{stat.S_IMODE(mode):o}'
+    return os.path.join(objects_dir, digest[:2], key)
+
+
+def iter_files(env_dir: str) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield every regular file in an env, not following symlinks."""
+    for root, _, filenames in os.walk(env_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            info = os.lstat(path)
+            if stat.S_ISREG(info.st_mode):
+                yield path, info
+
+
+def link_file(path: str, info: os.stat_result, objects_dir: str) -> Optional[str]:
+    """
+    Replace one file with a link to the store, or add it to the store.
+
+    Returns
+    -------
+    action : str or None
+        "linked" if the file now links to a stored object, "stored" if it
+        was added to the store, or None if nothing could be done.
+    """
+    obj = object_path(objects_dir, file_hash(path), info.st_mode)
+    try:
+        obj_info = os.stat(obj)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        try:
+            os.link(path, obj)
+        except FileExistsError:
+            # Another file with the same contents just got stored
+            return link_file(path, info, objects_dir)
+        except OSError:
+            return None
+        return 'stored'
+    if obj_info.st_ino == info.st_ino and obj_info.st_dev == info.st_dev:
+        return 'linked'
+    tmp_path = path + '.dedup-tmp'
+    try:
+        os.link(obj, tmp_path)
+    except OSError:
+        return None
+    os.replace(tmp_path, path)
+    return 'linked'
+
+
+def dedup_env(
+    env_dir: str,
+    objects_dir: Optional[str] = None,
+    workers: int = WORKERS,
+    dry_run: bool = False,
+) -> DedupStats:
+    """
+    Hardlink every file in an env to the shared object store.
+
+    Parameters
+    ----------
+    env_dir : str
+        The unpacked env, after conda-unpack has been run.
+    objects_dir : str, optional
+        The object store. Defaults to .objects next to the env.
+    workers : int, optional
+        How many files to hash at the same time.
+    dry_run : bool, optional
+        If True, only count how many files would be linked.
+    """
+    env_dir = os.path.abspath(env_dir)
+    if objects_dir is None:
+        objects_dir = os.path.join(os.path.dirname(env_dir), OBJECTS_DIR)
+    stats = DedupStats()
+    files = list(iter_files(env_dir))
+    stats.files = len(files)
+
+    def process(item):
+        path, info = item
+        if dry_run:
+            obj = object_path(objects_dir, file_hash(path), info.st_mode)
+            return path, info, 'linked' if os.path.exists(obj) else 'stored'
+        return path, info, link_file(path, info, objects_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, info, action in pool.map(process, files):
+            if action == 'linked':
+                stats.linked += 1
+                stats.linked_bytes += info.st_size
+            elif action == 'stored':
+                stats.stored += 1
+                stats.stored_bytes += info.st_size
+            else:
+                stats.skipped += 1
+    return stats
+
+
+def extract_pack(
+    fileobj: BinaryIO,
+    env_dir: str,
+    manifest: EnvManifest,
+    objects_dir: Optional[str] = None,
+) -> DedupStats:
+    """
+    Extract a pack, linking the files that are already in the store.
+
+    Parameters
+    ----------
+    fileobj : file
+        The uncompressed tar stream of the pack.
+    env_dir : str
+        The directory to extract into.
+    manifest : EnvManifest
+        The manifest of the pack. Only the files in its files list are
+        linked. The files that conda-unpack rewrites are always written.
+    objects_dir : str, optional
+        The object store. Defaults to .objects next to the env.
+    """
+    env_dir = os.path.abspath(env_dir)
+    if objects_dir is None:
+        objects_dir = os.path.join(os.path.dirname(env_dir), OBJECTS_DIR)
+    stats = DedupStats()
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            known = manifest.files.get(os.path.normpath(member.name))
+            if not member.isfile() or known is None:
+                tar.extract(member, env_dir, **EXTRACT_ARGS)
+                continue
+            stats.files += 1
+            size, digest = known
+            path = os.path.join(env_dir, os.path.normpath(member.name))
+            obj = object_path(objects_dir, digest, member.mode)
+            if os.path.exists(obj):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.link(obj, path)
+                except OSError:
+                    pass
+                else:
+                    stats.linked += 1
+                    stats.linked_bytes += size
+                    continue
+            tar.extract(member, env_dir, **EXTRACT_ARGS)
+            # Hash what was written rather than trusting the manifest
+            action = link_file(path, os.lstat(path), objects_dir)
+            if action == 'stored':
+                stats.stored += 1
+                stats.stored_bytes += size
+            elif action == 'linked':
+                stats.linked += 1
+                stats.linked_bytes += size
+            else:
+                stats.skipped += 1
+    return stats
+
+
+def collect_garbage(objects_dir: str, dry_run: bool = False) -> Tuple[int, int]:
+    """
+    Remove the stored objects that no env links to anymore.
+
+    Returns
+    -------
+    removed : tuple of int
+        The number of objects and bytes that were, or would be, removed.
+    """
+    count = 0
+    size = 0
+    if not os.path.isdir(objects_dir):
+        return count, size
+    for root, _, filenames in os.walk(objects_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            info = os.lstat(path)
+            if info.st_nlink == 1:
+                count += 1
+                size += info.st_size
+                if not dry_run:
+                    os.remove(path)
+    return count, size
+
+
+def gib(num_bytes: int) -> str:
+    return f'{num_bytes / 2**30:.2f} GiB'
+
+
+def main(
+    env_dir: str,
+    workers: int = WORKERS,
+    dry_run: bool = False,
+    extract: Optional[str] = None,
+) -> int:
+    if extract is not None:
+        print(f'Extracting into {env_dir}, linking files that are already stored')
+        stats = extract_pack(sys.stdin.buffer, env_dir, EnvManifest.load(extract))
+    elif not os.path.isdir(env_dir):
+        print(f'{env_dir} is not a directory. Aborting.')
+        return 1
+    else:
+        print(f'Linking the files of {env_dir} into the shared object store')
+        stats = dedup_env(env_dir, workers=workers, dry_run=dry_run)
+    if dry_run:
+        print('Dry run: no files were linked')
+    print(
+        f'{stats.linked} of {stats.files} files ({gib(stats.linked_bytes)}) '
+        f'are shared with earlier envs, {stats.stored} files '
+        f'({gib(stats.stored_bytes)}) are new'
+    )
+    if stats.skipped:
+        print(f'{stats.skipped} files could not be linked')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Hardlink the files of an unpacked env to a shared store.',
+    )
+    parser.add_argument('env_dir', help='The unpacked env to deduplicate.')
+    parser.add_argument(
+        '--extract',
+        metavar='MANIFEST',
+        help=(
+            'Extract an uncompressed pack from stdin into env_dir, using the '
+            'hashes in this env manifest to link files that are already '
+            'stored instead of writing them.'
+        ),
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=WORKERS,
+        help='How many files to hash at the same time.',
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only report how many files would be shared.',
+    )
+    args = parser.parse_args()
+    sys.exit(main(
+        args.env_dir,
+        workers=args.workers,
+        dry_run=args.dry_run,
+        extract=args.extract,
+    ))
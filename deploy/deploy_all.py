@@ -0,0 +1,274 @@
+"""
+Run pcds_env_deploy on all scheduled servers at the same time.
+
+This does the same thing as deploy_all, but with several hosts at once.
+Each host's stdout and stderr are kept in their own log files under
+deploy/logs, and a summary table of every host's exit code is printed at
+the end.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import os
+import os.path
+import shlex
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HOSTS_FILE = os.path.join(HERE, 'hosts.txt')
+LOG_DIR = os.path.join(HERE, 'logs')
+DEPLOY = os.path.join(HERE, 'pcds_env_deploy')
+# How many hosts to work on at the same time
+JOBS = 5
+
+
+@dataclass
+class HostResult:
+    host: str
+    # The exit code of the remote command, or None if it timed out
+    returncode: Optional[int]
+    # Seconds spent on this host
+    duration: float
+    stdout_path: str
+    stderr_path: str
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+def read_hosts(filename: str) -> List[str]:
+    """
+    Get the hosts to use from a file with one host per line.
+    """
+    with open(filename, 'r') as fd:
+        lines = fd.read().splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def run_on_host(
+    host: str,
+    remote_command: str,
+    ssh: List[str],
+    log_dir: str,
+    timeout: Optional[float] = None,
+) -> HostResult:
+    """
+    Run a command on one host, writing its output to log files.
+
+    Parameters
+    ----------
+    host : str
+        The host to connect to.
+    remote_command : str
+        The shell command to run on the host.
+    ssh : list of str
+        The ssh command to use, e.g. ['ssh'] or a local stand-in for tests.
+    log_dir : str
+        Where to write {host}.stdout and {host}.stderr
+    timeout : float, optional
+        Seconds to wait before giving up on this host.
+    """
+    stdout_path = os.path.join(log_dir, host + '.stdout')
+    stderr_path = os.path.join(log_dir, host + '.stderr')
+    start = time.monotonic()
+    with open(stdout_path, 'w') as stdout, open(stderr_path, 'w') as stderr:
+        try:
+            proc = subprocess.run(
+                ssh + ['-n', host, remote_command],
+                stdin=subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=stderr,
+                timeout=timeout,
+            )
+            returncode = proc.returncode
+        except subprocess.TimeoutExpired:
+            stderr.write(f'Timed out after {timeout} seconds\n')
+            returncode = None
+    return HostResult(
+        host=host,
+        returncode=returncode,
+        duration=time.monotonic() - start,
+        stdout_path=stdout_path,
+        stderr_path=stderr_path,
+    )
+
+
+def fan_out(
+    hosts: List[str],
+    make_command: Callable[[str], str],
+    ssh: List[str],
+    log_dir: str,
+    jobs: int = JOBS,
+    timeout: Optional[float] = None,
+) -> List[HostResult]:
+    """
+    Run a command on many hosts, up to jobs hosts at a time.
+
+    Parameters
+    ----------
+    hosts : list of str
+        The hosts to connect to.
+    make_command : callable
+        Gets the shell command to run on a host, given the host name.
+    ssh : list of str
+        The ssh command to use.
+    log_dir : str
+        Where to write the per-host log files. Created if needed.
+    jobs : int, optional
+        How many hosts to work on at the same time.
+    timeout : float, optional
+        Seconds to wait before giving up on a host.
+
+    Returns
+    -------
+    results : list of HostResult
+        One result per host, in the same order as hosts.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                run_on_host, host, make_command(host), ssh, log_dir, timeout,
+            ): host
+            for host in hosts
+        }
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results[result.host] = result
+            status = 'ok' if result.ok else 'FAILED'
+            print(
+                f'Done with {result.host} ({status}, {result.duration:.0f}s)',
+                flush=True,
+            )
+    return [results[host] for host in hosts]
+
+
+def print_summary(results: List[HostResult]) -> None:
+    width = max([len('host')] + [len(result.host) for result in results])
+    print(f'{"host":<{width}}  {"exit":>7}  {"time":>8}  log')
+    for result in results:
+        if result.returncode is None:
+            code = 'timeout'
+        else:
+            code = str(result.returncode)
+        log = result.stdout_path if result.ok else result.stderr_path
+        print(
+            f'{result.host:<{width}}  {code:>7}  {result.duration:>7.0f}s  {log}'
+        )
+
+
+def default_log_dir(prefix: str) -> str:
+    stamp = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    return os.path.join(LOG_DIR, f'{prefix}-{stamp}')
+
+
+def main(
+    run: bool = False,
+    env: Optional[str] = None,
+    hosts_file: str = HOSTS_FILE,
+    jobs: int = JOBS,
+    ssh: str = 'ssh',
+    log_dir: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> int:
+    if not os.access(DEPLOY, os.X_OK):
+        print('Script pcds_env_deploy not found. Aborting.')
+        return 1
+    if not os.path.isfile(hosts_file):
+        print(f'Could not find hosts file {hosts_file}. Aborting.')
+        return 1
+
+    # -d makes us delete old envs
+    inner_args = ['-d']
+    if run:
+        inner_args.append('-r')
+    if env is not None:
+        inner_args += ['-e', env]
+    remote_command = ' '.join(shlex.quote(arg) for arg in [DEPLOY] + inner_args)
+    if log_dir is None:
+        log_dir = default_log_dir('deploy')
+
+    hosts = read_hosts(hosts_file)
+    print('Deploying conda env to all operator machines.')
+    print(f'Running "{remote_command}" on {len(hosts)} hosts, {jobs} at a time')
+    print(f'Logs are in {log_dir}', flush=True)
+    results = fan_out(
+        hosts,
+        lambda host: remote_command,
+        ssh=shlex.split(ssh),
+        log_dir=log_dir,
+        jobs=jobs,
+        timeout=timeout,
+    )
+    print()
+    print_summary(results)
+    errors = [result.host for result in results if not result.ok]
+    if errors:
+        print('Deploy finished with errors on the following hosts:')
+        for host in errors:
+            print(host)
+        return min(len(errors), 255)
+    print('Done deploying conda env to all operator machines.')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Deploy pcds conda envs onto many servers at once. '
+            'Uses ssh and pcds_env_deploy to do the installs.'
+        ),
+    )
+    parser.add_argument(
+        '-r', '--run',
+        action='store_true',
+        help='Actually run the script. If omitted, does a dry run.',
+    )
+    parser.add_argument(
+        '-e', '--env',
+        help='The environment to deploy, or latest if omitted.',
+    )
+    parser.add_argument(
+        '-f', '--file',
+        default=HOSTS_FILE,
+        help=(
+            'The file that contains a list of hosts to install to. '
+            'Defaults to the hosts.txt file in this directory.'
+        ),
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=JOBS,
+        help='How many hosts to deploy to at the same time.',
+    )
+    parser.add_argument(
+        '--ssh',
+        default='ssh',
+        help='The ssh command to use, e.g. "ssh -o ConnectTimeout=10".',
+    )
+    parser.add_argument(
+        '--log-dir',
+        help='Where to put the per-host logs. Defaults to a new dir in logs.',
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        help='Seconds to wait for each host before giving up on it.',
+    )
+    args = parser.parse_args()
+    sys.exit(main(
+        run=args.run,
+        env=args.env,
+        hosts_file=args.file,
+        jobs=args.jobs,
+        ssh=args.ssh,
+        log_dir=args.log_dir,
+        timeout=args.timeout,
+    ))
@@ -0,0 +1,299 @@
+"""
+Check that an unpacked env has every file from its pack, intact.
+
+When a release is staged, stage_release.sh writes a manifest of the pack
+next to it, e.g. pcds-6.0.0.manifest.json.gz. The manifest has the size
+and sha256 of every file, the target of every symlink, and the list of
+files that contain the build prefix.
+
+conda-unpack rewrites the prefix in those files to wherever the env was
+unpacked, so their size and contents depend on the host. Only their
+presence is checked. Every other file must match the manifest exactly.
+
+The full check reads every file, hashing several at a time using mmap.
+The size-only check only stats the files, which is enough to catch a
+truncated or interrupted extract in a fraction of the time.
+
+Make a manifest:
+
+    python env_manifest.py create pcds-6.0.0.tar.gz --prefix /path/to/env
+
+Check an unpacked env:
+
+    python env_manifest.py verify pcds-6.0.0.manifest.json.gz /u1/opr/env
+"""
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import os.path
+import sys
+import tarfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_SUFFIX = '.manifest.json.gz'
+MANIFEST_VERSION = 1
+# Files from packages built with conda-build's long placeholder prefix
+PLACEHOLDER = b'placehold_placehold'
+CHUNK_SIZE = 1024 * 1024
+WORKERS = 8
+# The most mismatches to print for one env
+MAX_REPORTED = 50
+
+
+@dataclass
+class EnvManifest:
+    # Path to (size, sha256) for regular files
+    files: Dict[str, Tuple[int, str]] = field(default_factory=dict)
+    # Path to target for symlinks
+    links: Dict[str, str] = field(default_factory=dict)
+    # Files that conda-unpack rewrites, so only their presence is checked
+    rewritten: List[str] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, path: str) -> 'EnvManifest':
+        with gzip.open(path, 'rt') as fd:
+            data = json.load(fd)
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError(
+                f'Unsupported manifest version {data.get("version")} in {path}'
+            )
+        return cls(
+            files={
+                name: (size, digest)
+                for name, (size, digest) in data['files'].items()
+            },
+            links=data['links'],
+            rewritten=data['rewritten'],
+        )
+
+    def save(self, path: str) -> None:
+        data = {
+            'version': MANIFEST_VERSION,
+            'files': self.files,
+            'links': self.links,
+            'rewritten': self.rewritten,
+        }
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wt') as fd:
+            json.dump(data, fd)
+        os.replace(tmp_path, path)
+
+
+def manifest_path(pack: str) -> str:
+    """The manifest for e.g. pcds-6.0.0.tar.gz is pcds-6.0.0.manifest.json.gz"""
+    base = os.path.basename(pack).split('.tar')[0]
+    return os.path.join(os.path.dirname(pack), base + MANIFEST_SUFFIX)
+
+
+def make_manifest(pack: str, prefix: str) -> EnvManifest:
+    """
+    Read every file in a pack to make its manifest.
+
+    Parameters
+    ----------
+    pack : str
+        The .tar.gz made by conda-pack.
+    prefix : str
+        Where the packed env was built. Files that contain this path are
+        the ones conda-unpack rewrites.
+    """
+    markers = [os.fsencode(prefix), PLACEHOLDER]
+    overlap = max(len(marker) for marker in markers)
+    manifest = EnvManifest()
+    with tarfile.open(pack, 'r:*') as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if member.issym():
+                manifest.links[name] = member.linkname
+                continue
+            if not (member.isfile() or member.islnk()):
+                continue
+            digest = hashlib.sha256()
+            size = 0
+            rewritten = False
+            tail = b''
+            fd = tar.extractfile(member)
+            for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                # Include the end of the last chunk, in case a marker spans both
+                window = tail + chunk
+                if any(marker in window for marker in markers):
+                    rewritten = True
+                tail = window[-overlap:]
+            if rewritten:
+                manifest.rewritten.append(name)
+            else:
+                manifest.files[name] = (size, digest.hexdigest())
+    manifest.rewritten.sort()
+    return manifest
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            # mmap can't map an empty file
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+
+def check_file(
+    env_dir: str,
+    name: str,
+    size: int,
+    digest: str,
+    sizes_only: bool,
+) -> Optional[str]:
+    """Check one regular file, returning a description of any mismatch."""
+    path = os.path.join(env_dir, name)
+    try:
+        found_size = os.stat(path).st_size
+    except FileNotFoundError:
+        return f'missing {name}'
+    if found_size != size:
+        return f'size {name}: expected {size}, found {found_size}'
+    if not sizes_only and file_hash(path) != digest:
+        return f'hash {name}'
+    return None
+
+
+def verify_env(
+    manifest: EnvManifest,
+    env_dir: str,
+    sizes_only: bool = False,
+    workers: int = WORKERS,
+) -> List[str]:
+    """
+    Compare an unpacked env with its manifest.
+
+    Parameters
+    ----------
+    manifest : EnvManifest
+        The manifest of the env's pack.
+    env_dir : str
+        The unpacked env.
+    sizes_only : bool, optional
+        If True, check sizes without reading the files.
+    workers : int, optional
+        How many files to hash at the same time.
+
+    Returns
+    -------
+    mismatches : list of str
+        One line for every file that is missing or differs, sorted by path.
+    """
+    mismatches = {}
+    for name, target in manifest.links.items():
+        path = os.path.join(env_dir, name)
+        if not os.path.islink(path):
+            mismatches[name] = f'missing {name}'
+        elif os.readlink(path) != target:
+            mismatches[name] = (
+                f'link {name}: expected {target}, found {os.readlink(path)}'
+            )
+    for name in manifest.rewritten:
+        if not os.path.isfile(os.path.join(env_dir, name)):
+            mismatches[name] = f'missing {name}'
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(check_file, env_dir, name, size, digest, sizes_only): name
+            for name, (size, digest) in manifest.files.items()
+        }
+        for future, name in futures.items():
+            mismatch = future.result()
+            if mismatch is not None:
+                mismatches[name] = mismatch
+    return [mismatches[name] for name in sorted(mismatches)]
+
+
+def main_create(pack: str, prefix: str, output: Optional[str]) -> int:
+    if output is None:
+        output = manifest_path(pack)
+    print(f'Writing env manifest {output}')
+    manifest = make_manifest(pack, prefix)
+    manifest.save(output)
+    print(
+        f'{len(manifest.files)} files, {len(manifest.links)} symlinks, '
+        f'{len(manifest.rewritten)} files rewritten by conda-unpack'
+    )
+    return 0
+
+
+def main_verify(
+    manifest_file: str,
+    env_dir: str,
+    sizes_only: bool,
+    workers: int,
+) -> int:
+    if not os.path.isdir(env_dir):
+        print(f'{env_dir} does not exist or is not a directory!')
+        return 1
+    manifest = EnvManifest.load(manifest_file)
+    mismatches = verify_env(
+        manifest, env_dir, sizes_only=sizes_only, workers=workers,
+    )
+    total = len(manifest.files) + len(manifest.links) + len(manifest.rewritten)
+    kind = 'sizes' if sizes_only else 'contents'
+    if not mismatches:
+        print(f'All {total} files in {env_dir} match the manifest ({kind}).')
+        return 0
+    for line in mismatches[:MAX_REPORTED]:
+        print(line)
+    if len(mismatches) > MAX_REPORTED:
+        print(f'... and {len(mismatches) - MAX_REPORTED} more')
+    print(
+        f'{len(mismatches)} of {total} files in {env_dir} do not match the '
+        f'manifest ({kind}).'
+    )
+    return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Make or check the manifest of a packed env.',
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    create_parser = subparsers.add_parser(
+        'create',
+        help='Write the manifest of a conda-pack .tar.gz.',
+    )
+    create_parser.add_argument('pack', help='The pack to read.')
+    create_parser.add_argument(
+        '--prefix',
+        required=True,
+        help='Where the packed env was built.',
+    )
+    create_parser.add_argument(
+        '--output',
+        help='Where to write the manifest. Defaults to next to the pack.',
+    )
+    verify_parser = subparsers.add_parser(
+        'verify',
+        help='Check an unpacked env against its manifest.',
+    )
+    verify_parser.add_argument('manifest', help='The manifest of the pack.')
+    verify_parser.add_argument('env_dir', help='The unpacked env.')
+    verify_parser.add_argument(
+        '--sizes-only',
+        action='store_true',
+        help='Only compare file sizes, without reading the files.',
+    )
+    verify_parser.add_argument(
+        '--workers',
+        type=int,
+        default=WORKERS,
+        help='How many files to hash at the same time.',
+    )
+    args = parser.parse_args()
+    if args.command == 'create':
+        sys.exit(main_create(args.pack, args.prefix, args.output))
+    sys.exit(main_verify(
+        args.manifest, args.env_dir, args.sizes_only, args.workers,
+    ))
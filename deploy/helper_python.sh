@@ -0,0 +1,46 @@
+# helper_python.sh
+# Sourced by pcds_env_deploy, conda_unpack_helper and validate_unpack
+# to pick the python that runs the python helpers, e.g. stage_pack.py
+#
+# The helpers only use the standard library, but need python 3.7 or newer.
+# In order, this uses:
+# - PCDS_HELPER_PYTHON, if set
+# - the host's python3
+# - the python of the pcds env PCDS_HELPER_ENV, found through pcds_conda
+#
+# HELPER_PYTHON is left empty if none of these work, and the callers then
+# skip the steps that need it. It is exported as PCDS_HELPER_PYTHON so
+# that scripts called from here do not need to look again.
+
+PCDS_HELPER_ENV="${PCDS_HELPER_ENV:-pcds-5.4.1}"
+PCDS_CONDA="${PCDS_CONDA:-/cds/group/pcds/pyps/conda/pcds_conda}"
+
+helper_python_ok()
+{
+  [ -n "${1}" ] && "${1}" -c 'import dataclasses' >/dev/null 2>&1
+}
+
+HELPER_PYTHON=""
+for CANDIDATE in "${PCDS_HELPER_PYTHON}" "$(command -v python3)"; do
+  if helper_python_ok "${CANDIDATE}"; then
+    HELPER_PYTHON="${CANDIDATE}"
+    break
+  fi
+done
+
+if [ -z "${HELPER_PYTHON}" ] && [ -f "${PCDS_CONDA}" ]; then
+  # In a subshell, so that a missing env cannot end the calling script
+  CANDIDATE="$(
+    export PCDS_CONDA_VER="${PCDS_HELPER_ENV}"
+    source "${PCDS_CONDA}" >/dev/null 2>&1
+    command -v python
+  )" || true
+  if helper_python_ok "${CANDIDATE}"; then
+    HELPER_PYTHON="${CANDIDATE}"
+  fi
+fi
+
+if [ -z "${HELPER_PYTHON}" ]; then
+  echo "No python 3.7 or newer found for the python helpers."
+fi
+export PCDS_HELPER_PYTHON="${HELPER_PYTHON}"
@@ -0,0 +1,285 @@
+"""
+Copy a packed env from NFS to local disk before unpacking it.
+
+Unpacking straight from NFS means that an NFS hiccup partway through
+leaves a half-unpacked env behind, which conda_unpack_helper then refuses
+to overwrite. Instead, pcds_env_deploy first copies the pack to local disk
+in large sequential chunks, then unpacks the local copy.
+
+When the pack is made, stage_release.sh publishes a manifest next to it
+with the sha256 of every chunk, e.g. pcds-6.0.0.tar.gz.chunks.json. Each
+chunk is checked against the manifest as it is copied, and a failed read
+is retried. If a copy is interrupted, the next run checks the chunks that
+are already on disk and continues from the first one that is missing or
+wrong. The finished copy gets its final name only after every chunk has
+been checked.
+
+Packs without a manifest are still copied and resumed in chunks, but only
+their size can be checked.
+
+Make a manifest:
+
+    python stage_pack.py manifest pcds-6.0.0.tar.gz
+
+Copy a pack to local disk:
+
+    python stage_pack.py stage /nfs/pcds-6.0.0.tar.gz /u1/opr/conda_envs/.staging
+"""
+import argparse
+import hashlib
+import json
+import os
+import os.path
+import sys
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+MANIFEST_SUFFIX = '.chunks.json'
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 64 * 1024 * 1024
+RETRIES = 5
+
+
+@dataclass
+class ChunkManifest:
+    # The file name of the pack, without the directory
+    filename: str
+    size: int
+    chunk_size: int
+    # The sha256 of each chunk, in order
+    chunks: List[str]
+
+    @classmethod
+    def load(cls, path: str) -> 'ChunkManifest':
+        with open(path, 'r') as fd:
+            data = json.load(fd)
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError(
+                f'Unsupported manifest version {data.get("version")} in {path}'
+            )
+        return cls(
+            filename=data['filename'],
+            size=data['size'],
+            chunk_size=data['chunk_size'],
+            chunks=data['chunks'],
+        )
+
+    def save(self, path: str) -> None:
+        data = {
+            'version': MANIFEST_VERSION,
+            'filename': self.filename,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'algorithm': 'sha256',
+            'chunks': self.chunks,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(data, fd, indent=1)
+        os.replace(tmp_path, path)
+
+
+def manifest_path(pack: str) -> str:
+    return pack + MANIFEST_SUFFIX
+
+
+def chunk_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_manifest(pack: str, chunk_size: int = CHUNK_SIZE) -> ChunkManifest:
+    """Hash every chunk of a pack."""
+    chunks = []
+    with open(pack, 'rb') as fd:
+        for data in iter(lambda: fd.read(chunk_size), b''):
+            chunks.append(chunk_hash(data))
+    return ChunkManifest(
+        filename=os.path.basename(pack),
+        size=os.path.getsize(pack),
+        chunk_size=chunk_size,
+        chunks=chunks,
+    )
+
+
+def read_chunk(fd, offset: int, size: int, expected: Optional[str]) -> bytes:
+    """
+    Read one chunk of the source pack, retrying on errors.
+
+    A chunk that does not match its hash in the manifest is read again, in
+    case NFS handed us bad data, before giving up.
+    """
+    for attempt in range(RETRIES):
+        if attempt:
+            delay = 2 ** (attempt - 1)
+            print(f'Retrying the chunk at byte {offset} in {delay}s', flush=True)
+            time.sleep(delay)
+        try:
+            fd.seek(offset)
+            data = fd.read(size)
+        except OSError as exc:
+            print(f'Error reading the chunk at byte {offset}: {exc}')
+            continue
+        if len(data) != size:
+            print(f'Short read of the chunk at byte {offset}')
+            continue
+        if expected is not None and chunk_hash(data) != expected:
+            print(f'Checksum mismatch in the chunk at byte {offset}')
+            continue
+        return data
+    raise RuntimeError(
+        f'Could not read the chunk at byte {offset} after {RETRIES} tries'
+    )
+
+
+def verified_chunks(
+    partial: str,
+    manifest: Optional[ChunkManifest],
+    chunk_size: int,
+) -> int:
+    """
+    Count the chunks at the start of a partial copy that can be kept.
+
+    With a manifest, this is every chunk up to the first one that is
+    missing, short, or does not match. Without one, only the size of each
+    chunk can be checked.
+    """
+    if not os.path.exists(partial):
+        return 0
+    good = 0
+    with open(partial, 'rb') as fd:
+        for data in iter(lambda: fd.read(chunk_size), b''):
+            if manifest is None:
+                if len(data) != chunk_size:
+                    break
+            elif (
+                good >= len(manifest.chunks)
+                or chunk_hash(data) != manifest.chunks[good]
+            ):
+                break
+            good += 1
+    return good
+
+
+def stage_pack(source: str, staging_dir: str) -> str:
+    """
+    Copy a pack to local disk, resuming and checking it chunk by chunk.
+
+    Parameters
+    ----------
+    source : str
+        The pack on NFS. Its manifest is read from next to it, if there is
+        one.
+    staging_dir : str
+        The local directory to copy the pack into. Created if needed.
+
+    Returns
+    -------
+    path : str
+        The checked local copy of the pack.
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    filename = os.path.basename(source)
+    dest = os.path.join(staging_dir, filename)
+    partial = dest + '.partial'
+    size = os.path.getsize(source)
+
+    manifest = None
+    if os.path.exists(manifest_path(source)):
+        manifest = ChunkManifest.load(manifest_path(source))
+        if manifest.filename != filename or manifest.size != size:
+            raise RuntimeError(
+                f'The manifest for {source} does not match the pack, it may '
+                'still be being copied to NFS.'
+            )
+        chunk_size = manifest.chunk_size
+    else:
+        print(f'No manifest found for {source}, only checking the size')
+        chunk_size = CHUNK_SIZE
+    num_chunks = -(-size // chunk_size)
+
+    # A finished copy from an earlier run only needs to be checked
+    if os.path.exists(dest):
+        os.replace(dest, partial)
+    done = verified_chunks(partial, manifest, chunk_size)
+    if done:
+        print(f'Keeping {done} of {num_chunks} chunks from an earlier copy')
+
+    # The last chunk may be short, so never grow the file past the pack
+    resume_at = min(done * chunk_size, size)
+    mode = 'r+b' if os.path.exists(partial) else 'wb'
+    with open(source, 'rb') as src, open(partial, mode) as dst:
+        dst.truncate(resume_at)
+        dst.seek(resume_at)
+        for index in range(done, num_chunks):
+            offset = index * chunk_size
+            expected = None if manifest is None else manifest.chunks[index]
+            data = read_chunk(
+                src, offset, min(chunk_size, size - offset), expected,
+            )
+            dst.write(data)
+            print(f'Copied chunk {index + 1} of {num_chunks}', flush=True)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+    if os.path.getsize(partial) != size:
+        raise RuntimeError(
+            f'{partial} is {os.path.getsize(partial)} bytes, expected {size}'
+        )
+    os.replace(partial, dest)
+    return dest
+
+
+def main_manifest(packs: List[str], chunk_size: int) -> int:
+    for pack in packs:
+        path = manifest_path(pack)
+        print(f'Writing chunk manifest {path}')
+        make_manifest(pack, chunk_size=chunk_size).save(path)
+    return 0
+
+
+def main_stage(source: str, staging_dir: str) -> int:
+    if not os.path.isfile(source):
+        print(f'Could not find {source}. Aborting.')
+        return 1
+    print(f'Copying {source} into {staging_dir}', flush=True)
+    try:
+        dest = stage_pack(source, staging_dir)
+    except (OSError, RuntimeError, ValueError) as exc:
+        print(f'Copy failed: {exc}')
+        print('Run again to continue from the last good chunk.')
+        return 1
+    print(f'Copied and checked {dest}')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Copy packed envs to local disk in checked chunks.',
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    manifest_parser = subparsers.add_parser(
+        'manifest',
+        help='Write the chunk manifest for packs, next to each pack.',
+    )
+    manifest_parser.add_argument('packs', nargs='+', help='The packs to hash.')
+    manifest_parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=CHUNK_SIZE,
+        help='The size of each chunk in bytes.',
+    )
+    stage_parser = subparsers.add_parser(
+        'stage',
+        help='Copy a pack to local disk, resuming an earlier copy.',
+    )
+    stage_parser.add_argument('source', help='The pack to copy.')
+    stage_parser.add_argument(
+        'staging_dir',
+        help='The local directory to copy the pack into.',
+    )
+    args = parser.parse_args()
+    if args.command == 'manifest':
+        sys.exit(main_manifest(args.packs, args.chunk_size))
+    sys.exit(main_stage(args.source, args.staging_dir))
@@ -0,0 +1,5 @@
+import os.path
+import sys
+
+# The deploy scripts import each other by name, as when run from deploy/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tarfile
+
+import pytest
+
+from dedup_env import OBJECTS_DIR, collect_garbage, dedup_env, extract_pack
+from env_manifest import make_manifest
+
+BUILD_PREFIX = '/opt/build/pcds-env'
+
+
+def make_env(root):
+    (root / 'bin').mkdir(parents=True)
+    (root / 'lib').mkdir()
+    (root / 'lib' / 'big').write_bytes(os.urandom(200_000))
+    (root / 'lib' / 'same1').write_text('same\n')
+    (root / 'lib' / 'same2').write_text('same\n')
+    script = root / 'bin' / 'tool'
+    script.write_text(f'#!{BUILD_PREFIX}/bin/python\n')
+    script.chmod(0o755)
+    (root / 'lib' / 'link').symlink_to('big')
+
+
+@pytest.fixture
+def pack(tmp_path):
+    build = tmp_path / 'build'
+    make_env(build)
+    path = tmp_path / 'pcds-1.0.0.tar'
+    with tarfile.open(path, 'w') as tar:
+        tar.add(build, arcname='.')
+    return path, make_manifest(str(path), BUILD_PREFIX)
+
+
+def extract(pack, env_dir):
+    path, manifest = pack
+    with open(path, 'rb') as fd:
+        return extract_pack(fd, str(env_dir), manifest)
+
+
+def test_extract_links_stored_files(pack, tmp_path):
+    envs = tmp_path / 'envs'
+    first = extract(pack, envs / 'pcds-1.0.0')
+    assert first.linked + first.stored == first.files == 3
+    assert first.linked == 1  # same2 matches same1
+
+    second = extract(pack, envs / 'pcds-1.0.1')
+    assert second.linked == second.files == 3
+    assert second.stored == 0
+    for name in ('big', 'same1', 'same2'):
+        old = envs / 'pcds-1.0.0' / 'lib' / name
+        new = envs / 'pcds-1.0.1' / 'lib' / name
+        assert os.path.samefile(old, new)
+        assert new.read_bytes() == (tmp_path / 'build' / 'lib' / name).read_bytes()
+    assert os.readlink(envs / 'pcds-1.0.1' / 'lib' / 'link') == 'big'
+
+    # conda-unpack rewrites this one in place, so it must not be shared
+    old_tool = envs / 'pcds-1.0.0' / 'bin' / 'tool'
+    new_tool = envs / 'pcds-1.0.1' / 'bin' / 'tool'
+    assert not os.path.samefile(old_tool, new_tool)
+    assert os.stat(new_tool).st_nlink == 1
+    assert os.stat(new_tool).st_mode & 0o777 == 0o755
+
+
+def test_dedup_after_unpack(pack, tmp_path):
+    path, _ = pack
+    envs = tmp_path / 'envs'
+    for name in ('pcds-1.0.0', 'pcds-1.0.1'):
+        with tarfile.open(path) as tar:
+            tar.extractall(envs / name)
+    dedup_env(str(envs / 'pcds-1.0.0'))
+    stats = dedup_env(str(envs / 'pcds-1.0.1'))
+    assert stats.linked == stats.files == 4
+    assert os.path.samefile(
+        envs / 'pcds-1.0.0' / 'lib' / 'big',
+        envs / 'pcds-1.0.1' / 'lib' / 'big',
+    )
+
+
+def test_collect_garbage(pack, tmp_path):
+    envs = tmp_path / 'envs'
+    extract(pack, envs / 'pcds-1.0.0')
+    extract(pack, envs / 'pcds-1.0.1')
+    objects = str(envs / OBJECTS_DIR)
+
+    shutil.rmtree(envs / 'pcds-1.0.0')
+    assert collect_garbage(objects) == (0, 0)
+
+    shutil.rmtree(envs / 'pcds-1.0.1')
+    assert collect_garbage(objects, dry_run=True)[0] == 2
+    count, size = collect_garbage(objects)
+    assert count == 2
+    assert size == 200_000 + len('same\n')
+    assert collect_garbage(objects) == (0, 0)
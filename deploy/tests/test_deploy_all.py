@@ -0,0 +1,99 @@
+import shlex
+
+import pytest
+
+import deploy_all
+from deploy_all import fan_out, print_summary, run_on_host
+
+# Runs the "remote" command locally, with the host name in $HOST
+STAND_IN_SSH = """\
+[ "$1" = -n ] || { echo "expected -n, got $1" >&2; exit 255; }
+HOST="$2"
+export HOST
+exec sh -c "$3"
+"""
+
+
+@pytest.fixture
+def ssh(tmp_path):
+    script = tmp_path / 'ssh'
+    script.write_text(STAND_IN_SSH)
+    return ['sh', str(script)]
+
+
+def host_command(host):
+    if host.startswith('bad'):
+        return 'echo "starting on $HOST"; echo "broken on $HOST" >&2; exit 3'
+    if host.startswith('slow'):
+        return 'sleep 30'
+    return 'echo "deployed on $HOST"'
+
+
+def test_run_on_host(ssh, tmp_path):
+    result = run_on_host('good-01', host_command('good-01'), ssh, str(tmp_path))
+    assert result.ok
+    assert result.returncode == 0
+    with open(result.stdout_path) as fd:
+        assert fd.read() == 'deployed on good-01\n'
+    with open(result.stderr_path) as fd:
+        assert fd.read() == ''
+
+
+def test_run_on_host_timeout(ssh, tmp_path):
+    result = run_on_host(
+        'slow-01', host_command('slow-01'), ssh, str(tmp_path), timeout=0.5,
+    )
+    assert not result.ok
+    assert result.returncode is None
+    assert result.duration < 10
+    with open(result.stderr_path) as fd:
+        assert fd.read() == 'Timed out after 0.5 seconds\n'
+
+
+def test_fan_out(ssh, tmp_path, capsys):
+    hosts = ['good-01', 'bad-01', 'slow-01', 'good-02']
+    log_dir = tmp_path / 'logs'
+    results = fan_out(
+        hosts, host_command, ssh, str(log_dir), jobs=4, timeout=2,
+    )
+    assert [result.host for result in results] == hosts
+    assert [result.returncode for result in results] == [0, 3, None, 0]
+    assert (log_dir / 'good-02.stdout').read_text() == 'deployed on good-02\n'
+    assert (log_dir / 'bad-01.stdout').read_text() == 'starting on bad-01\n'
+    assert (log_dir / 'bad-01.stderr').read_text() == 'broken on bad-01\n'
+    output = capsys.readouterr().out
+    assert 'Done with bad-01 (FAILED' in output
+    assert 'Done with good-01 (ok' in output
+
+    print_summary(results)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ['host', 'exit', 'time', 'log']
+    summary = {line.split()[0]: line.split() for line in lines[1:]}
+    assert summary['good-01'][1] == '0'
+    assert summary['good-01'][3] == str(log_dir / 'good-01.stdout')
+    assert summary['bad-01'][1] == '3'
+    assert summary['bad-01'][3] == str(log_dir / 'bad-01.stderr')
+    assert summary['slow-01'][1] == 'timeout'
+
+
+def test_main(tmp_path, capsys):
+    hosts_file = tmp_path / 'hosts.txt'
+    hosts_file.write_text('good-01\n\nbad-01\nbad-02\n')
+    # Print the deploy command instead of running it, failing on bad hosts
+    script = tmp_path / 'echo-ssh'
+    script.write_text('echo "$3"; case "$2" in bad*) exit 1;; esac\n')
+    log_dir = tmp_path / 'logs'
+    code = deploy_all.main(
+        run=True,
+        env='pcds-6.0.0',
+        hosts_file=str(hosts_file),
+        ssh=f'sh {shlex.quote(str(script))}',
+        log_dir=str(log_dir),
+    )
+    assert code == 2
+    expected = f'{deploy_all.DEPLOY} -d -r -e pcds-6.0.0\n'
+    assert (log_dir / 'good-01.stdout').read_text() == expected
+    output = capsys.readouterr().out
+    assert output.endswith(
+        'Deploy finished with errors on the following hosts:\nbad-01\nbad-02\n'
+    )
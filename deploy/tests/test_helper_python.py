@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+HELPER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'helper_python.sh',
+)
+# Stands in for pcds_conda: puts the env's bin on PATH, or exits if it is missing
+PCDS_CONDA = """\
+ENV_BIN="{envs}/${{PCDS_CONDA_VER}}/bin"
+if [ ! -d "${{ENV_BIN}}" ]; then
+  echo "No env ${{PCDS_CONDA_VER}}"
+  exit 1
+fi
+export PATH="${{ENV_BIN}}:${{PATH}}"
+"""
+
+
+def link_python(bin_dir, name):
+    os.makedirs(bin_dir, exist_ok=True)
+    os.symlink(sys.executable, os.path.join(bin_dir, name))
+    return os.path.join(bin_dir, name)
+
+
+@pytest.fixture
+def host(tmp_path):
+    """A host with no python3 on PATH, and pcds_conda with one env."""
+    envs = tmp_path / 'envs'
+    pcds_conda = tmp_path / 'pcds_conda'
+    pcds_conda.write_text(PCDS_CONDA.format(envs=envs))
+    env = {
+        'PATH': str(tmp_path / 'bin'),
+        'PCDS_CONDA': str(pcds_conda),
+    }
+    return tmp_path, env
+
+
+def pick(env):
+    """Source helper_python.sh like the deploy scripts, under set -e."""
+    script = f'set -e; source {HELPER}; echo "picked:${{HELPER_PYTHON}}"'
+    proc = subprocess.run(
+        ['/bin/bash', '-c', script],
+        env=env,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return proc.stdout.splitlines()
+
+
+def test_host_python3(host):
+    tmp_path, env = host
+    python3 = link_python(tmp_path / 'bin', 'python3')
+    assert pick(env) == [f'picked:{python3}']
+
+
+def test_override(host):
+    tmp_path, env = host
+    link_python(tmp_path / 'bin', 'python3')
+    env['PCDS_HELPER_PYTHON'] = link_python(tmp_path / 'other', 'python')
+    assert pick(env) == [f'picked:{env["PCDS_HELPER_PYTHON"]}']
+
+
+def test_pcds_env(host):
+    tmp_path, env = host
+    python = link_python(tmp_path / 'envs' / 'pcds-5.4.1' / 'bin', 'python')
+    assert pick(env) == [f'picked:{python}']
+    env['PCDS_HELPER_ENV'] = 'pcds-6.0.0'
+    python = link_python(tmp_path / 'envs' / 'pcds-6.0.0' / 'bin', 'python')
+    assert pick(env) == [f'picked:{python}']
+
+
+def test_nothing_found(host):
+    tmp_path, env = host
+    # pcds_conda exits when the env is missing, which must not end the caller
+    assert pick(env) == [
+        'No python 3.7 or newer found for the python helpers.',
+        'picked:',
+    ]
+    os.remove(env['PCDS_CONDA'])
+    assert pick(env)[-1] == 'picked:'
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from stage_pack import make_manifest, manifest_path, stage_pack
+
+SIZE = 1_000_003
+CHUNK_SIZE = 100_000
+
+
+@pytest.fixture
+def pack(tmp_path):
+    nfs = tmp_path / 'nfs'
+    nfs.mkdir()
+    path = nfs / 'pcds-1.0.0.tar.gz'
+    path.write_bytes(os.urandom(SIZE))
+    make_manifest(str(path), chunk_size=CHUNK_SIZE).save(manifest_path(str(path)))
+    return path
+
+
+def test_stage_fresh(pack, tmp_path):
+    dest = stage_pack(str(pack), str(tmp_path / 'staging'))
+    assert open(dest, 'rb').read() == pack.read_bytes()
+
+
+def test_restage_completed_copy(pack, tmp_path):
+    staging = tmp_path / 'staging'
+    stage_pack(str(pack), str(staging))
+    dest = stage_pack(str(pack), str(staging))
+    assert open(dest, 'rb').read() == pack.read_bytes()
+    assert not (staging / 'pcds-1.0.0.tar.gz.partial').exists()
+
+
+def test_resume_truncated_copy(pack, tmp_path, capsys):
+    staging = tmp_path / 'staging'
+    staging.mkdir()
+    partial = staging / 'pcds-1.0.0.tar.gz.partial'
+    partial.write_bytes(pack.read_bytes()[:350_000])
+    dest = stage_pack(str(pack), str(staging))
+    assert open(dest, 'rb').read() == pack.read_bytes()
+    assert 'Keeping 3 of 11 chunks' in capsys.readouterr().out
+
+
+def test_recopy_corrupt_chunk(pack, tmp_path):
+    staging = tmp_path / 'staging'
+    dest = stage_pack(str(pack), str(staging))
+    with open(dest, 'r+b') as fd:
+        fd.seek(CHUNK_SIZE * 5 + 10)
+        fd.write(b'X')
+    dest = stage_pack(str(pack), str(staging))
+    assert open(dest, 'rb').read() == pack.read_bytes()
+
+
+def test_stale_manifest(pack, tmp_path):
+    with open(pack, 'ab') as fd:
+        fd.write(b'more')
+    with pytest.raises(RuntimeError, match='does not match the pack'):
+        stage_pack(str(pack), str(tmp_path / 'staging'))
+
+
+def test_no_manifest(pack, tmp_path):
+    os.remove(manifest_path(str(pack)))
+    staging = tmp_path / 'staging'
+    stage_pack(str(pack), str(staging))
+    dest = stage_pack(str(pack), str(staging))
+    assert open(dest, 'rb').read() == pack.read_bytes()
@@ -0,0 +1,131 @@
+"""
+Run validate_unpack on all hosts at the same time for a given environment.
+
+Each host checks its unpacked env against the env's manifest, see
+env_manifest.py. The output of each host is kept in its own log file, and
+the files that did not match are printed for every host that failed.
+"""
+import argparse
+import os.path
+import shlex
+import sys
+from typing import List, Optional
+
+from deploy_all import (HERE, HOSTS_FILE, JOBS, default_log_dir, fan_out,
+                        print_summary, read_hosts)
+
+VALIDATE = os.path.join(HERE, 'validate_unpack')
+UNPACK_DIRECTORY = '/u1/{hutch}opr/conda_envs'
+# The most output lines to show for each failed host
+MAX_LINES = 20
+
+
+def tail_lines(path: str, count: int = MAX_LINES) -> List[str]:
+    with open(path, 'r', errors='replace') as fd:
+        return fd.read().splitlines()[-count:]
+
+
+def main(
+    env: str,
+    sizes_only: bool = False,
+    hosts_file: str = HOSTS_FILE,
+    jobs: int = JOBS,
+    ssh: str = 'ssh',
+    log_dir: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> int:
+    if not os.path.isfile(hosts_file):
+        print(f'Could not find hosts file {hosts_file}. Aborting.')
+        return 1
+    if log_dir is None:
+        log_dir = default_log_dir('validate')
+
+    def make_command(host):
+        env_dir = os.path.join(
+            UNPACK_DIRECTORY.format(hutch=host.split('-')[0]), env,
+        )
+        args = [VALIDATE]
+        if sizes_only:
+            args.append('-s')
+        args.append(env_dir)
+        return ' '.join(shlex.quote(arg) for arg in args)
+
+    hosts = read_hosts(hosts_file)
+    print(f'Validating {env} on {len(hosts)} hosts, {jobs} at a time')
+    print(f'Logs are in {log_dir}', flush=True)
+    results = fan_out(
+        hosts,
+        make_command,
+        ssh=shlex.split(ssh),
+        log_dir=log_dir,
+        jobs=jobs,
+        timeout=timeout,
+    )
+    print()
+    print_summary(results)
+    errors = [result for result in results if not result.ok]
+    if errors:
+        for result in errors:
+            print()
+            print(f'{result.host}:')
+            # ssh errors end up in stderr, the mismatches in stdout
+            for path in (result.stdout_path, result.stderr_path):
+                for line in tail_lines(path):
+                    print(f'  {line}')
+        print()
+        print('Verify finished with errors on the following hosts:')
+        for result in errors:
+            print(result.host)
+        return min(len(errors), 255)
+    print(f'Done verifying conda env {env} on all operator machines.')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check all hosts to see if an env was installed correctly.',
+    )
+    parser.add_argument('env', help='The environment to check, e.g. pcds-6.0.0')
+    parser.add_argument(
+        '-s', '--sizes-only',
+        action='store_true',
+        help='Only compare file sizes with the manifest, which is faster.',
+    )
+    parser.add_argument(
+        '-f', '--file',
+        default=HOSTS_FILE,
+        help=(
+            'The file that contains a list of hosts to check. '
+            'Defaults to the hosts.txt file in this directory.'
+        ),
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=JOBS,
+        help='How many hosts to check at the same time.',
+    )
+    parser.add_argument(
+        '--ssh',
+        default='ssh',
+        help='The ssh command to use, e.g. "ssh -o ConnectTimeout=10".',
+    )
+    parser.add_argument(
+        '--log-dir',
+        help='Where to put the per-host logs. Defaults to a new dir in logs.',
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        help='Seconds to wait for each host before giving up on it.',
+    )
+    args = parser.parse_args()
+    sys.exit(main(
+        env=args.env,
+        sizes_only=args.sizes_only,
+        hosts_file=args.file,
+        jobs=args.jobs,
+        ssh=args.ssh,
+        log_dir=args.log_dir,
+        timeout=args.timeout,
+    ))
@@ -0,0 +1,150 @@
+"""
+Shared helpers for the on-disk caches used by the release scripts.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+
+def cache_dir(*parts: str) -> Path:
+    """
+    Get a directory for cached data, creating it if needed.
+
+    This is $PCDS_ENVS_CACHE if set, otherwise $XDG_CACHE_HOME/pcds-envs,
+    which defaults to ~/.cache/pcds-envs.
+
+    Parameters
+    ----------
+    *parts : str
+        Subdirectories to use inside the main cache directory.
+    """
+    try:
+        root = Path(os.environ['PCDS_ENVS_CACHE'])
+    except KeyError:
+        xdg = os.environ.get('XDG_CACHE_HOME', '~/.cache')
+        root = Path(xdg).expanduser() / 'pcds-envs'
+    path = root.joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def content_hash(path: Path) -> str:
+    """The sha256 of a file's contents, or an empty string if it is missing."""
+    try:
+        with open(path, 'rb') as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+    except FileNotFoundError:
+        return ''
+
+
+def read_json(path: Path) -> Any:
+    """Load a json cache file, or return None if it is missing or corrupt."""
+    try:
+        with open(path, 'r') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: Path, data: Any) -> None:
+    """Write a json cache file atomically so readers never see half a file."""
+    tmp_path = path.with_name(
+        f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    )
+    with open(tmp_path, 'w') as fd:
+        json.dump(data, fd, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+class MetadataCache:
+    """
+    A small on-disk key-value store for answers from remote servers.
+
+    Each entry expires after ttl seconds. When there are more than
+    max_entries, the oldest entries are dropped on save. In offline mode,
+    every stored answer is used no matter how old it is.
+
+    This can be shared between threads. Call save when done, or use it as a
+    context manager.
+
+    Parameters
+    ----------
+    name : str
+        The name of this cache, which is also its file name.
+    ttl : float
+        How many seconds an answer stays fresh.
+    max_entries : int, optional
+        The most answers to keep.
+    offline : bool, optional
+        If True, use stored answers even if they are stale.
+    """
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        max_entries: int = 1000,
+        offline: bool = False,
+    ):
+        self.path = cache_dir('metadata') / f'{name}.json'
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.offline = offline
+        self._lock = threading.Lock()
+        entries = read_json(self.path)
+        self._entries = entries if isinstance(entries, dict) else {}
+
+    def get(self, key: str) -> Any:
+        """
+        Get a stored answer.
+
+        Raises
+        ------
+        KeyError
+            If there is no answer for key, or if it is stale and we are not
+            offline.
+        """
+        with self._lock:
+            entry = self._entries[key]
+        if not self.offline and time.time() - entry['time'] > self.ttl:
+            raise KeyError(key)
+        return entry['value']
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = {'time': time.time(), 'value': value}
+
+    def fetch(self, key: str, func: Callable[[], Any]) -> Any:
+        """
+        Get a stored answer, or call func to get a new one and store it.
+
+        In offline mode, func is only called if there is no stored answer at
+        all, so it should be able to work offline too or raise.
+        """
+        try:
+            return self.get(key)
+        except KeyError:
+            value = func()
+            self.set(key, value)
+            return value
+
+    def save(self) -> None:
+        with self._lock:
+            keep = sorted(
+                self._entries.items(),
+                key=lambda item: item[1]['time'],
+            )[-self.max_entries:]
+            self._entries = dict(keep)
+            write_json(self.path, self._entries)
+
+    def __enter__(self) -> MetadataCache:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.save()
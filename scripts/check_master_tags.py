@@ -1,38 +1,98 @@
 # Helper script to check which packages we need to tag
-import os
+#
+# A repo is tagged only if a tag points at the HEAD of its default branch.
+# Repos with commits after their latest tag are reported as not tagged,
+# since they need a new tag. This is what the old shallow clone plus
+# git describe --tags reported too: a depth 1 clone has no older tags, so
+# describe never printed e.g. v1.2.3-4-gabc, it failed and the repo was
+# listed as not tagged.
+import argparse
+import concurrent.futures
 import pathlib
-import shutil
 import subprocess
-import sys
 import time
 
+from packaging.version import InvalidVersion, Version
 
-def get_master_tag(repo):
-    tmp_dir = 'check_tag_tmp'
-    shutil.rmtree(tmp_dir, ignore_errors=True)
+from caching import MetadataCache
 
-    clone_tries = 10
-    while clone_tries > 0:
+# Seconds to reuse a repo's tag status for
+TAG_TTL = 600
+URL_BASE = 'https://github.com/{}'
+WORKERS = 8
+RETRIES = 5
+
+
+def ls_remote(url, retries=RETRIES):
+    """
+    Get the HEAD and tag refs of a remote repo, without cloning it.
+
+    Failures are retried with an exponential backoff, starting at 1 second.
+    """
+    delay = 1
+    while True:
         try:
-            subprocess.run(['git', 'clone', '--depth', '1', f'https://github.com/{repo}',
-                            tmp_dir], check=True)
-            break
-        except subprocess.CalledProcessError:
-            time.sleep(5)
-            clone_tries -= 1
-            if clone_tries <= 0:
-                raise
-
-    os.chdir(tmp_dir)
+            return subprocess.check_output(
+                ['git', 'ls-remote', url, 'HEAD', 'refs/tags/*'],
+                universal_newlines=True,
+                stderr=subprocess.PIPE,
+            )
+        except subprocess.CalledProcessError as err:
+            retries -= 1
+            if retries <= 0:
+                raise RuntimeError(
+                    f'Could not list refs of {url}: {err.stderr.strip()}'
+                ) from err
+            time.sleep(delay)
+            delay *= 2
+
+
+def _tag_sort_key(tag):
     try:
-        tag = subprocess.check_output(['git', 'describe', '--tags'],
-                                      universal_newlines=True)
-        tag = tag.strip()
-    except subprocess.CalledProcessError:
-        tag = ''
-    os.chdir('..')
-    shutil.rmtree(tmp_dir)
-    return tag
+        return (1, Version(tag), tag)
+    except InvalidVersion:
+        return (0, Version('0'), tag)
+
+
+def head_tag(refs):
+    """
+    Find the tag that points at HEAD in git ls-remote output.
+
+    Annotated tags are listed twice: once as the sha of the tag object, and
+    once with a ^{} suffix as the sha of the commit it points to. Only the
+    commit shas are compared with HEAD.
+
+    Returns
+    -------
+    tag : str
+        The newest tag at HEAD, or an empty string if HEAD is not tagged.
+    """
+    head = None
+    commits = {}
+    for line in refs.splitlines():
+        sha, ref = line.split()
+        if ref == 'HEAD':
+            head = sha
+        elif ref.startswith('refs/tags/'):
+            tag = ref.removeprefix('refs/tags/')
+            if tag.endswith('^{}'):
+                commits[tag.removesuffix('^{}')] = sha
+            else:
+                commits.setdefault(tag, sha)
+    tags = [tag for tag, sha in commits.items() if sha == head]
+    if head is None or not tags:
+        return ''
+    return max(tags, key=_tag_sort_key)
+
+
+def get_master_tag(repo, url_base=URL_BASE):
+    return head_tag(ls_remote(url_base.format(repo)))
+
+
+def lookup_master_tag(repo, offline=False, url_base=URL_BASE):
+    if offline:
+        raise RuntimeError(f'No cached tag status for {repo}, cannot check offline.')
+    return get_master_tag(repo, url_base)
 
 
 def collect_repos(filename):
@@ -40,12 +100,13 @@ def collect_repos(filename):
         return fd.read().splitlines()
 
 
-def main():
-    try:
-        env = sys.argv[1]
-    except Exception:
-        env = 'pcds'
-
+def main(
+    env='pcds',
+    offline=False,
+    ttl=TAG_TTL,
+    workers=WORKERS,
+    url_base=URL_BASE,
+):
     here = pathlib.Path(__file__).resolve().parent
     test_repos_file = here.parent / 'envs' / env / 'package-tests.txt'
 
@@ -53,12 +114,20 @@ def main():
     tagged = {}
     untagged = []
 
-    for repo in repos:
-        tag = get_master_tag(repo)
-        if tag:
-            tagged[repo] = tag
-        else:
-            untagged.append(repo)
+    def check(repo):
+        # Key by url so results from a different url_base are not mixed up
+        return cache.fetch(
+            url_base.format(repo),
+            lambda: lookup_master_tag(repo, offline, url_base),
+        )
+
+    with MetadataCache('master-tags', ttl=ttl, offline=offline) as cache:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for repo, tag in zip(repos, pool.map(check, repos)):
+                if tag:
+                    tagged[repo] = tag
+                else:
+                    untagged.append(repo)
 
     print()
     for repo, tag in tagged.items():
@@ -70,4 +139,38 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env', nargs='?', default='pcds')
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='Report the last known tag status without any network access.',
+    )
+    parser.add_argument(
+        '--ttl',
+        type=float,
+        default=TAG_TTL,
+        help='How many seconds to reuse a repo\'s tag status for.',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=WORKERS,
+        help='How many repos to check at the same time.',
+    )
+    parser.add_argument(
+        '--url-base',
+        default=URL_BASE,
+        help=(
+            'Format string for the repo urls, where {} is the org/name from '
+            'package-tests.txt, e.g. file:///path/to/repos/{}.git'
+        ),
+    )
+    args = parser.parse_args()
+    main(
+        env=args.env,
+        offline=args.offline,
+        ttl=args.ttl,
+        workers=args.workers,
+        url_base=args.url_base,
+    )
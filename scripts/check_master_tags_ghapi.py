@@ -1,8 +1,34 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
 import pathlib
-import sys
+
+import requests
 from ghapi.all import GhApi
 
+from caching import MetadataCache
+
 api = GhApi()
+# Seconds to reuse a repo's tag status for
+TAG_TTL = 600
+GRAPHQL_URL = 'https://api.github.com/graphql'
+# How many repos to ask about in each graphql query
+BATCH_SIZE = 25
+# How many of the newest tags to compare with the default branch
+TAGS_PER_REPO = 5
+REPO_QUERY = """
+  r{num}: repository(owner: {owner}, name: {name}) {{
+    defaultBranchRef {{ target {{ oid }} }}
+    refs(refPrefix: "refs/tags/", first: {tags},
+         orderBy: {{field: TAG_COMMIT_DATE, direction: DESC}}) {{
+      nodes {{
+        name
+        target {{ oid ... on Tag {{ target {{ oid }} }} }}
+      }}
+    }}
+  }}"""
 
 def is_tag_latest(org: str = 'pcdshub', repo: str = ""):
     """Returns true if the latest commit matches that of the latest tag"""
@@ -22,24 +48,106 @@ def is_tag_latest(org: str = 'pcdshub', repo: str = ""):
     return False
 
 
-def collect_repos(filename):
-    with open(filename, 'r') as fd:
-        return fd.read().splitlines()
+def latest_tag_from_graphql(data):
+    """
+    Pick the tag at the head of the default branch from a repository query.
+
+    Annotated tags point at a tag object, which then points at the commit.
+    """
+    head = data['defaultBranchRef']['target']['oid']
+    for node in data['refs']['nodes']:
+        target = node['target']
+        commit = target.get('target', target)['oid']
+        if commit == head:
+            return node['name']
+    return False
 
 
-def main():
-    try:
-        env = sys.argv[1]
-    except Exception:
-        env = 'pcds'
+def graphql_tag_status(
+    repos,
+    url: str = GRAPHQL_URL,
+    token: str | None = None,
+    batch_size: int = BATCH_SIZE,
+):
+    """
+    Check many repos with a few batched graphql queries.
+
+    Each query asks about batch_size repos at once, using one alias per repo,
+    instead of making two REST calls per repo.
+
+    Returns
+    -------
+    status : dict of str to str or False
+        Each "org/repo" to its tag at the head of the default branch, or
+        False if the head is not tagged.
+    """
+    headers = {}
+    if token:
+        headers['Authorization'] = f'bearer {token}'
+    session = requests.Session()
+    status = {}
+    for start in range(0, len(repos), batch_size):
+        batch = repos[start:start + batch_size]
+        parts = []
+        for num, repo in enumerate(batch):
+            owner, name = repo.split('/')
+            parts.append(REPO_QUERY.format(
+                num=num,
+                owner=json.dumps(owner),
+                name=json.dumps(name),
+                tags=TAGS_PER_REPO,
+            ))
+        response = session.post(
+            url,
+            json={'query': 'query {' + ''.join(parts) + '\n}'},
+            headers=headers,
+        )
+        response.raise_for_status()
+        result = response.json()
+        data = result.get('data') or {}
+        for num, repo in enumerate(batch):
+            repo_data = data.get(f'r{num}')
+            if repo_data is None or repo_data['defaultBranchRef'] is None:
+                errors = [err.get('message') for err in result.get('errors', [])]
+                raise RuntimeError(f'Could not query {repo}: {errors}')
+            status[repo] = latest_tag_from_graphql(repo_data)
+    return status
 
-    here = pathlib.Path(__file__).resolve().parent
-    test_repos_file = here.parent / 'envs' / env / 'package-tests.txt'
 
-    repos = collect_repos(test_repos_file)
-    tagged = {}
-    untagged = []
+def collect_repos(filename):
+    with open(filename, 'r') as fd:
+        return fd.read().splitlines()
 
+
+def graphql_statuses(repos, offline, ttl, graphql_url, batch_size):
+    statuses = {}
+    # Each endpoint, e.g. an enterprise server, has its own answers
+    with MetadataCache('master-tags-graphql', ttl=ttl, offline=offline) as cache:
+        for repo in repos:
+            try:
+                statuses[repo] = cache.get(f'{graphql_url}|{repo}')
+            except KeyError:
+                pass
+        todo = [repo for repo in repos if repo not in statuses]
+        if todo and offline:
+            raise RuntimeError(f'No cached tag status for {todo}, cannot check offline.')
+        if todo:
+            print(f'Querying {len(todo)} repos from {graphql_url}')
+            new_statuses = graphql_tag_status(
+                todo,
+                url=graphql_url,
+                token=os.environ.get('GITHUB_TOKEN'),
+                batch_size=batch_size,
+            )
+            for repo, latest_tag in new_statuses.items():
+                cache.set(f'{graphql_url}|{repo}', latest_tag)
+            statuses.update(new_statuses)
+    return statuses
+
+
+def rest_statuses(repos, offline, ttl):
+    statuses = {}
+    cache = MetadataCache('master-tags-ghapi', ttl=ttl, offline=offline)
     max_out_length = 0
     for i, repo in enumerate(repos):
         org, repository_name = repo.split('/')
@@ -48,13 +156,46 @@ def main():
             max_out_length = len(out_string)
 
         print(out_string + " " * (max_out_length - len(out_string)), end="\r")
-        latest_tag = is_tag_latest(org, repository_name)
+        try:
+            latest_tag = cache.get(repo)
+        except KeyError:
+            if offline:
+                raise RuntimeError(f'No cached tag status for {repo}, cannot check offline.')
+            latest_tag = is_tag_latest(org, repository_name)
+            cache.set(repo, latest_tag)
+        statuses[repo] = latest_tag
+
+    cache.save()
+    print(" " * max_out_length)
+    return statuses
+
+
+def main(
+    env='pcds',
+    offline=False,
+    ttl=TAG_TTL,
+    graphql=False,
+    graphql_url=GRAPHQL_URL,
+    batch_size=BATCH_SIZE,
+):
+    here = pathlib.Path(__file__).resolve().parent
+    test_repos_file = here.parent / 'envs' / env / 'package-tests.txt'
+
+    repos = collect_repos(test_repos_file)
+    tagged = {}
+    untagged = []
+
+    if graphql:
+        statuses = graphql_statuses(repos, offline, ttl, graphql_url, batch_size)
+    else:
+        statuses = rest_statuses(repos, offline, ttl)
+    for repo in repos:
+        latest_tag = statuses[repo]
         if not latest_tag:
             untagged.append(repo)
         else:
             tagged[repo] = latest_tag
 
-    print(" " * max_out_length)
     for repo, tag in tagged.items():
         print(f'{repo} is tagged at {tag}')
 
@@ -63,4 +204,44 @@ def main():
         print(f'{repo} is not tagged')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env', nargs='?', default='pcds')
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='Report the last known tag status without any network access.',
+    )
+    parser.add_argument(
+        '--ttl',
+        type=float,
+        default=TAG_TTL,
+        help='How many seconds to reuse a repo\'s tag status for.',
+    )
+    parser.add_argument(
+        '--graphql',
+        action='store_true',
+        help=(
+            'Check every repo with a few batched graphql queries instead of '
+            'two REST calls per repo. Uses $GITHUB_TOKEN to authenticate.'
+        ),
+    )
+    parser.add_argument(
+        '--graphql-url',
+        default=GRAPHQL_URL,
+        help='The graphql endpoint to query.',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=BATCH_SIZE,
+        help='How many repos to check in each graphql query.',
+    )
+    args = parser.parse_args()
+    main(
+        env=args.env,
+        offline=args.offline,
+        ttl=args.ttl,
+        graphql=args.graphql,
+        graphql_url=args.graphql_url,
+        batch_size=args.batch_size,
+    )
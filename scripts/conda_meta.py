@@ -0,0 +1,127 @@
+"""
+Read the package metadata of a conda prefix directly from disk.
+
+Every conda package installed into a prefix leaves a json record in
+conda-meta, and every python distribution leaves a dist-info directory in
+site-packages. Reading these files is much faster than asking conda, which
+has a slow startup and may need to consult the channel index.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+from collections.abc import Iterator
+from dataclasses import dataclass
+from email.parser import HeaderParser
+from pathlib import Path
+
+from packaging.utils import canonicalize_name
+
+
+def default_prefix() -> Path:
+    """The active conda environment, or the running python's prefix."""
+    return Path(os.environ.get('CONDA_PREFIX', sys.prefix))
+
+
+def spec_name(spec: str) -> str:
+    """
+    Get the package name from a conda match spec.
+
+    For example, "conda-forge::numpy >=1.21,<2" becomes "numpy".
+    """
+    return spec.split()[0].split('::')[-1]
+
+
+@dataclass
+class CondaRecord:
+    # The conda package name e.g. pcdsdevices
+    name: str
+    version: str
+    build: str
+    # The names of the conda packages this one depends on
+    depends: list[str]
+    # The names of the dist-info directories installed by this package
+    dist_infos: list[str]
+
+    @classmethod
+    def from_json(cls, data: dict) -> CondaRecord:
+        """
+        Make a record from the contents of a conda-meta json file.
+
+        Parameters
+        ----------
+        data : dict
+            The loaded json from a conda-meta/*.json file.
+        """
+        dist_infos = set()
+        for filename in data.get('files', []):
+            if '.dist-info/' in filename:
+                parent, _, dirname = filename.split('.dist-info/')[0].rpartition('/')
+                # Skip copies vendored inside other packages, e.g. in setuptools
+                if parent.endswith('site-packages'):
+                    dist_infos.add(dirname)
+        return cls(
+            name=data['name'],
+            version=data['version'],
+            build=data['build'],
+            depends=[spec_name(spec) for spec in data.get('depends', [])],
+            dist_infos=sorted(name + '.dist-info' for name in dist_infos),
+        )
+
+
+@dataclass
+class DistInfo:
+    # The PEP 503 normalized distribution name e.g. line-profiler
+    name: str
+    version: str
+    # The raw Requires-Dist strings
+    requires: list[str]
+    # The Provides-Extra names
+    extras: list[str]
+
+    @classmethod
+    def from_metadata(cls, text: str) -> DistInfo:
+        """
+        Make a DistInfo from the contents of a METADATA file.
+
+        Parameters
+        ----------
+        text : str
+            The text of a dist-info/METADATA file.
+        """
+        headers = HeaderParser().parsestr(text, headersonly=True)
+        return cls(
+            name=canonicalize_name(headers.get('Name', '')),
+            version=headers.get('Version', ''),
+            requires=headers.get_all('Requires-Dist') or [],
+            extras=headers.get_all('Provides-Extra') or [],
+        )
+
+
+def iter_conda_meta_paths(prefix: Path) -> Iterator[Path]:
+    """Yield the path to every conda-meta json record in the prefix."""
+    meta_dir = Path(prefix) / 'conda-meta'
+    if not meta_dir.is_dir():
+        return
+    yield from sorted(meta_dir.glob('*.json'))
+
+
+def iter_dist_info_paths(prefix: Path) -> Iterator[Path]:
+    """Yield the path to every dist-info directory in the prefix."""
+    for site_packages in sorted(Path(prefix).glob('lib/python*/site-packages')):
+        yield from sorted(site_packages.glob('*.dist-info'))
+
+
+def read_conda_record(path: Path) -> CondaRecord:
+    with open(path, 'r') as fd:
+        return CondaRecord.from_json(json.load(fd))
+
+
+def read_dist_info(path: Path) -> DistInfo | None:
+    """Read a dist-info directory, or return None if it has no metadata."""
+    try:
+        with open(Path(path) / 'METADATA', 'r', encoding='utf-8') as fd:
+            return DistInfo.from_metadata(fd.read())
+    except (OSError, UnicodeDecodeError):
+        return None
@@ -25,15 +25,13 @@ ENV_DIR="../envs/${BASE}"
 conda create -y --name "${ENVNAME}" python="${PY_VER}" --file "${ENV_DIR}/conda-packages.txt" --file "${ENV_DIR}/security-packages.txt"
 conda activate "${ENVNAME}"
 
-# First extras round to pick up conda stuff
-python get_extras.py --verbose "${BASE}" > "${ENV_DIR}"/extras_conda.txt
+# Resolve the conda and pypi extras together in one pass
+python get_extras.py --verbose --output-dir "${ENV_DIR}" "${BASE}"
 conda install -y --file "${ENV_DIR}/conda-packages.txt" --file "${ENV_DIR}/security-packages.txt" --file "${ENV_DIR}/extras_conda.txt"
 
 # Main pip install step
 pip install -r "${ENV_DIR}"/pip-packages.txt -r "${ENV_DIR}"/security-packages.txt
 
-# Second extras round to pick up pypi stuff
-python get_extras.py --verbose --for-pypi "${BASE}" > "${ENV_DIR}"/extras_pip.txt
 # Also pull out the git installs, include these with the pip extras
 cut -f 2 -d " " "${ENV_DIR}"/git-packages.txt >> "${ENV_DIR}"/extras_pip.txt
 
@@ -42,15 +42,13 @@ git diff "${GIT_REF}" "${ENV_DIR}/conda-packages.txt" | grep "^+\w" | cut -c 2-
 conda install -q -y -n "${ENVNAME}" --file "${TEMP_CONDA_UP}" --file "${ENV_DIR}/security-packages.txt"
 conda activate "${ENVNAME}"
 
-# First extras round to pick up conda stuff
-python get_extras.py --verbose "${BASE}" > "${ENV_DIR}"/extras_conda.txt
+# Resolve the conda and pypi extras together in one pass
+python get_extras.py --verbose --output-dir "${ENV_DIR}" "${BASE}"
 conda install -y --file "${ENV_DIR}/conda-packages.txt" --file "${ENV_DIR}/security-packages.txt" --file "${ENV_DIR}/extras_conda.txt"
 
 # Install from the pinned latest versions in case something wants an update
 pip install -r "${ENV_DIR}"/pip-packages.txt -r "${ENV_DIR}"/security-packages.txt
 
-# Second extras round to pick up pypi stuff
-python get_extras.py --verbose --for-pypi "${BASE}" > "${ENV_DIR}"/extras_pip.txt
 # Also pull out the git installs, include these with the pip extras
 cut -f 2 -d " " "${ENV_DIR}"/git-packages.txt >> "${ENV_DIR}"/extras_pip.txt
 
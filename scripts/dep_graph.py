@@ -0,0 +1,372 @@
+"""
+Build the full dependency graph of an installed environment in one pass.
+
+Conda packages are read from the conda-meta json records and python
+distributions are read from their dist-info METADATA. Where a python
+distribution was installed by conda, it is known by its conda name so that
+both sources of dependency information land on the same graph nodes.
+
+The parsed metadata can be kept in an on-disk cache so that rebuilding the
+graph after a small environment change only re-reads the files that changed.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import hashlib
+import json
+from collections.abc import Container, Iterable, Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from packaging.markers import UndefinedEnvironmentName
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+
+from caching import cache_dir, content_hash, read_json, write_json
+from conda_meta import (CondaRecord, DistInfo, default_prefix,
+                        iter_conda_meta_paths, iter_dist_info_paths,
+                        read_conda_record, read_dist_info)
+from name_mapping import NameMapping
+
+# Bump this if the cached record format changes
+GRAPH_CACHE_VERSION = 2
+
+
+def _graph_dict() -> dict[str, set[str]]:
+    return collections.defaultdict(set)
+
+
+@dataclass
+class DependencyGraph:
+    # Package name to the names of the packages it requires
+    forward: dict[str, set[str]] = field(default_factory=_graph_dict)
+    # Package name to the names of the packages that require it
+    reverse: dict[str, set[str]] = field(default_factory=_graph_dict)
+
+    def add_edge(self, package: str, requirement: str) -> None:
+        """Record that package requires requirement."""
+        if package == requirement:
+            return
+        self.forward[package].add(requirement)
+        self.reverse[requirement].add(package)
+
+    @classmethod
+    def from_prefix(cls, prefix: Path | None = None) -> DependencyGraph:
+        """
+        Read every conda-meta record and dist-info directory in a prefix.
+
+        Parameters
+        ----------
+        prefix : Path, optional
+            The conda environment to inspect. Defaults to the active one.
+        """
+        if prefix is None:
+            prefix = default_prefix()
+        records = [read_conda_record(path) for path in iter_conda_meta_paths(prefix)]
+        dists = {}
+        for path in iter_dist_info_paths(prefix):
+            info = read_dist_info(path)
+            if info is not None:
+                dists[path.name] = info
+        return cls.from_metadata(records, dists)
+
+    @classmethod
+    def from_metadata(
+        cls,
+        records: Iterable[CondaRecord],
+        dists: dict[str, DistInfo],
+    ) -> DependencyGraph:
+        """
+        Assemble the graph from already-parsed metadata.
+
+        Parameters
+        ----------
+        records : iterable of CondaRecord
+            The conda packages in the environment.
+        dists : dict of str to DistInfo
+            The python distributions in the environment, keyed by
+            dist-info directory name.
+        """
+        graph = cls()
+        records = list(records)
+        for record in records:
+            for dep in record.depends:
+                graph.add_edge(record.name, dep)
+        names = NameMapping.from_metadata(
+            records,
+            {dirname: info.name for dirname, info in dists.items()},
+        )
+        installed = {info.name for info in dists.values()}
+        for info in dists.values():
+            package = names.pypi_to_conda(info.name)
+            for req_name in installed_requirements(info, installed):
+                graph.add_edge(package, names.pypi_to_conda(req_name))
+        return graph
+
+
+def _marker_matches(req: Requirement, extra: str) -> bool:
+    if req.marker is None:
+        return not extra
+    try:
+        return req.marker.evaluate({'extra': extra})
+    except UndefinedEnvironmentName:
+        return False
+
+
+def installed_requirements(
+    info: DistInfo,
+    installed: Container[str],
+) -> Iterator[str]:
+    """
+    Yield the normalized names of the requirements that apply to a dist.
+
+    This includes the core requirements and the requirements of every extra
+    that is fully installed, which is how pkg_resources would see it.
+
+    Parameters
+    ----------
+    info : DistInfo
+        The python distribution to check.
+    installed : container of str
+        The normalized names of every installed python distribution.
+    """
+    reqs = []
+    for spec in info.requires:
+        try:
+            reqs.append(Requirement(spec))
+        except InvalidRequirement:
+            continue
+    for req in reqs:
+        if _marker_matches(req, ''):
+            yield canonicalize_name(req.name)
+    for extra in info.extras:
+        extra_names = [
+            canonicalize_name(req.name) for req in reqs
+            if _marker_matches(req, extra) and not _marker_matches(req, '')
+        ]
+        if all(name in installed for name in extra_names):
+            yield from extra_names
+
+
+def _file_state(path: Path) -> list[int]:
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def default_graph_cache(prefix: Path) -> Path:
+    """The cache file used for a prefix if no other is specified."""
+    key = hashlib.sha256(str(Path(prefix).resolve()).encode()).hexdigest()
+    return cache_dir('dep_graph') / f'{key[:16]}.json'
+
+
+def load_dependency_graph(
+    prefix: Path | None = None,
+    env_path: Path | None = None,
+    cache_path: Path | None = None,
+) -> DependencyGraph:
+    """
+    Build the dependency graph, reusing cached metadata where possible.
+
+    The cache holds the parsed form of every conda-meta record and dist-info
+    directory along with its mtime and size. Only files that were added or
+    changed since the last run are parsed again, and removed files are
+    dropped. If neither the env.yaml contents nor any of the prefix metadata
+    changed, the cached graph is returned as-is.
+
+    Parameters
+    ----------
+    prefix : Path, optional
+        The conda environment to inspect. Defaults to the active one.
+    env_path : Path, optional
+        The env.yaml that describes this environment. Its content hash is
+        part of the cache key.
+    cache_path : Path, optional
+        Where to keep the cache. Defaults to a file in the pcds-envs cache
+        directory that is unique to the prefix.
+    """
+    if prefix is None:
+        prefix = default_prefix()
+    if cache_path is None:
+        cache_path = default_graph_cache(prefix)
+    cache = read_json(cache_path)
+    if not isinstance(cache, dict) or cache.get('version') != GRAPH_CACHE_VERSION:
+        cache = {}
+
+    meta_states = {
+        path.name: (path, _file_state(path))
+        for path in iter_conda_meta_paths(prefix)
+    }
+    dist_states = {}
+    for path in iter_dist_info_paths(prefix):
+        try:
+            dist_states[path.name] = (path, _file_state(path / 'METADATA'))
+        except OSError:
+            continue
+    fingerprint = hashlib.sha256(json.dumps([
+        content_hash(env_path) if env_path is not None else '',
+        sorted((name, state) for name, (_, state) in meta_states.items()),
+        sorted((name, state) for name, (_, state) in dist_states.items()),
+    ]).encode()).hexdigest()
+    if cache.get('fingerprint') == fingerprint:
+        graph = DependencyGraph()
+        for package, requirements in cache['forward'].items():
+            for requirement in requirements:
+                graph.add_edge(package, requirement)
+        return graph
+
+    old_records = cache.get('records', {})
+    records = {}
+    for name, (path, state) in meta_states.items():
+        old = old_records.get(name)
+        if old is not None and old['state'] == state:
+            record = CondaRecord(**old['record'])
+        else:
+            record = read_conda_record(path)
+        records[name] = {'state': state, 'record': dataclasses.asdict(record)}
+
+    old_dists = cache.get('dists', {})
+    dists = {}
+    for name, (path, state) in dist_states.items():
+        old = old_dists.get(name)
+        if old is not None and old['state'] == state:
+            info = DistInfo(**old['info'])
+        else:
+            info = read_dist_info(path)
+            if info is None:
+                continue
+        dists[name] = {'state': state, 'info': dataclasses.asdict(info)}
+
+    graph = DependencyGraph.from_metadata(
+        records=[CondaRecord(**entry['record']) for entry in records.values()],
+        dists={
+            name: DistInfo(**entry['info']) for name, entry in dists.items()
+        },
+    )
+    write_json(cache_path, {
+        'version': GRAPH_CACHE_VERSION,
+        'fingerprint': fingerprint,
+        'records': records,
+        'dists': dists,
+        'forward': {
+            package: sorted(requirements)
+            for package, requirements in graph.forward.items()
+        },
+    })
+    return graph
+
+
+class CoreAttribution:
+    """
+    Find which core packages pull in each package of a dependency graph.
+
+    A core package uses a package if there is a chain of requirements from
+    the core package down to it where none of the packages in between are
+    core packages themselves.
+
+    This is precomputed once for the whole graph: the non-core packages are
+    condensed into strongly connected components, which are visited in
+    dependency order so that each component's set of core users can be
+    built from the sets of its requirers. The sets are stored as integer
+    bitsets, so the total cost is roughly linear in the size of the graph.
+
+    Parameters
+    ----------
+    reverse : dict of str to set of str
+        Package name to the names of the packages that require it.
+    core_packages : iterable of str
+        The names of the packages to attribute dependencies to.
+    """
+    def __init__(
+        self,
+        reverse: dict[str, set[str]],
+        core_packages: Iterable[str],
+    ):
+        self.reverse = reverse
+        self.core_packages = sorted(set(core_packages))
+        self._core_bits = {
+            name: 1 << num for num, name in enumerate(self.core_packages)
+        }
+        self._bits: dict[str, int] = {}
+        nodes = set(reverse)
+        for requirers in reverse.values():
+            nodes.update(requirers)
+        for node in sorted(nodes):
+            if node not in self._bits and node not in self._core_bits:
+                self._condense(node)
+
+    def _requirers(self, package: str) -> Iterator[str]:
+        """Non-core packages that require package."""
+        for requirer in self.reverse.get(package, ()):
+            if requirer not in self._core_bits:
+                yield requirer
+
+    def _condense(self, root: str) -> None:
+        """Iterative Tarjan's algorithm starting at root."""
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+
+        def visit(node):
+            index[node] = lowlink[node] = len(index)
+            stack.append(node)
+            on_stack.add(node)
+            work.append((node, self._requirers(node)))
+
+        work = []
+        visit(root)
+        while work:
+            node, requirers = work[-1]
+            for requirer in requirers:
+                if requirer in self._bits:
+                    # Finished in an earlier pass
+                    continue
+                if requirer not in index:
+                    visit(requirer)
+                    break
+                if requirer in on_stack:
+                    lowlink[node] = min(lowlink[node], index[requirer])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    self._finish(component)
+
+    def _finish(self, component: set[str]) -> None:
+        """Every requirer outside of the component is already finished."""
+        bits = 0
+        for member in component:
+            for requirer in self.reverse.get(member, ()):
+                if requirer in self._core_bits:
+                    bits |= self._core_bits[requirer]
+                elif requirer not in component:
+                    bits |= self._bits[requirer]
+        for member in component:
+            self._bits[member] = bits
+
+    def first_requirers(self, package: str) -> list[str]:
+        """The packages that directly require package."""
+        return sorted(self.reverse.get(package, ()))
+
+    def core_requirers(self, package: str) -> list[str]:
+        """The core packages that use package, directly or indirectly."""
+        if package in self._core_bits:
+            bits = 0
+            for requirer in self.reverse.get(package, ()):
+                bits |= self._core_bits.get(requirer) or self._bits[requirer]
+        else:
+            bits = self._bits.get(package, 0)
+        return [
+            name for num, name in enumerate(self.core_packages)
+            if bits >> num & 1
+        ]
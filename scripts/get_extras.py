@@ -13,14 +13,23 @@ with the importlib.metadata module.
 """
 from __future__ import annotations
 
+import hashlib
+import json
 import logging
+import os
+import sys
 from argparse import ArgumentParser
 from collections.abc import Iterator
 from dataclasses import dataclass
-from importlib.metadata import PackageNotFoundError, distribution
+from functools import lru_cache
+from importlib.metadata import distributions
 from pathlib import Path
 
-from packaging.requirements import Requirement
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+
+from caching import cache_dir, content_hash, read_json, write_json
+from name_mapping import NameMapping
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +44,68 @@ PYPI_ONLY = ["line_profiler"]
 AVOID = ['python-ldap']
 
 
+@dataclass(frozen=True)
+class InstalledDistribution:
+    # PEP 503 normalized name e.g. pcdsdevices
+    name: str
+    version: str
+    # The extras this distribution defines e.g. doc, test
+    extras: frozenset[str]
+    # Spec strings from importlib.metadata.Distribution.requires
+    requires: tuple[str, ...]
+
+
+class DistributionIndex:
+    """
+    Every installed distribution, found in a single pass over sys.path.
+
+    Each importlib.metadata.distribution call rescans every sys.path entry,
+    which is slow in an environment with thousands of dist-info directories.
+    This index does that scan once so every lookup is a dict lookup.
+
+    Parameters
+    ----------
+    dists : iterable of importlib.metadata.Distribution, optional
+        The distributions to index. Defaults to everything on sys.path.
+    """
+    def __init__(self, dists=None):
+        if dists is None:
+            dists = distributions()
+        self._dists = {}
+        for dist in dists:
+            metadata = dist.metadata
+            name = canonicalize_name(metadata["Name"] or "")
+            if not name or name in self._dists:
+                # Like importlib.metadata, the first one on sys.path wins
+                continue
+            self._dists[name] = InstalledDistribution(
+                name=name,
+                version=metadata["Version"],
+                extras=frozenset(metadata.get_all("Provides-Extra") or []),
+                requires=tuple(dist.requires or []),
+            )
+
+    def get(self, name: str) -> InstalledDistribution | None:
+        """
+        Get an installed distribution by any spelling of its name.
+        """
+        return self._dists.get(canonicalize_name(name))
+
+    def __contains__(self, name: str) -> bool:
+        return canonicalize_name(name) in self._dists
+
+    def __iter__(self) -> Iterator[InstalledDistribution]:
+        return iter(self._dists.values())
+
+
+@lru_cache(maxsize=None)
+def get_distribution_index() -> DistributionIndex:
+    """
+    Get the DistributionIndex for this process, building it the first time.
+    """
+    return DistributionIndex()
+
+
 @dataclass(frozen=True)
 class PackageSpec:
     # Just the install name e.g. pcdsdevices
@@ -81,15 +152,61 @@ class PackageSpec:
             source_extra=source_extra,
         )
 
-    def is_installed(self) -> bool:
+    def is_installed(self, index: DistributionIndex | None = None) -> bool:
         """
         Return True if this package is installed and False otherwise.
+
+        Parameters
+        ----------
+        index : DistributionIndex, optional
+            The installed distributions. Defaults to the ones found by
+            get_distribution_index.
         """
+        if index is None:
+            index = get_distribution_index()
+        return self.name in index
+
+
+def get_extras_path(base: str) -> Path:
+    """
+    Get the install-extras.txt file for a base environment.
+    """
+    return Path(__file__).parent.parent / "envs" / base / "install-extras.txt"
+
+
+def get_pip_packages_path(base: str) -> Path:
+    """
+    Get the pip-packages.txt file for a base environment.
+    """
+    return Path(__file__).parent.parent / "envs" / base / "pip-packages.txt"
+
+
+def get_pip_pinned(base: str) -> set[str]:
+    """
+    Get the normalized names of the packages pinned in pip-packages.txt.
+
+    The build scripts install these with pip right after the conda extras,
+    so they count as installed when picking the extras.
+
+    Parameters
+    ----------
+    base : str
+        The environment name, e.g. pcds.
+    """
+    names = set()
+    try:
+        text = get_pip_packages_path(base).read_text()
+    except FileNotFoundError:
+        return names
+    for line in text.splitlines():
+        line = line.split("#")[0].strip()
+        if not line or line.startswith("-"):
+            continue
         try:
-            distribution(self.name)
-            return True
-        except PackageNotFoundError:
-            return False
+            names.add(canonicalize_name(Requirement(line).name))
+        except InvalidRequirement:
+            logger.warning("Could not parse %s in pip-packages.txt", line)
+    return names
 
 
 def get_packages(base: str) -> Iterator[str]:
@@ -112,12 +229,15 @@ def get_packages(base: str) -> Iterator[str]:
     packages : iterator of str
         The package names that we want to use here.
     """
-    extras_path = Path(__file__).parent.parent / "envs" / base / "install-extras.txt"
-    with extras_path.open("r") as fd:
+    with get_extras_path(base).open("r") as fd:
         return (yield from (line for line in fd.read().splitlines() if line))
 
 
-def get_package_extra_deps(package: str) -> Iterator[PackageSpec]:
+def get_package_extra_deps(
+    package: str,
+    index: DistributionIndex | None = None,
+    extra: str | None = None,
+) -> Iterator[PackageSpec]:
     """
     Given a package name, get all of the dependencies of just the extras.
 
@@ -130,22 +250,38 @@ def get_package_extra_deps(package: str) -> Iterator[PackageSpec]:
     ----------
     package : str
         The name of the package to check
+    index : DistributionIndex, optional
+        The installed distributions. Defaults to the ones found by
+        get_distribution_index.
+    extra : str, optional
+        Only include the dependencies of this one extra, e.g. doc.
+        Defaults to including every extra.
 
     Returns
     -------
     dependencies : iterator of PackageSpec
         All dependencies of the package extras. Uses the pypi names.
     """
-    try:
-        full_reqs = distribution(package).requires
-    except PackageNotFoundError:
+    if index is None:
+        index = get_distribution_index()
+    dist = index.get(package)
+    if dist is None:
         logger.warning("%s is not installed and cannot be checked.", package)
         return set()
-    specs = (PackageSpec.from_importlib_metadata(req) for req in full_reqs)
-    return (yield from (pkg for pkg in specs if pkg.source_extra))
-
-
-def get_env_extra_deps(base: str) -> set[PackageSpec]:
+    specs = (PackageSpec.from_importlib_metadata(req) for req in dist.requires)
+    if extra is None:
+        return (yield from (pkg for pkg in specs if pkg.source_extra))
+    extra = canonicalize_name(extra)
+    return (yield from (
+        pkg for pkg in specs
+        if pkg.source_extra and canonicalize_name(pkg.source_extra) == extra
+    ))
+
+
+def get_env_extra_deps(
+    base: str,
+    index: DistributionIndex | None = None,
+) -> set[PackageSpec]:
     """
     Given a base environment, get all of the extras to include.
 
@@ -155,6 +291,9 @@ def get_env_extra_deps(base: str) -> set[PackageSpec]:
     ----------
     base : str
         The environment name, e.g. pcds.
+    index : DistributionIndex, optional
+        The installed distributions. Defaults to the ones found by
+        get_distribution_index.
 
     Returns
     -------
@@ -163,11 +302,64 @@ def get_env_extra_deps(base: str) -> set[PackageSpec]:
     """
     deps = set()
     for package_name in get_packages(base=base):
-        deps.update(get_package_extra_deps(package=package_name))
+        deps.update(get_package_extra_deps(package=package_name, index=index))
+    return deps
+
+
+def get_env_extra_deps_closure(
+    base: str,
+    index: DistributionIndex | None = None,
+) -> set[PackageSpec]:
+    """
+    Given a base environment, get all of the extras to include, transitively.
+
+    This starts from get_env_extra_deps. Whenever one of the dependencies
+    asks for an extra of its own, e.g. ophyd[sim], the dependencies of that
+    extra are included too, and so on until nothing new turns up.
+
+    An extra can only be expanded if the package that defines it is already
+    installed, because that is where the extra is described.
+
+    Parameters
+    ----------
+    base : str
+        The environment name, e.g. pcds.
+    index : DistributionIndex, optional
+        The installed distributions. Defaults to the ones found by
+        get_distribution_index.
+
+    Returns
+    -------
+    dependencies : set of PackageSpec
+        All pypi depenencies of the package extras and of their extras.
+    """
+    if index is None:
+        index = get_distribution_index()
+    deps = get_env_extra_deps(base=base, index=index)
+    todo = [dep for dep in deps if dep.spec_extra]
+    expanded = set()
+    while todo:
+        dep = todo.pop()
+        key = (canonicalize_name(dep.name), canonicalize_name(dep.spec_extra))
+        if key in expanded or not dep.is_installed(index):
+            continue
+        expanded.add(key)
+        for new_dep in get_package_extra_deps(
+            package=dep.name,
+            index=index,
+            extra=dep.spec_extra,
+        ):
+            if new_dep not in deps:
+                deps.add(new_dep)
+                if new_dep.spec_extra:
+                    todo.append(new_dep)
     return deps
 
 
-def get_missing_dependencies(all_deps: Iterator[PackageSpec]) -> Iterator[PackageSpec]:
+def get_missing_dependencies(
+    all_deps: Iterator[PackageSpec],
+    index: DistributionIndex | None = None,
+) -> Iterator[PackageSpec]:
     """
     Return a reduced set of dependencies: only the ones that are not installed
 
@@ -175,16 +367,172 @@ def get_missing_dependencies(all_deps: Iterator[PackageSpec]) -> Iterator[Packag
     ----------
     all_deps : set of str
         All dependencies to consider.
+    index : DistributionIndex, optional
+        The installed distributions. Defaults to the ones found by
+        get_distribution_index.
 
     Returns
     -------
     missing_deps : set of PackageSpec
         A new set that only includes the dependencies that are not installed.
     """
-    return (yield from (dep for dep in all_deps if not dep.is_installed()))
+    return (yield from (dep for dep in all_deps if not dep.is_installed(index)))
+
+
+def installed_fingerprint(base: str) -> str:
+    """
+    Get a hash that changes whenever the extras lists could change.
+
+    This covers the install-extras.txt and pip-packages.txt files, the
+    special package lists in this module, and the name and mtime of every dist-info and egg-info
+    directory on sys.path. The names include the versions, so this is cheap
+    to compute and does not need to read any metadata.
+
+    Parameters
+    ----------
+    base : str
+        The environment name, e.g. pcds.
+    """
+    installed = []
+    for path in sys.path:
+        try:
+            entries = list(os.scandir(path or "."))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith((".dist-info", ".egg-info")):
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+                installed.append((path, entry.name, mtime))
+    return hashlib.sha256(json.dumps([
+        content_hash(get_extras_path(base)),
+        content_hash(get_pip_packages_path(base)),
+        CONDA_ONLY,
+        PYPI_ONLY,
+        AVOID,
+        sorted(installed),
+    ]).encode()).hexdigest()
+
+
+def get_name_mapping(base: str) -> NameMapping:
+    """
+    Get the pypi to conda name mapping to use when building an environment.
+
+    This is the mapping saved from earlier builds of this base environment,
+    updated with the names in the active environment and saved again. Since
+    the missing extras are not installed yet, the earlier builds are the
+    only place to learn their conda names.
+
+    Parameters
+    ----------
+    base : str
+        The environment name, e.g. pcds.
+    """
+    path = cache_dir("name_mapping") / f"{base}.json"
+    mapping = NameMapping.load(path)
+    mapping.update(NameMapping.from_prefix())
+    mapping.save(path)
+    return mapping
+
+
+def resolve_extras(
+    base: str,
+    index: DistributionIndex | None = None,
+    use_cache: bool = True,
+) -> dict[str, list[str]]:
+    """
+    Get the missing extras for both conda and pypi in one pass.
+
+    This runs before the conda extras are installed, and both lists are
+    written from what it finds. Each missing extra goes to exactly one of
+    the lists: conda gets it unless it is in PYPI_ONLY or was last seen
+    installed by pip, and pip gets the rest, so pip never installs what
+    conda is about to. The conda specs use the conda names from
+    get_name_mapping. Packages pinned in pip-packages.txt count as
+    installed, since the build installs them before the pip extras.
+
+    The extras of a package can only be read once it is installed, so a
+    package in install-extras.txt that only pip-packages.txt installs does
+    not add any extras here.
+
+    The result is cached using installed_fingerprint, so running this again
+    in an unchanged environment does not need to read any metadata.
 
+    Parameters
+    ----------
+    base : str
+        The environment name, e.g. pcds.
+    index : DistributionIndex, optional
+        The installed distributions. Defaults to the ones found by
+        get_distribution_index.
+    use_cache : bool, optional
+        If False, always resolve the extras from scratch.
 
-def main(base: str, for_pypi: bool) -> int:
+    Returns
+    -------
+    extras : dict of str to list of str
+        The sorted specs to install. The "conda" key has just the names and
+        the "pip" key has the names with their extras, e.g. pcdsdevices[doc].
+    """
+    cache_path = None
+    if use_cache:
+        cache_path = cache_dir("extras") / f"{base}.json"
+        fingerprint = installed_fingerprint(base)
+        cached = read_json(cache_path)
+        if isinstance(cached, dict) and cached.get("fingerprint") == fingerprint:
+            logger.debug("Using cached extras from %s", cache_path)
+            return cached["extras"]
+    if index is None:
+        index = get_distribution_index()
+    mapping = get_name_mapping(base)
+    all_deps = get_env_extra_deps_closure(base=base, index=index)
+    pinned = get_pip_pinned(base)
+    missing_deps = [
+        dep for dep in get_missing_dependencies(all_deps=all_deps, index=index)
+        if canonicalize_name(dep.name) not in pinned
+    ]
+    conda_deps = [
+        dep for dep in missing_deps
+        if dep.name not in PYPI_ONLY + AVOID and not mapping.is_pip_only(dep.name)
+    ]
+    for_conda = {canonicalize_name(dep.name) for dep in conda_deps}
+    extras = {
+        "conda": sorted(set(mapping.pypi_to_conda(dep.name) for dep in conda_deps)),
+        "pip": sorted(set(
+            dep.name_with_extra for dep in missing_deps
+            if dep.name not in CONDA_ONLY + AVOID
+            and canonicalize_name(dep.name) not in for_conda
+        )),
+    }
+    if cache_path is not None:
+        write_json(cache_path, {"fingerprint": fingerprint, "extras": extras})
+    return extras
+
+
+def write_extras(extras: dict[str, list[str]], output_dir: Path) -> None:
+    """
+    Write extras_conda.txt and extras_pip.txt to a directory.
+
+    Parameters
+    ----------
+    extras : dict of str to list of str
+        The output of resolve_extras.
+    output_dir : Path
+        Where to write the files, e.g. envs/pcds.
+    """
+    for key in ("conda", "pip"):
+        with (Path(output_dir) / f"extras_{key}.txt").open("w") as fd:
+            fd.write("".join(f"{spec}\n" for spec in extras[key]))
+
+
+def main(
+    base: str,
+    for_pypi: bool,
+    output_dir: Path | None = None,
+    use_cache: bool = True,
+) -> int:
     """
     Get all missing extras dependencies in the current env and send them to stdout.
 
@@ -195,14 +543,21 @@ def main(base: str, for_pypi: bool) -> int:
 
     for_pypi : bool
         Whether or not to include the pypi extras string
+
+    output_dir : Path, optional
+        If provided, write both extras_conda.txt and extras_pip.txt here
+        instead of printing one of the lists to stdout.
+
+    use_cache : bool, optional
+        If False, ignore any cached result from a previous run.
     """
-    all_deps = get_env_extra_deps(base=base)
-    missing_deps = get_missing_dependencies(all_deps=all_deps)
-    if for_pypi:
-        pkg_to_print = set(dep.name_with_extra for dep in missing_deps if dep.name not in CONDA_ONLY + AVOID)
+    extras = resolve_extras(base=base, use_cache=use_cache)
+    if output_dir is not None:
+        write_extras(extras=extras, output_dir=output_dir)
+    elif for_pypi:
+        print("\n".join(extras["pip"]))
     else:
-        pkg_to_print = set(dep.name for dep in missing_deps if dep.name not in PYPI_ONLY + AVOID)
-    print("\n".join(sorted(list(pkg_to_print))))
+        print("\n".join(extras["conda"]))
     return 0
 
 
@@ -230,9 +585,29 @@ if __name__ == "__main__":
             "from pypi but not when installing from conda."
         )
     )
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        help=(
+            "Write both extras_conda.txt and extras_pip.txt to this "
+            "directory instead of printing to stdout. Run this before the "
+            "conda extras install: the pip list leaves out what the conda "
+            "list and pip-packages.txt will install."
+        )
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Resolve the extras from scratch even if a cached result matches.",
+    )
     args = parser.parse_args()
     try:
-        exit(main(base=args.base, for_pypi=args.for_pypi))
+        exit(main(
+            base=args.base,
+            for_pypi=args.for_pypi,
+            output_dir=args.output_dir,
+            use_cache=not args.no_cache,
+        ))
     except Exception as exc:
         if args.verbose:
             raise
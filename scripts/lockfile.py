@@ -0,0 +1,353 @@
+"""
+Read the exact package pins out of an exported env.yaml lockfile.
+
+The env.yaml files are written by conda env export, so they have a very
+regular layout: one "name=version=build" line per conda package and a pip
+subsection with one "name==version" line per pypi package. Packages
+installed from git are listed by url, and git-packages.txt tells us which
+package each url belongs to.
+
+A Lockfile keeps the original lines of the file next to a name index of
+the pins, so that every script can look up, replace, and write back pins
+without scanning the raw lines again. Revisions of these files can be read
+straight from git objects using GitObjectReader, which keeps a single git
+cat-file process open.
+"""
+from __future__ import annotations
+
+import subprocess
+import sys
+from collections.abc import Iterator, Mapping
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass(frozen=True, slots=True)
+class LockEntry:
+    name: str
+    version: str
+    # Conda build string, empty for pip packages
+    build: str = ''
+    # Either conda or pip
+    source: str = 'conda'
+
+
+def read_git_packages(path: Path) -> dict[str, str]:
+    """
+    Map git install urls to package names using a git-packages.txt file.
+
+    The urls are stored without the "@ref" part so that older revisions of
+    the env.yaml, which pin other refs, map to the same package names.
+
+    Parameters
+    ----------
+    path : Path
+        The git-packages.txt file, which has lines like
+        "pmpsui git+https://github.com/pcdshub/pmps-ui.git@v2.0.0".
+    """
+    try:
+        with open(path, 'r') as fd:
+            lines = fd.read().splitlines()
+    except FileNotFoundError:
+        return {}
+    git_names = {}
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            name, spec = line.split()
+            git_names[spec.rpartition('@')[0]] = name
+    return git_names
+
+
+def parse_git_spec(
+    spec: str,
+    git_names: dict[str, str] | None = None,
+) -> LockEntry:
+    """
+    Make an entry from a pip git url like git+https://host/org/repo.git@v1.0.0
+    """
+    url, _, ref = spec.rpartition('@')
+    try:
+        name = git_names[url]
+    except (KeyError, TypeError):
+        name = url.rstrip('/').split('/')[-1].removesuffix('.git')
+    if ref[:1] == 'v' and ref[1:2].isdigit():
+        ref = ref[1:]
+    return LockEntry(name=sys.intern(name), version=ref, source='pip')
+
+
+def parse_spec_line(
+    spec: str,
+    pip: bool,
+    git_names: dict[str, str] | None = None,
+) -> LockEntry:
+    """
+    Parse the text after the "- " in a single env.yaml dependency line.
+
+    Parameters
+    ----------
+    spec : str
+        e.g. "numpy=1.26.4=py312heda63a1_0" or "tenacity==9.1.2"
+    pip : bool
+        True if this line is in the pip subsection.
+    git_names : dict of str to str, optional
+        Package names for git install specs, see read_git_packages.
+    """
+    if pip:
+        if spec.startswith('git+'):
+            return parse_git_spec(spec, git_names)
+        name, _, version = spec.partition('==')
+        return LockEntry(
+            name=sys.intern(name),
+            version=sys.intern(version),
+            source='pip',
+        )
+    name, version, build = (spec.split('=') + ['', ''])[:3]
+    # Many entries and snapshots share versions and builds like pyhd8ed1ab_0
+    return LockEntry(
+        name=sys.intern(name),
+        version=sys.intern(version),
+        build=sys.intern(build),
+    )
+
+
+def iter_spec_lines(lines: list[str]) -> Iterator[tuple[int, bool, str]]:
+    """
+    Find the package pins in the lines of an env.yaml file.
+
+    Yields
+    ------
+    line_number : int
+        The index of the line in lines.
+    pip : bool
+        True if this line is in the pip subsection.
+    spec : str
+        The text after the "- " on this line.
+    """
+    in_deps = False
+    pip_indent = None
+    for line_number, line in enumerate(lines):
+        stripped = line.lstrip()
+        indent = len(line) - len(stripped)
+        if not line.startswith((' ', '-')):
+            in_deps = line.startswith('dependencies:')
+            pip_indent = None
+            continue
+        if not in_deps or not stripped.startswith('- '):
+            continue
+        spec = stripped[2:].strip()
+        if spec == 'pip:':
+            pip_indent = indent
+            continue
+        if pip_indent is not None and indent <= pip_indent:
+            pip_indent = None
+        yield line_number, pip_indent is not None, spec
+
+
+class Lockfile(Mapping):
+    """
+    The lines of an env.yaml file plus an index of its pins by package name.
+
+    This is a read-only mapping of package name to LockEntry, except for
+    replace_spec, which rewrites a single pin in place. str() gives back the
+    file text, so an unmodified Lockfile round-trips exactly. If a name
+    is pinned twice, e.g. in both the conda and pip sections, the later pin
+    is the one that is indexed.
+
+    Parameters
+    ----------
+    text : str
+        The contents of an env.yaml file.
+    git_names : dict of str to str, optional
+        Package names for git install specs, see read_git_packages.
+    """
+    __slots__ = ('lines', 'git_names', '_entries', '_line_numbers', '_newline')
+
+    def __init__(self, text: str, git_names: dict[str, str] | None = None):
+        self.lines = text.splitlines()
+        self.git_names = git_names
+        self._newline = text.endswith('\n')
+        self._entries: dict[str, LockEntry] = {}
+        self._line_numbers: dict[str, int] = {}
+        for line_number, pip, spec in iter_spec_lines(self.lines):
+            self._add(parse_spec_line(spec, pip, git_names), line_number)
+
+    @classmethod
+    def from_path(
+        cls,
+        path: Path,
+        git_names: dict[str, str] | None = None,
+    ) -> Lockfile:
+        with open(path, 'r') as fd:
+            return cls(fd.read(), git_names)
+
+    def _add(self, entry: LockEntry, line_number: int) -> None:
+        self._entries[entry.name] = entry
+        self._line_numbers[entry.name] = line_number
+
+    def __getitem__(self, name: str) -> LockEntry:
+        return self._entries[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __str__(self) -> str:
+        return '\n'.join(self.lines) + ('\n' if self._newline else '')
+
+    def replace_spec(self, name: str, spec: str) -> LockEntry:
+        """
+        Replace the pin for a package, keeping its place in the file.
+
+        Parameters
+        ----------
+        name : str
+            The package to replace.
+        spec : str
+            The new text to put after the "- ", in the same format as the
+            line it replaces, e.g. a git+https url in the pip section.
+
+        Returns
+        -------
+        entry : LockEntry
+            The parsed new pin.
+        """
+        old_entry = self._entries.pop(name)
+        line_number = self._line_numbers.pop(name)
+        line = self.lines[line_number]
+        indent = line[:len(line) - len(line.lstrip())]
+        self.lines[line_number] = f'{indent}- {spec}'
+        entry = parse_spec_line(spec, old_entry.source == 'pip', self.git_names)
+        self._add(entry, line_number)
+        return entry
+
+    def write(self, path: Path) -> None:
+        with open(path, 'w') as fd:
+            fd.write(str(self))
+
+
+def parse_env_yaml(
+    text: str,
+    git_names: dict[str, str] | None = None,
+) -> Lockfile:
+    """
+    Get every package pin from the text of an env.yaml file.
+
+    Parameters
+    ----------
+    text : str
+        The contents of an env.yaml file.
+    git_names : dict of str to str, optional
+        Package names for git install specs, see read_git_packages.
+
+    Returns
+    -------
+    entries : Lockfile
+        The pins, keyed by package name.
+    """
+    return Lockfile(text, git_names)
+
+
+def diff_lockfiles(
+    old: Mapping[str, LockEntry],
+    new: Mapping[str, LockEntry],
+) -> dict[str, tuple[LockEntry | None, LockEntry | None]]:
+    """
+    Find every package that was added, removed, updated, or rebuilt.
+
+    Returns
+    -------
+    changes : dict of str to tuple
+        Package name to the (old, new) entries. The old entry is None for
+        added packages and the new entry is None for removed packages.
+    """
+    changes = {}
+    for name in sorted(old.keys() | new.keys()):
+        old_entry = old.get(name)
+        new_entry = new.get(name)
+        if old_entry is None or new_entry is None or (
+            (old_entry.version, old_entry.build)
+            != (new_entry.version, new_entry.build)
+        ):
+            changes[name] = (old_entry, new_entry)
+    return changes
+
+
+class GitObjectReader:
+    """
+    Read files at many git revisions through one git cat-file process.
+
+    Use as a context manager, or call close when done.
+
+    Parameters
+    ----------
+    cwd : Path, optional
+        Any directory inside the git repository. Defaults to the current
+        working directory.
+    """
+    def __init__(self, cwd: Path | None = None):
+        self.toplevel = Path(subprocess.check_output(
+            ['git', 'rev-parse', '--show-toplevel'],
+            cwd=cwd,
+            universal_newlines=True,
+        ).strip())
+        self._proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            cwd=self.toplevel,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def read(self, reference: str, path: Path) -> bytes | None:
+        """
+        Get the contents of path at a git reference.
+
+        Parameters
+        ----------
+        reference : str
+            Any git revision, e.g. master, origin/master, or a tag.
+        path : Path
+            A path to a file in the working tree of this repository.
+
+        Returns
+        -------
+        contents : bytes or None
+            The file contents, or None if the file does not exist at that
+            reference.
+        """
+        rel_path = Path(path).resolve().relative_to(self.toplevel).as_posix()
+        self._proc.stdin.write(f'{reference}:{rel_path}\n'.encode())
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().decode().split()
+        if len(header) != 3:
+            # e.g. "master:envs/pcds/env.yaml missing"
+            return None
+        contents = self._proc.stdout.read(int(header[2]))
+        # Each object is followed by a newline
+        self._proc.stdout.read(1)
+        return contents
+
+    def read_lockfile(
+        self,
+        reference: str,
+        path: Path,
+        git_names: dict[str, str] | None = None,
+    ) -> Lockfile:
+        """Parse an env.yaml at a git reference, see parse_env_yaml."""
+        contents = self.read(reference, path)
+        if contents is None:
+            raise RuntimeError(f'Did not find {path} at git reference {reference}')
+        return parse_env_yaml(contents.decode(), git_names)
+
+    def close(self) -> None:
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+
+    def __enter__(self) -> GitObjectReader:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,170 @@
+"""
+Translate between pypi distribution names and conda package names.
+
+Most python packages have the same name on pypi and conda-forge, but many
+do not, e.g. the pypi distribution "tables" is the conda package
+"pytables". The installed prefix already knows the answer: each conda-meta
+record lists the files it installed, which includes the dist-info
+directory of the python distribution inside it. Any dist-info directory
+that no conda package owns was installed by pip.
+
+The mapping can be saved as a small json file so that knowledge from one
+environment build can be used by the next, before the packages are
+installed there.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+
+from packaging.utils import canonicalize_name
+
+from caching import read_json, write_json
+from conda_meta import (CondaRecord, default_prefix, iter_conda_meta_paths,
+                        iter_dist_info_paths, read_conda_record)
+
+# Bump this if the saved file format changes
+NAME_MAPPING_VERSION = 1
+
+
+def dist_info_name(dirname: str) -> str:
+    """
+    Get the normalized distribution name from a dist-info directory name.
+
+    For example, "line_profiler-4.1.3.dist-info" becomes "line-profiler".
+    """
+    return canonicalize_name(dirname.removesuffix('.dist-info').rpartition('-')[0])
+
+
+class NameMapping:
+    """
+    Two-way lookup table between pypi and conda names.
+
+    Parameters
+    ----------
+    pypi_to_conda : dict of str to str, optional
+        Normalized pypi name to the conda package that installs it.
+    pip_only : iterable of str, optional
+        Normalized pypi names that were installed without a conda package.
+    """
+    __slots__ = ('_pypi_to_conda', '_conda_to_pypi', '_pip_only')
+
+    def __init__(
+        self,
+        pypi_to_conda: dict[str, str] | None = None,
+        pip_only: Iterable[str] = (),
+    ):
+        self._pypi_to_conda: dict[str, str] = {}
+        self._conda_to_pypi: dict[str, str] = {}
+        self._pip_only: set[str] = set()
+        self.update(pypi_to_conda or {}, pip_only)
+
+    @classmethod
+    def from_metadata(
+        cls,
+        records: Iterable[CondaRecord],
+        dist_names: Mapping[str, str],
+    ) -> NameMapping:
+        """
+        Build the mapping from already-parsed metadata.
+
+        Parameters
+        ----------
+        records : iterable of CondaRecord
+            The conda packages in the environment.
+        dist_names : dict of str to str
+            The normalized distribution name of every dist-info directory in
+            the environment, keyed by directory name.
+        """
+        pypi_to_conda = {}
+        for record in records:
+            for dirname in record.dist_infos:
+                try:
+                    pypi_to_conda[dist_names[dirname]] = record.name
+                except KeyError:
+                    continue
+        pip_only = set(dist_names.values()) - pypi_to_conda.keys()
+        return cls(pypi_to_conda, pip_only)
+
+    @classmethod
+    def from_prefix(cls, prefix: Path | None = None) -> NameMapping:
+        """
+        Build the mapping for an installed environment.
+
+        Only file names are used for the dist-info directories, so no
+        METADATA files need to be read.
+
+        Parameters
+        ----------
+        prefix : Path, optional
+            The conda environment to inspect. Defaults to the active one.
+        """
+        if prefix is None:
+            prefix = default_prefix()
+        records = [read_conda_record(path) for path in iter_conda_meta_paths(prefix)]
+        dist_names = {
+            path.name: dist_info_name(path.name)
+            for path in iter_dist_info_paths(prefix)
+        }
+        return cls.from_metadata(records, dist_names)
+
+    @classmethod
+    def load(cls, path: Path) -> NameMapping:
+        """Read a saved mapping, or get an empty one if there is none."""
+        data = read_json(path)
+        if not isinstance(data, dict) or data.get('version') != NAME_MAPPING_VERSION:
+            return cls()
+        return cls(data['pypi_to_conda'], data['pip_only'])
+
+    def save(self, path: Path) -> None:
+        write_json(path, {
+            'version': NAME_MAPPING_VERSION,
+            'pypi_to_conda': dict(sorted(self._pypi_to_conda.items())),
+            'pip_only': sorted(self._pip_only),
+        })
+
+    def update(
+        self,
+        pypi_to_conda: Mapping[str, str] | NameMapping,
+        pip_only: Iterable[str] = (),
+    ) -> None:
+        """
+        Add new names, replacing any older answers for the same names.
+
+        Parameters
+        ----------
+        pypi_to_conda : dict of str to str or NameMapping
+            The new pypi to conda names, or another mapping to merge in
+            whole, in which case pip_only is taken from it too.
+        pip_only : iterable of str, optional
+            New pypi names that were installed without a conda package.
+        """
+        if isinstance(pypi_to_conda, NameMapping):
+            pip_only = pypi_to_conda._pip_only
+            pypi_to_conda = pypi_to_conda._pypi_to_conda
+        for pypi_name, conda_name in pypi_to_conda.items():
+            pypi_name = canonicalize_name(pypi_name)
+            self._pypi_to_conda[pypi_name] = conda_name
+            self._conda_to_pypi[conda_name] = pypi_name
+            self._pip_only.discard(pypi_name)
+        for pypi_name in pip_only:
+            pypi_name = canonicalize_name(pypi_name)
+            old_conda = self._pypi_to_conda.pop(pypi_name, None)
+            if self._conda_to_pypi.get(old_conda) == pypi_name:
+                del self._conda_to_pypi[old_conda]
+            self._pip_only.add(pypi_name)
+
+    def pypi_to_conda(self, name: str) -> str:
+        """The conda name for a pypi name, or the name itself if unknown."""
+        return self._pypi_to_conda.get(canonicalize_name(name), name)
+
+    def conda_to_pypi(self, name: str) -> str:
+        """The pypi name for a conda name, or the name itself if unknown."""
+        return self._conda_to_pypi.get(name, name)
+
+    def is_pip_only(self, name: str) -> bool:
+        """True if this pypi name was seen installed without conda."""
+        return canonicalize_name(name) in self._pip_only
+
+    def __len__(self) -> int:
+        return len(self._pypi_to_conda) + len(self._pip_only)
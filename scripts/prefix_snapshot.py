@@ -0,0 +1,251 @@
+"""
+Take a quick snapshot of the package versions installed in a conda prefix.
+
+conda list has a slow startup, but the same information is on disk: every
+conda package leaves a conda-meta/name-version-build.json record, and every
+package installed by pip leaves a dist-info directory with "pip" in its
+INSTALLER file. By default only these file names are read, which takes a
+few milliseconds even for a large environment. The full mode reads the
+conda-meta records themselves, in parallel, which is slower but does not
+rely on the file names.
+
+The snapshot can be compared with an env.yaml to find drift, e.g. on a
+deploy host to check that an unpacked environment matches its release:
+
+    python prefix_snapshot.py --prefix /path/to/pcds-6.0.0 --base pcds
+"""
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import json
+import sys
+from collections.abc import Mapping
+from pathlib import Path
+
+from packaging.utils import canonicalize_name
+
+from conda_meta import (default_prefix, iter_conda_meta_paths,
+                        iter_dist_info_paths, read_conda_record)
+from lockfile import LockEntry, Lockfile, diff_lockfiles, read_git_packages
+
+WORKERS = 8
+ENVS_DIR = Path(__file__).resolve().parent.parent / 'envs'
+
+
+def parse_meta_filename(filename: str) -> LockEntry:
+    """
+    Make an entry from a conda-meta file name.
+
+    For example, "numpy-1.26.4-py312heda63a1_0.json" has the name numpy,
+    the version 1.26.4, and the build py312heda63a1_0. Neither versions nor
+    builds may contain a "-", so the last two are always the separators.
+    """
+    name, version, build = filename.removesuffix('.json').rsplit('-', 2)
+    return LockEntry(
+        name=sys.intern(name),
+        version=sys.intern(version),
+        build=sys.intern(build),
+    )
+
+
+def _pip_installed(dist_info: Path) -> bool:
+    try:
+        with open(dist_info / 'INSTALLER', 'r') as fd:
+            return fd.read().strip() != 'conda'
+    except OSError:
+        return False
+
+
+def snapshot_prefix(
+    prefix: Path | None = None,
+    full: bool = False,
+    workers: int = WORKERS,
+) -> dict[str, LockEntry]:
+    """
+    Get every package installed in a prefix.
+
+    Parameters
+    ----------
+    prefix : Path, optional
+        The conda environment to inspect. Defaults to the active one.
+    full : bool, optional
+        If True, read the conda-meta records instead of trusting their
+        file names, and use their file lists to tell which python
+        distributions were installed by pip.
+    workers : int, optional
+        How many conda-meta records to read at the same time in full mode.
+
+    Returns
+    -------
+    snapshot : dict of str to LockEntry
+        Package name to its installed version. Packages installed by pip use
+        the normalized pypi name and replace any conda package of the same
+        name, like in an env.yaml.
+    """
+    if prefix is None:
+        prefix = default_prefix()
+    snapshot = {}
+    owned = set()
+    meta_paths = list(iter_conda_meta_paths(prefix))
+    if full:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for record in pool.map(read_conda_record, meta_paths):
+                snapshot[record.name] = LockEntry(
+                    name=record.name,
+                    version=record.version,
+                    build=record.build,
+                )
+                owned.update(record.dist_infos)
+    else:
+        for path in meta_paths:
+            entry = parse_meta_filename(path.name)
+            snapshot[entry.name] = entry
+    for path in iter_dist_info_paths(prefix):
+        if full:
+            pip_installed = path.name not in owned
+        else:
+            pip_installed = _pip_installed(path)
+        if not pip_installed:
+            continue
+        name, _, version = path.name.removesuffix('.dist-info').rpartition('-')
+        name = canonicalize_name(name)
+        snapshot[name] = LockEntry(name=name, version=version, source='pip')
+    return snapshot
+
+
+def lockfile_entries(lockfile: Mapping[str, LockEntry]) -> dict[str, LockEntry]:
+    """Key the pins of a lockfile the same way as snapshot_prefix."""
+    entries = {}
+    for entry in lockfile.values():
+        if entry.source == 'pip':
+            entries[canonicalize_name(entry.name)] = entry
+        else:
+            entries.setdefault(entry.name, entry)
+    return entries
+
+
+def find_drift(
+    lockfile: Mapping[str, LockEntry],
+    snapshot: Mapping[str, LockEntry],
+) -> dict[str, tuple[LockEntry | None, LockEntry | None]]:
+    """
+    Find every difference between a lockfile and an installed snapshot.
+
+    Returns
+    -------
+    drift : dict of str to tuple
+        Package name to the (expected, installed) entries. The expected
+        entry is None for extra packages and the installed entry is None for
+        missing packages.
+    """
+    return diff_lockfiles(lockfile_entries(lockfile), snapshot)
+
+
+def _describe(entry: LockEntry | None) -> str:
+    if entry is None:
+        return '(none)'
+    if entry.source == 'pip':
+        return f'{entry.version} (pip)'
+    return f'{entry.version} {entry.build}'
+
+
+def print_drift(drift: dict[str, tuple[LockEntry | None, LockEntry | None]]):
+    if not drift:
+        print('Environment matches the lockfile.')
+        return
+    width = max(len(name) for name in drift)
+    print(f'{"package":<{width}}  expected -> installed')
+    for name, (expected, installed) in drift.items():
+        print(f'{name:<{width}}  {_describe(expected)} -> {_describe(installed)}')
+    print(f'{len(drift)} packages differ from the lockfile.')
+
+
+def main(
+    prefix: Path | None,
+    lockfile_path: Path | None,
+    full: bool,
+    workers: int,
+    as_json: bool,
+) -> int:
+    snapshot = snapshot_prefix(prefix=prefix, full=full, workers=workers)
+    if lockfile_path is None:
+        if as_json:
+            print(json.dumps({
+                name: [entry.version, entry.build, entry.source]
+                for name, entry in sorted(snapshot.items())
+            }, indent=2))
+        else:
+            for name, entry in sorted(snapshot.items()):
+                print(name, _describe(entry))
+        return 0
+    lockfile = Lockfile.from_path(
+        lockfile_path,
+        git_names=read_git_packages(lockfile_path.parent / 'git-packages.txt'),
+    )
+    drift = find_drift(lockfile, snapshot)
+    if as_json:
+        print(json.dumps({
+            name: [
+                None if entry is None else [entry.version, entry.build, entry.source]
+                for entry in entries
+            ]
+            for name, entries in drift.items()
+        }, indent=2))
+    else:
+        print_drift(drift)
+    return 1 if drift else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'List the packages installed in a conda prefix, or compare them '
+            'with an env.yaml.'
+        ),
+    )
+    parser.add_argument(
+        '--prefix',
+        type=Path,
+        help='The environment to inspect. Defaults to the active one.',
+    )
+    lock_group = parser.add_mutually_exclusive_group()
+    lock_group.add_argument(
+        '--lockfile',
+        type=Path,
+        help=(
+            'Report the differences from this env.yaml. Exits with 1 if '
+            'there are any.'
+        ),
+    )
+    lock_group.add_argument(
+        '--base',
+        help='Like --lockfile, using the env.yaml for this base env e.g. pcds.',
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Read the conda-meta records instead of only their file names.',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=WORKERS,
+        help='How many conda-meta records to read at once with --full.',
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print json instead of text.',
+    )
+    args = parser.parse_args()
+    lockfile_path = args.lockfile
+    if args.base is not None:
+        lockfile_path = ENVS_DIR / args.base / 'env.yaml'
+    sys.exit(main(
+        prefix=args.prefix,
+        lockfile_path=lockfile_path,
+        full=args.full,
+        workers=args.workers,
+        as_json=args.json,
+    ))
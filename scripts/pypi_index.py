@@ -0,0 +1,136 @@
+"""
+Client for the pypi simple index that keeps its responses on disk.
+
+Project pages are requested in the PEP 691 json format, with html as a
+fallback for simple servers that do not support it. Each response is
+cached with its ETag and Last-Modified headers, so repeat lookups are
+conditional requests that usually come back as "304 Not Modified".
+"""
+from __future__ import annotations
+
+import re
+from pathlib import Path
+
+import requests
+from packaging.utils import (InvalidSdistFilename, InvalidWheelFilename,
+                             canonicalize_name, parse_sdist_filename,
+                             parse_wheel_filename)
+from packaging.version import InvalidVersion, Version
+
+from caching import cache_dir, read_json, write_json
+
+PYPI_SIMPLE = 'https://pypi.org/simple'
+JSON_ACCEPT = (
+    'application/vnd.pypi.simple.v1+json, '
+    'application/vnd.pypi.simple.v1+html;q=0.2, '
+    'text/html;q=0.1'
+)
+html_link_re = re.compile(r'<a([^>]*)>([^<]+)</a>')
+
+
+def filename_version(filename: str) -> Version | None:
+    """Get the version from a wheel or sdist filename, if it is one."""
+    try:
+        if filename.endswith('.whl'):
+            return parse_wheel_filename(filename)[1]
+        return parse_sdist_filename(filename)[1]
+    except (InvalidWheelFilename, InvalidSdistFilename, InvalidVersion):
+        return None
+
+
+class PyPIIndex:
+    """
+    Look up the released versions of projects on a pypi simple index.
+
+    Parameters
+    ----------
+    index_url : str, optional
+        The simple index to use. Defaults to pypi.org.
+    session : requests.Session, optional
+        The session to make requests with, e.g. a shared pooled session.
+    cache_path : Path, optional
+        Where to keep the cached project pages. Defaults to a directory in
+        the pcds-envs cache that is unique to the index_url.
+    offline : bool, optional
+        If True, only use the cached project pages.
+    """
+    def __init__(
+        self,
+        index_url: str = PYPI_SIMPLE,
+        session: requests.Session | None = None,
+        cache_path: Path | None = None,
+        offline: bool = False,
+    ):
+        self.index_url = index_url.rstrip('/')
+        self.session = session or requests.Session()
+        if cache_path is None:
+            host = re.sub(r'[^\w.-]+', '_', self.index_url.split('://')[-1])
+            cache_path = cache_dir('pypi', host)
+        self.cache_path = Path(cache_path)
+        self.offline = offline
+
+    def filenames(self, project: str) -> list[str]:
+        """
+        Get the names of every non-yanked file in a project.
+
+        Raises
+        ------
+        RuntimeError
+            If the project is not on the index, or if we are offline and it
+            is not cached.
+        """
+        name = canonicalize_name(project)
+        path = self.cache_path / f'{name}.json'
+        cached = read_json(path)
+        if self.offline:
+            if cached is None:
+                raise RuntimeError(f'{project} is not in the offline pypi cache.')
+            return cached['filenames']
+        headers = {'Accept': JSON_ACCEPT}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        response = self.session.get(f'{self.index_url}/{name}/', headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached['filenames']
+        if response.status_code == 404:
+            raise RuntimeError(f'{project} not found on pypi.')
+        response.raise_for_status()
+        if 'json' in response.headers.get('Content-Type', ''):
+            filenames = [
+                info['filename'] for info in response.json()['files']
+                if not info.get('yanked')
+            ]
+        else:
+            # PEP 592 marks yanked files with a data-yanked attribute
+            filenames = [
+                filename for attrs, filename in html_link_re.findall(response.text)
+                if 'data-yanked' not in attrs
+            ]
+        write_json(path, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'filenames': filenames,
+        })
+        return filenames
+
+    def versions(self, project: str) -> set[Version]:
+        """Get every version with a wheel or sdist in a project."""
+        versions = set()
+        for filename in self.filenames(project):
+            ver = filename_version(filename)
+            if ver is not None:
+                versions.add(ver)
+        return versions
+
+    def latest_version(self, project: str) -> str:
+        """Get the newest final release of a project."""
+        releases = [
+            ver for ver in self.versions(project)
+            if not (ver.is_prerelease or ver.is_devrelease)
+        ]
+        if not releases:
+            raise RuntimeError(f'{project} has no releases on pypi.')
+        return str(max(releases))
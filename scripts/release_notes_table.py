@@ -1,18 +1,21 @@
+import argparse
 import collections
-import copy
 import dataclasses
 import itertools
 import json
 import pathlib
 import re
 import subprocess
-import sys
 import typing
 import warnings
 
 import pkg_resources
 import prettytable
 
+from dep_graph import CoreAttribution, DependencyGraph, load_dependency_graph
+from lockfile import (GitObjectReader, LockEntry, Lockfile, diff_lockfiles,
+                      parse_env_yaml, read_git_packages)
+
 # How much of a change is enough to include in the table?
 VER_DEPTH = {
     'pcds': 3,
@@ -29,6 +32,7 @@ HEADERS = {
     'lab': 'Lab Community Package Updates',
     'community': 'Python Community Core Package Updates',
     'other': 'Other Python Community Major Updates',
+    'rebuilt': 'Core Packages Rebuilt Without Version Changes',
     'degraded': 'Packages With Degraded Versions',
 }
 
@@ -112,25 +116,29 @@ PACKAGES = {
     'community': COMMUNITY_PACKAGES,
 }
 
-# For looking through a git diff
-# First capture group is + or - (new version or old version)
-# Second capture group is package name
-# Third capture group is version string
-ver_change_regex = re.compile(
-    r'^(\+|\-)\s+\- ([^=\n]*)=+([^=\n]*)=?.*$',
-    flags=re.M,
-)
-
-# For looking through the normal file
-# Capture group is the package name
-package_name_regex = re.compile(r'\s+\- ([^=\n]*)=+[^=\n]*=.*$', flags=re.M)
-
 
 @dataclasses.dataclass
 class Update:
     package_name: str
     old_version: typing.Optional[str] = None
     new_version: typing.Optional[str] = None
+    old_build: typing.Optional[str] = None
+    new_build: typing.Optional[str] = None
+
+    @classmethod
+    def from_entries(
+        cls,
+        old: typing.Optional[LockEntry],
+        new: typing.Optional[LockEntry],
+    ) -> 'Update':
+        """Make an Update from the two sides of a lockfile diff."""
+        return cls(
+            package_name=(new or old).name,
+            old_version=old and old.version,
+            new_version=new and new.version,
+            old_build=old and old.build,
+            new_build=new and new.build,
+        )
 
     def ver_depth(self) -> int:
         """
@@ -180,6 +188,13 @@ class Update:
     def updated(self) -> bool:
         return self.new_version != self.old_version
 
+    @property
+    def rebuilt(self) -> bool:
+        return (
+            self.new_version == self.old_version
+            and self.new_build != self.old_build
+        )
+
     @property
     def degraded(self) -> bool:
         if self.new_version == self.old_version:
@@ -197,29 +212,26 @@ class Update:
 def get_package_updates(
     path: typing.Union[str, pathlib.Path],
     reference: str = 'master',
+    reader: typing.Optional[GitObjectReader] = None,
 ) -> dict[str, Update]:
-    """Scans a git diff of the env.yaml file for changes."""
-    diff_output = subprocess.check_output(
-        ['git', 'diff', reference, str(path)],
-        universal_newlines=True,
-    )
-    matches = ver_change_regex.findall(diff_output)
-    updates = {}
-    for diff_type, package_name, version_str in matches:
-        try:
-            entry = updates[package_name]
-        except KeyError:
-            entry = Update(package_name=package_name)
-            updates[package_name] = entry
-        if diff_type == '+':
-            entry.new_version = version_str
-        elif diff_type == '-':
-            entry.old_version = version_str
-        else:
-            raise RuntimeError(
-                f'Unexpected diff_type {diff_type} for {package_name}'
-            )
-    return updates
+    """
+    Compares the env.yaml file against its version at a git reference.
+
+    Pass a shared reader to compare against several references without
+    starting a new git process each time.
+    """
+    path = pathlib.Path(path)
+    git_names = read_git_packages(path.parent / 'git-packages.txt')
+    if reader is None:
+        with GitObjectReader(cwd=path.parent) as reader:
+            old = reader.read_lockfile(reference, path, git_names)
+    else:
+        old = reader.read_lockfile(reference, path, git_names)
+    new = parse_env_yaml(path.read_text(), git_names)
+    return {
+        name: Update.from_entries(old_entry, new_entry)
+        for name, (old_entry, new_entry) in diff_lockfiles(old, new).items()
+    }
 
 
 def build_tables(
@@ -227,11 +239,14 @@ def build_tables(
 ) -> dict[str, prettytable.PrettyTable]:
     """Makes the tables that we'd like to display in the update notes."""
     headers = ('Package', 'Old', 'New')
-    table_names = ('pcds', 'slac', 'lab', 'community', 'other', 'degraded')
+    table_names = (
+        'pcds', 'slac', 'lab', 'community', 'other', 'rebuilt', 'degraded'
+    )
     tables = {name: prettytable.PrettyTable() for name in table_names}
     tables['pcds'].field_names = list(headers) + ['Release Notes']
     tables['slac'].field_names = list(headers) + ['Release Notes']
-    for name in table_names[2:]:
+    tables['rebuilt'].field_names = ('Package', 'Version', 'Old', 'New')
+    for name in ('lab', 'community', 'other', 'degraded'):
         tables[name].field_names = headers
     for update in updates.values():
         if update.added or update.removed:
@@ -248,7 +263,14 @@ def build_tables(
                         row += [update.release_link('slaclab')]
                     tables[group].add_row(row)
                     row_added = True
-                    break
+                elif update.rebuilt:
+                    tables['rebuilt'].add_row([
+                        update.package_name,
+                        update.new_version,
+                        update.old_build,
+                        update.new_build,
+                    ])
+                break
         if (
             update.updated
             and not row_added
@@ -262,10 +284,11 @@ def build_tables(
 
 def audit_package_lists(path):
     """Find typos in the package list globals."""
-    with open(path, 'r') as fd:
-        lines = fd.read()
-
-    packages = set(package_name_regex.findall(lines))
+    path = pathlib.Path(path)
+    packages = Lockfile.from_path(
+        path,
+        git_names=read_git_packages(path.parent / 'git-packages.txt'),
+    )
     err = []
     for package_list in PACKAGES.values():
         for package_name in package_list:
@@ -293,6 +316,10 @@ def build_reverse_deps_cache(
     using the "subset" argument if provided, or with the info discovered
     from conda list. Afterwards, conda repoquery seems to be the fastest
     way to build the dependency tree.
+
+    This spawns a conda subprocess per package, so it is only used as a
+    fallback. DependencyGraph.from_prefix is much faster when the
+    environment is installed locally.
     """
     reverse_deps_cache = collections.defaultdict(set)
     # Use the standard python info
@@ -374,114 +401,310 @@ def conda_list() -> list[str]:
     return [spec['name'] for spec in response]
 
 
-def main(env_name='pcds', reference='master'):
+def get_reverse_deps(
+    added_pkgs: set[str],
+    env_path: pathlib.Path,
+    prefix: typing.Optional[pathlib.Path] = None,
+    repoquery: bool = False,
+    use_cache: bool = True,
+) -> dict[str, set]:
+    """Get the reverse dependency info using the selected strategy."""
+    if repoquery:
+        return build_reverse_deps_cache(added_pkgs)
+    elif use_cache:
+        return load_dependency_graph(prefix=prefix, env_path=env_path).reverse
+    else:
+        return DependencyGraph.from_prefix(prefix).reverse
+
+
+def get_core_attribution(reverse_deps_cache: dict[str, set]) -> CoreAttribution:
+    core_packages = []
+    for package_list in PACKAGES.values():
+        core_packages.extend(package_list)
+    return CoreAttribution(reverse_deps_cache, core_packages)
+
+
+@dataclasses.dataclass
+class AddedDependency:
+    package_name: str
+    required_by: list[str]
+    used_in: list[str]
+    core: bool = False
+
+    def describe(self) -> str:
+        if self.core:
+            return f'{self.package_name} (new core package)'
+        first_required_text = ', '.join(self.required_by)
+        if self.used_in:
+            if len(self.required_by) > 1:
+                are = 'are'
+            else:
+                are = 'is'
+            return (
+                f'{self.package_name} (required by {first_required_text}, '
+                f'which {are} used in {", ".join(self.used_in)})'
+            )
+        return f'{self.package_name} (required by {first_required_text})'
+
+
+@dataclasses.dataclass
+class ReleaseNotes:
+    # Added packages that nothing else requires
+    added: list[str]
+    tables: dict[str, prettytable.PrettyTable]
+    # Added packages that are required by something else
+    dependencies: list[AddedDependency]
+    removed: list[str]
+
+    @classmethod
+    def from_updates(
+        cls,
+        updates: dict[str, Update],
+        attribution: CoreAttribution,
+    ) -> 'ReleaseNotes':
+        added_pkgs = set()
+        removed_pkgs = []
+        for update in updates.values():
+            if update.added:
+                added_pkgs.add(update.package_name)
+            elif update.removed:
+                removed_pkgs.append(update.package_name)
+        # Split based on what we know about dependencies
+        dependencies = []
+        added_specs = []
+        for pkg in sorted(added_pkgs):
+            first_required = attribution.first_requirers(pkg)
+            if not first_required:
+                added_specs.append(pkg)
+            elif pkg in attribution.core_packages:
+                dependencies.append(
+                    AddedDependency(pkg, first_required, [], core=True)
+                )
+            else:
+                core_required = set(
+                    attribution.core_requirers(pkg)
+                ).difference(first_required)
+                dependencies.append(
+                    AddedDependency(pkg, first_required, sorted(core_required))
+                )
+        return cls(
+            added=added_specs,
+            tables=build_tables(updates),
+            dependencies=dependencies,
+            removed=sorted(removed_pkgs),
+        )
+
+    def to_markdown(self) -> str:
+        sections = []
+        # First, show added packages (exciting!)
+        if self.added:
+            sections.append((
+                'Added the Following Packages',
+                '\n'.join(f'- {pkg}' for pkg in self.added),
+            ))
+        # Next, show updates by category
+        for name, table in self.tables.items():
+            if len(list(table)) > 0:
+                table.set_style(prettytable.MARKDOWN)
+                sections.append((HEADERS[name], str(table)))
+        # Next, show dependency updates
+        if self.dependencies:
+            sections.append((
+                'Added the Following Dependencies',
+                '\n'.join(f'- {dep.describe()}' for dep in self.dependencies),
+            ))
+        # Last, show removals
+        if self.removed:
+            sections.append((
+                'Removed the Following Packages',
+                '\n'.join(f'- {pkg}' for pkg in self.removed),
+            ))
+        if not sections:
+            return 'No package updates.\n'
+        return ''.join(
+            f'{header}\n{"-" * len(header)}\n\n{body}\n\n'
+            for header, body in sections
+        )
+
+    def to_json(self) -> dict[str, typing.Any]:
+        return {
+            'added': self.added,
+            'tables': {
+                name: [dict(zip(table.field_names, row)) for row in table.rows]
+                for name, table in self.tables.items()
+            },
+            'dependencies': [
+                dataclasses.asdict(dep) for dep in self.dependencies
+            ],
+            'removed': self.removed,
+        }
+
+
+def main(
+    env_name='pcds',
+    reference='master',
+    prefix=None,
+    repoquery=False,
+    use_cache=True,
+):
     warnings.simplefilter('ignore')
     path = f'../envs/{env_name}/env.yaml'
     audit_package_lists(path)
     updates = get_package_updates(path, reference)
 
-    # Prep work to build the dependency chain
-    added_pkgs = set()
-    removed_pkgs = []
-    for update in updates.values():
-        if update.added:
-            added_pkgs.add(update.package_name)
-        elif update.removed:
-            removed_pkgs.append(update.package_name)
-    reverse_deps_cache = build_reverse_deps_cache(added_pkgs)
-
-    showed_update = False
-    # First, show added packages (exciting!)
-    # Split based on what pkg_resources knows about dependencies
-    added_reqs = {
-        pkg for pkg in added_pkgs if len(reverse_deps_cache[pkg]) > 0
+    added_pkgs = {
+        update.package_name for update in updates.values() if update.added
     }
-    added_specs = added_pkgs.difference(added_reqs)
-    # Further refine the split based on conda's knowledge
-    if added_specs:
-        showed_update = True
-        header = 'Added the Following Packages'
-        print(header)
-        print('-' * len(header))
-        print()
-        for pkg in sorted(added_specs):
-            print(f'- {pkg}')
-        print()
-    # Next, show updates by category
-    tables = build_tables(updates)
-    for name, table in tables.items():
-        if len(list(table)) > 0:
-            showed_update = True
-            print(HEADERS[name])
-            divider = '-' * len(HEADERS[name])
-            print(divider)
-            print()
-            table.set_style(prettytable.MARKDOWN)
-            print(table)
-            print()
-    # Next, show dependency updates
-    if added_reqs:
-        showed_update = True
-        header = 'Added the Following Dependencies'
-        print(header)
-        print('-' * len(header))
-        print()
-        core_packages = []
-        for package_list in PACKAGES.values():
-            core_packages.extend(package_list)
-        for pkg in sorted(added_reqs):
-            if pkg in core_packages:
-                print(f'- {pkg} (new core package)')
-            else:
-                first_required = sorted(reverse_deps_cache[pkg])
-                first_required_text = ', '.join(first_required)
-                core_required = set()
-                unresolved_chains = [[pkg]]
-                while unresolved_chains:
-                    for chain in copy.copy(unresolved_chains):
-                        unresolved_chains.remove(chain)
-                        deps = sorted(reverse_deps_cache.get(chain[0], []))
-                        if not deps:
-                            continue
-                        for dep in deps:
-                            if dep in chain:
-                                continue
-                            new_chain = [dep] + chain
-                            if dep in core_packages:
-                                # Include the core requires
-                                core_required.add(dep)
-                            else:
-                                unresolved_chains.append(new_chain)
-                for req in first_required:
-                    try:
-                        core_required.remove(req)
-                    except KeyError:
-                        pass
-                if core_required:
-                    if len(first_required) > 1:
-                        are = 'are'
-                    else:
-                        are = 'is'
-                    print(
-                        f'- {pkg} (required by {first_required_text}, which '
-                        f'{are} used in {", ".join(sorted(core_required))})'
-                    )
-                else:
-                    print(f'- {pkg} (required by {first_required_text})')
-        print()
-    # Last, show removals
-    if removed_pkgs:
-        showed_update = True
-        header = 'Removed the Following Packages'
-        print(header)
-        print('-' * len(header))
-        print()
-        for pkg in sorted(removed_pkgs):
-            print(f'- {pkg}')
-        print()
-    if not showed_update:
-        print('No package updates.')
+    reverse_deps_cache = get_reverse_deps(
+        added_pkgs,
+        env_path=pathlib.Path(path),
+        prefix=prefix,
+        repoquery=repoquery,
+        use_cache=use_cache,
+    )
+    notes = ReleaseNotes.from_updates(
+        updates,
+        get_core_attribution(reverse_deps_cache),
+    )
+    print(notes.to_markdown(), end='')
+
+
+def release_tags(
+    start: str,
+    end: str,
+    env_name: str = 'pcds',
+) -> list[str]:
+    """
+    Get the release tags from start to end, inclusive, in version order.
+
+    The pcds env is tagged with bare version numbers and other envs are
+    tagged with their name as a prefix, e.g. ease-0.1.0.
+    """
+    if env_name == 'pcds':
+        tag_regex = re.compile(r'^v?\d+(\.\d+)*$')
+    else:
+        tag_regex = re.compile(rf'^{re.escape(env_name)}-\d+(\.\d+)*$')
+    tags = [
+        tag for tag in subprocess.check_output(
+            ['git', 'tag', '--list', '--sort=version:refname'],
+            universal_newlines=True,
+        ).splitlines()
+        if tag_regex.match(tag)
+    ]
+    try:
+        return tags[tags.index(start):tags.index(end) + 1]
+    except ValueError as exc:
+        raise RuntimeError(
+            f'Did not find both {start} and {end} in the {env_name} tags.'
+        ) from exc
+
+
+def history(
+    env_name='pcds',
+    references=(),
+    prefix=None,
+    repoquery=False,
+    use_cache=True,
+    as_json=False,
+):
+    """
+    Show the release notes for every consecutive pair of references.
+
+    Each env.yaml revision is read from git once through a shared reader,
+    and the dependency info of the installed env is built once and shared
+    between all of the pairs.
+    """
+    warnings.simplefilter('ignore')
+    path = pathlib.Path(f'../envs/{env_name}/env.yaml')
+    git_names = read_git_packages(path.parent / 'git-packages.txt')
+    with GitObjectReader(cwd=path.parent) as reader:
+        snapshots = {
+            ref: reader.read_lockfile(ref, path, git_names)
+            for ref in references
+        }
+    all_updates = {}
+    added_pkgs = set()
+    for old_ref, new_ref in zip(references, references[1:]):
+        updates = {
+            name: Update.from_entries(old_entry, new_entry)
+            for name, (old_entry, new_entry) in diff_lockfiles(
+                snapshots[old_ref], snapshots[new_ref],
+            ).items()
+        }
+        all_updates[old_ref, new_ref] = updates
+        added_pkgs.update(
+            update.package_name for update in updates.values() if update.added
+        )
+    reverse_deps_cache = get_reverse_deps(
+        added_pkgs,
+        env_path=path,
+        prefix=prefix,
+        repoquery=repoquery,
+        use_cache=use_cache,
+    )
+    attribution = get_core_attribution(reverse_deps_cache)
+    for (old_ref, new_ref), updates in all_updates.items():
+        notes = ReleaseNotes.from_updates(updates, attribution)
+        if as_json:
+            print(json.dumps({'old': old_ref, 'new': new_ref, **notes.to_json()}))
+        else:
+            header = f'{old_ref} to {new_ref}'
+            print(f'{header}\n{"=" * len(header)}\n')
+            print(notes.to_markdown(), end='')
 
 
 if __name__ == '__main__':
-    main(*sys.argv[1:])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env_name', nargs='?', default='pcds')
+    parser.add_argument('reference', nargs='?', default='master')
+    parser.add_argument(
+        '--prefix',
+        type=pathlib.Path,
+        help='The installed environment to inspect. Defaults to the active one.',
+    )
+    parser.add_argument(
+        '--repoquery',
+        action='store_true',
+        help=(
+            'Build the dependency info using one conda repoquery call per '
+            'package instead of reading the environment metadata directly.'
+        ),
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Rebuild the dependency info from scratch without using the cache.',
+    )
+    parser.add_argument(
+        '--history',
+        nargs=2,
+        metavar=('START', 'END'),
+        help=(
+            'Show the notes for every consecutive pair of release tags from '
+            'START to END instead of comparing against a single reference. '
+            'Dependency info comes from the installed environment.'
+        ),
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='With --history, print one json object per release pair.',
+    )
+    args = parser.parse_args()
+    if args.history:
+        history(
+            env_name=args.env_name,
+            references=release_tags(*args.history, env_name=args.env_name),
+            prefix=args.prefix,
+            repoquery=args.repoquery,
+            use_cache=not args.no_cache,
+            as_json=args.json,
+        )
+    else:
+        main(
+            env_name=args.env_name,
+            reference=args.reference,
+            prefix=args.prefix,
+            repoquery=args.repoquery,
+            use_cache=not args.no_cache,
+        )
@@ -0,0 +1,382 @@
+"""
+Run the test suite of every package in the tests directory concurrently.
+
+This is the test loop of run_all_tests.sh. Each package gets up to RETRIES
+tries, and each try is stopped after TIMEOUT seconds with SIGTERM, which
+counts as exit code 124 like the timeout command. A package that passes
+after failing at least once probably has a race condition in its tests, so
+it passes with a warning instead of an error.
+
+Suites run at the same time in separate worker slots. Each slot has its own
+TMPDIR and its own EPICS channel access and pvAccess ports, so IOCs and
+clients started by one suite cannot see the ones from another, and Qt is
+told to render offscreen. The output of each package is collected in a
+log file and printed in one piece when the package is done.
+
+Every run is added to the test history, see run_history.py, and the
+suites that took the longest in recent runs are started first.
+"""
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from run_history import TestHistory
+
+RETRIES = 5
+# Seconds before a try is stopped
+TIMEOUT = 600
+# Seconds to wait after SIGTERM before sending SIGKILL
+KILL_GRACE = 30
+# Each worker slot gets PORTS_PER_SLOT EPICS ports starting from here
+EPICS_BASE_PORT = 15064
+PORTS_PER_SLOT = 4
+
+RED = '31'
+YELLOW = '33'
+GREEN = '32'
+
+
+def color(text: str, code: str) -> str:
+    return f'\033[0;{code}m{text}\033[0m'
+
+
+@dataclass
+class TestResult:
+    # The test directory e.g. tests/pcdsdevices
+    package: str
+    exit_code: int = 0
+    # How many tries it took, including the last one
+    attempts: int = 0
+    # Seconds from the start of the first try to the end of the last one
+    wall_time: float = 0.0
+    # Seconds taken by each try
+    attempt_times: list[float] = field(default_factory=list)
+    # The exit code of each try
+    attempt_codes: list[int] = field(default_factory=list)
+
+    @property
+    def status(self) -> str:
+        """pass, warn if it needed retries to pass, or fail."""
+        if self.exit_code != 0:
+            return 'fail'
+        if self.attempts > 1:
+            return 'warn'
+        return 'pass'
+
+
+def worker_env(slot: int, tmp_root: Path) -> dict[str, str]:
+    """
+    Get the environment variables for the suites run in one worker slot.
+
+    Parameters
+    ----------
+    slot : int
+        The number of the worker slot, starting at 0.
+    tmp_root : Path
+        The directory to make the slot's TMPDIR in.
+    """
+    tmpdir = (tmp_root / f'worker-{slot}').resolve()
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    port = EPICS_BASE_PORT + PORTS_PER_SLOT * slot
+    env = dict(os.environ)
+    env.update({
+        'TMPDIR': str(tmpdir),
+        'EPICS_CA_SERVER_PORT': str(port),
+        'EPICS_CA_REPEATER_PORT': str(port + 1),
+        'EPICS_PVA_SERVER_PORT': str(port + 2),
+        'EPICS_PVA_BROADCAST_PORT': str(port + 3),
+        'PCDS_ENVS_TEST_WORKER': str(slot),
+    })
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    return env
+
+
+def run_once(
+    test_dir: Path,
+    env: dict[str, str],
+    log,
+    timeout: float = TIMEOUT,
+) -> int:
+    """
+    Run a package's tests one time, writing the output to log.
+
+    Returns
+    -------
+    exit_code : int
+        The exit code of the tests, or 124 if they timed out.
+    """
+    if (test_dir / 'run_tests.py').is_file():
+        cmd = [sys.executable, 'run_tests.py']
+    else:
+        cmd = [sys.executable, '-m', 'pytest']
+    proc = subprocess.Popen(
+        cmd,
+        cwd=test_dir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        # Put the tests in their own process group so we can stop all of it
+        start_new_session=True,
+    )
+    try:
+        return proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=KILL_GRACE)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        log.write(f'Test timed out after {timeout:.0f}s, killed with SIGKILL\n')
+        return 137
+    log.write(f'Test timed out after {timeout:.0f}s, killed with SIGTERM\n')
+    return 124
+
+
+def run_package(
+    test_dir: Path,
+    env: dict[str, str],
+    log_path: Path,
+    retries: int = RETRIES,
+    timeout: float = TIMEOUT,
+) -> TestResult:
+    """
+    Run a package's tests until they pass or we run out of retries.
+
+    Parameters
+    ----------
+    test_dir : Path
+        The cloned package to test.
+    env : dict of str to str
+        The environment variables to run the tests with.
+    log_path : Path
+        Where to write the output of every try.
+    retries : int, optional
+        The most times to try.
+    timeout : float, optional
+        Seconds before a try is stopped.
+    """
+    result = TestResult(package=str(test_dir))
+    start = time.monotonic()
+    with open(log_path, 'w') as log:
+        log.write(f'Running tests for {test_dir}\n')
+        log.flush()
+        # Check on the repo for debugging purposes
+        for cmd in (['git', 'status'], ['git', 'rev-parse', 'HEAD']):
+            subprocess.run(cmd, cwd=test_dir, stdout=log, stderr=subprocess.STDOUT)
+        while result.attempts < retries:
+            log.flush()
+            attempt_start = time.monotonic()
+            result.exit_code = run_once(test_dir, env, log, timeout=timeout)
+            result.attempts += 1
+            result.attempt_times.append(time.monotonic() - attempt_start)
+            result.attempt_codes.append(result.exit_code)
+            if result.exit_code == 0:
+                break
+    result.wall_time = time.monotonic() - start
+    return result
+
+
+def finish_message(result: TestResult) -> str:
+    code = {'fail': RED, 'warn': YELLOW, 'pass': GREEN}[result.status]
+    return color(
+        f'Test for {result.package} finished with exit code '
+        f'{result.exit_code} after {result.attempts} tries '
+        f'in {result.wall_time:.1f}s',
+        code,
+    )
+
+
+def run_all(
+    test_dirs: list[Path],
+    workers: int,
+    log_dir: Path,
+    retries: int = RETRIES,
+    timeout: float = TIMEOUT,
+) -> list[TestResult]:
+    """
+    Run every package's tests, up to workers at a time.
+
+    Each package runs in a free worker slot, see worker_env. The results
+    are in the same order as test_dirs.
+    """
+    log_dir.mkdir(parents=True, exist_ok=True)
+    slots = queue.Queue()
+    for slot in range(workers):
+        slots.put(slot)
+
+    def run(test_dir):
+        slot = slots.get()
+        try:
+            return run_package(
+                test_dir,
+                env=worker_env(slot, log_dir / 'tmp'),
+                log_path=log_dir / f'{test_dir.name}.log',
+                retries=retries,
+                timeout=timeout,
+            )
+        finally:
+            slots.put(slot)
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, test_dir): test_dir for test_dir in test_dirs}
+        for future in concurrent.futures.as_completed(futures):
+            test_dir = futures[future]
+            result = future.result()
+            results[test_dir] = result
+            print((log_dir / f'{test_dir.name}.log').read_text(errors='replace'))
+            print(finish_message(result), flush=True)
+    return [results[test_dir] for test_dir in test_dirs]
+
+
+def print_summary(results: list[TestResult]) -> None:
+    """Print the summary block that CI copies into the job summary."""
+    failed = ''.join(f'\n{res.package}' for res in results if res.status == 'fail')
+    warned = ''.join(f'\n{res.package}' for res in results if res.status == 'warn')
+    print('summary_start')
+    if failed:
+        print(color(f'The following packages failed all retries:{failed}', RED))
+    else:
+        print(color('All package tests passed!', GREEN))
+    if warned:
+        print(color(
+            'The following packages had race conditions, but passed at '
+            f'least once:{warned}',
+            YELLOW,
+        ))
+    else:
+        print(color('No packages had race conditions!', GREEN))
+    print('summary_end', flush=True)
+
+
+def write_json_summary(
+    path: Path,
+    results: list[TestResult],
+    wall_time: float,
+    workers: int,
+) -> None:
+    summary = {
+        'wall_time': wall_time,
+        'workers': workers,
+        'packages': {
+            result.package: dict(asdict(result), status=result.status)
+            for result in results
+        },
+    }
+    with open(path, 'w') as fd:
+        json.dump(summary, fd, indent=2)
+
+
+def main(
+    tests_dir: Path,
+    workers: int,
+    summary_json: Path,
+    retries: int = RETRIES,
+    timeout: float = TIMEOUT,
+    history_db: Path | None = None,
+    use_history: bool = True,
+    release: str = '',
+) -> int:
+    test_dirs = sorted(path for path in tests_dir.iterdir() if path.is_dir())
+    if not test_dirs:
+        print(f'No packages to test in {tests_dir}')
+    history = TestHistory(history_db) if use_history else None
+    if history is not None:
+        test_dirs = history.schedule(test_dirs)
+    start = time.monotonic()
+    results = run_all(
+        test_dirs,
+        workers=workers,
+        log_dir=tests_dir.parent / 'test_logs',
+        retries=retries,
+        timeout=timeout,
+    )
+    wall_time = time.monotonic() - start
+    results.sort(key=lambda result: result.package)
+    if history is not None:
+        history.record_run(results, wall_time, workers, release=release)
+        history.close()
+    print_summary(results)
+    write_json_summary(summary_json, results, wall_time, workers)
+    print(f'Ran {len(results)} packages in {wall_time:.1f}s, see {summary_json}')
+    return 1 if any(result.status == 'fail' for result in results) else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the tests of every package cloned by test_setup.py.',
+    )
+    parser.add_argument(
+        '--tests-dir',
+        type=Path,
+        default=Path('tests'),
+        help='The directory with one cloned package per subdirectory.',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='How many packages to test at the same time.',
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=RETRIES,
+        help='The most times to try each package.',
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=TIMEOUT,
+        help='Seconds before a try is stopped.',
+    )
+    parser.add_argument(
+        '--summary-json',
+        type=Path,
+        default=Path('test_summary.json'),
+        help='Where to write the machine-readable summary.',
+    )
+    parser.add_argument(
+        '--history-db',
+        type=Path,
+        help=(
+            'The test history database used to order the packages and '
+            'record this run. Defaults to one in the pcds-envs cache.'
+        ),
+    )
+    parser.add_argument(
+        '--no-history',
+        action='store_true',
+        help='Run in alphabetical order and do not record this run.',
+    )
+    parser.add_argument(
+        '--release',
+        default=os.environ.get('CONDA_DEFAULT_ENV', ''),
+        help=(
+            'The name to file this run under in the history, e.g. '
+            'pcds-6.0.0. Defaults to the active conda environment.'
+        ),
+    )
+    args = parser.parse_args()
+    sys.exit(main(
+        tests_dir=args.tests_dir,
+        workers=args.workers,
+        summary_json=args.summary_json,
+        retries=args.retries,
+        timeout=args.timeout,
+        history_db=args.history_db,
+        use_history=not args.no_history,
+        release=args.release,
+    ))
@@ -1,65 +1,7 @@
-ERROR=0
-ERR_PKGS=""
-WARN_PKGS=""
-RETRIES=5
-
-for dir in tests/*
-do
-  retries=$RETRIES
-  echo "Running tests for ${dir}"
-  pushd "${dir}"
-  # Check on the repo for debugging purposes
-  git status
-  git rev-parse HEAD
-  # Try a few times. Allow pass with a warning for race conditions in tests.
-  while [ $retries -gt 0 ]; do
-    if [ -f "run_tests.py" ]; then
-      timeout 10m python run_tests.py
-    else
-      timeout 10m python -m pytest
-    fi
-    # Accumulate error codes, else the loop eats them
-    retcode=$?
-    if [ "${retcode}" -eq "0" ]; then
-      break
-    else
-      if [ "${retcode}" -eq "124" ]; then
-        echo "Test timed out after 10 minutes, killed with SIGTERM"
-      elif [ "${retcode}" -eq "137" ]; then
-        echo "Test timed out after 10 minutes, killed with SIGKILL"
-      fi
-      (( retries -= 1 ))
-    fi
-  done
-  if [ "${retcode}" -ne "0" ]; then
-    ERR_PKGS="${ERR_PKGS}\n${dir}"
-    color="31" # Red
-  elif [ "${retries}" -lt "${RETRIES}" ]; then
-    WARN_PKGS="${WARN_PKGS}\n${dir}"
-    color="33" # Yellow
-  else
-    color="32" # Green
-  fi
-  echo -e "\033[0;${color}mTest for ${dir} finished with exit code ${retcode}\033[0m"
-  (( ERROR += $retcode ))
-  popd
-done
-
-echo "summary_start"
-
-# If ERROR is nonzero, at least one of the run_test.py calls failed
-if [ -n "${ERR_PKGS}" ]; then
-  echo -e "\033[0;31mThe following packages failed all retries:${ERR_PKGS}\033[0m"
-else
-  echo -e "\033[0;32mAll package tests passed!\033[0m"
-fi
-if [ -n "${WARN_PKGS}" ]; then
-  echo -e "\033[0;33mThe following packages had race conditions, but passed at least once:${WARN_PKGS}\033[0m"
-else
-  echo -e "\033[0;32mNo packages had race conditions!\033[0m"
-fi
-
-echo "summary_end"
+# Run every package's tests in parallel, with retries for race conditions.
+# This prints the summary_start/summary_end block and writes test_summary.json
+python run_all_tests.py
+ERROR=$?
 
 # Do the environment's extra tests if they exist
 if [ -n "${1}" ]; then
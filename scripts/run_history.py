@@ -0,0 +1,311 @@
+"""
+Keep a history of package test runs to schedule and review future runs.
+
+Every run of run_all_tests.py appends each package's wall time, number of
+tries, and exit code to a small sqlite database. The next run uses the
+recent wall times to start the longest suites first, so a slow suite does
+not start last and hold up the whole run. The report compares the latest
+release with the one before it to find suites that are getting slower or
+flakier.
+"""
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import statistics
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import prettytable
+
+from caching import cache_dir
+
+if TYPE_CHECKING:
+    from run_all_tests import TestResult
+
+# How many recent runs of a package to use for its expected wall time
+HISTORY_WINDOW = 5
+# Report suites that got this much slower from one release to the next
+SLOWER_RATIO = 1.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    release TEXT NOT NULL,
+    workers INTEGER NOT NULL,
+    wall_time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    package TEXT NOT NULL,
+    exit_code INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    wall_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_package ON results(package, run_id);
+"""
+
+
+def default_history_path() -> Path:
+    return cache_dir('test-history') / 'history.sqlite'
+
+
+def package_name(result: TestResult) -> str:
+    """The name to file a result under, e.g. pcdsdevices for tests/pcdsdevices"""
+    return Path(result.package).name
+
+
+@dataclass
+class PackageReport:
+    package: str
+    runs: int
+    # Median seconds in the latest and the previous release, if any
+    latest_time: float | None
+    previous_time: float | None
+    # Fraction of runs that needed a retry to pass
+    latest_flake_rate: float
+    previous_flake_rate: float | None
+    # Runs that failed every try, over all releases
+    failures: int
+
+    @property
+    def slowdown(self) -> float | None:
+        if not self.latest_time or not self.previous_time:
+            return None
+        return self.latest_time / self.previous_time
+
+    @property
+    def slower(self) -> bool:
+        return self.slowdown is not None and self.slowdown >= SLOWER_RATIO
+
+    @property
+    def flakier(self) -> bool:
+        return (
+            self.previous_flake_rate is not None
+            and self.latest_flake_rate > self.previous_flake_rate
+        )
+
+
+class TestHistory:
+    """
+    The sqlite database of past test runs.
+
+    Parameters
+    ----------
+    path : Path, optional
+        The database file. Defaults to one in the pcds-envs cache.
+    """
+    def __init__(self, path: Path | None = None):
+        self.path = default_history_path() if path is None else Path(path)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.executescript(SCHEMA)
+
+    def record_run(
+        self,
+        results: Iterable[TestResult],
+        wall_time: float,
+        workers: int,
+        release: str = '',
+    ) -> None:
+        """
+        Add the results of a run of run_all_tests.py.
+
+        Parameters
+        ----------
+        results : iterable of TestResult
+            The result for each package.
+        wall_time : float
+            Seconds the whole run took.
+        workers : int
+            How many packages were tested at the same time.
+        release : str, optional
+            The environment that was tested, e.g. pcds-6.0.0.
+        """
+        with self._conn:
+            cursor = self._conn.execute(
+                'INSERT INTO runs (started, release, workers, wall_time) '
+                'VALUES (?, ?, ?, ?)',
+                (time.time() - wall_time, release, workers, wall_time),
+            )
+            self._conn.executemany(
+                'INSERT INTO results '
+                '(run_id, package, exit_code, attempts, wall_time) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [
+                    (
+                        cursor.lastrowid,
+                        package_name(result),
+                        result.exit_code,
+                        result.attempts,
+                        result.wall_time,
+                    )
+                    for result in results
+                ],
+            )
+
+    def expected_times(self, window: int = HISTORY_WINDOW) -> dict[str, float]:
+        """The median wall time of the last few runs of each package."""
+        times = {}
+        rows = self._conn.execute(
+            'SELECT package, wall_time FROM results ORDER BY run_id DESC'
+        )
+        for package, wall_time in rows:
+            recent = times.setdefault(package, [])
+            if len(recent) < window:
+                recent.append(wall_time)
+        return {
+            package: statistics.median(recent)
+            for package, recent in times.items()
+        }
+
+    def schedule(self, test_dirs: Iterable[Path]) -> list[Path]:
+        """
+        Order packages from the longest expected wall time to the shortest.
+
+        Packages with no history go first, since they could be the longest.
+        """
+        expected = self.expected_times()
+        return sorted(
+            test_dirs,
+            key=lambda path: -expected.get(path.name, float('inf')),
+        )
+
+    def report(self) -> list[PackageReport]:
+        """
+        Compare the latest release with the one before it for every package.
+
+        Releases are ordered by when they were first tested.
+        """
+        releases = [
+            release for release, in self._conn.execute(
+                'SELECT release FROM runs GROUP BY release ORDER BY MIN(started)'
+            )
+        ]
+        by_package = {}
+        rows = self._conn.execute(
+            'SELECT results.package, runs.release, results.exit_code, '
+            'results.attempts, results.wall_time '
+            'FROM results JOIN runs ON results.run_id = runs.id'
+        )
+        for package, release, exit_code, attempts, wall_time in rows:
+            by_release = by_package.setdefault(package, {})
+            by_release.setdefault(release, []).append(
+                (exit_code, attempts, wall_time)
+            )
+
+        reports = []
+        for package, by_release in sorted(by_package.items()):
+            tested = [release for release in releases if release in by_release]
+            latest = by_release[tested[-1]]
+            previous = by_release[tested[-2]] if len(tested) > 1 else None
+            reports.append(PackageReport(
+                package=package,
+                runs=sum(len(runs) for runs in by_release.values()),
+                latest_time=_median_time(latest),
+                previous_time=_median_time(previous),
+                latest_flake_rate=_flake_rate(latest),
+                previous_flake_rate=_flake_rate(previous),
+                failures=sum(
+                    1 for runs in by_release.values()
+                    for exit_code, _, _ in runs if exit_code != 0
+                ),
+            ))
+        return reports
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self) -> TestHistory:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _median_time(runs: list[tuple[int, int, float]] | None) -> float | None:
+    if not runs:
+        return None
+    return statistics.median(wall_time for _, _, wall_time in runs)
+
+
+def _flake_rate(runs: list[tuple[int, int, float]] | None) -> float | None:
+    if not runs:
+        return None
+    flaky = sum(
+        1 for exit_code, attempts, _ in runs if exit_code == 0 and attempts > 1
+    )
+    return flaky / len(runs)
+
+
+def _format_time(seconds: float | None) -> str:
+    return '' if seconds is None else f'{seconds:.1f}s'
+
+
+def _format_rate(rate: float | None) -> str:
+    return '' if rate is None else f'{rate:.0%}'
+
+
+def print_report(reports: list[PackageReport], everything: bool = False) -> None:
+    """
+    Print a table of the suites that got slower or flakier.
+
+    Parameters
+    ----------
+    reports : list of PackageReport
+        The output of TestHistory.report.
+    everything : bool, optional
+        If True, include every package, not just the ones that got worse.
+    """
+    table = prettytable.PrettyTable()
+    table.field_names = [
+        'Package', 'Runs', 'Time', 'Previous Time', 'Change',
+        'Flake Rate', 'Previous Flake Rate', 'Failures',
+    ]
+    table.align = 'l'
+    shown = [
+        report for report in reports
+        if everything or report.slower or report.flakier
+    ]
+    shown.sort(key=lambda report: -(report.slowdown or 0))
+    for report in shown:
+        slowdown = report.slowdown
+        table.add_row([
+            report.package,
+            report.runs,
+            _format_time(report.latest_time),
+            _format_time(report.previous_time),
+            '' if slowdown is None else f'{slowdown - 1:+.0%}',
+            _format_rate(report.latest_flake_rate),
+            _format_rate(report.previous_flake_rate),
+            report.failures,
+        ])
+    if not shown:
+        print('No test suites got slower or flakier since the previous release.')
+        return
+    print(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Report test suites that got slower or flakier since the '
+            'previous release.'
+        ),
+    )
+    parser.add_argument(
+        '--history-db',
+        type=Path,
+        help='The test history database. Defaults to one in the cache.',
+    )
+    parser.add_argument(
+        '--all',
+        action='store_true',
+        help='Show every package, not just the ones that got worse.',
+    )
+    args = parser.parse_args()
+    with TestHistory(args.history_db) as history:
+        print_report(history.report(), everything=args.all)
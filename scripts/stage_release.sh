@@ -56,6 +56,25 @@ if [ -x "$(command -v conda-pack)" ]; then
   echo "Packing env into ${PACKPATH}"
   mkdir -p "${PACKDIR}"
   conda-pack -n "${NAME}" -o "${PACKPATH}"
+  PACKS=("${PACKPATH}")
+  # Also make a zstd pack, which pzstd can decompress on every core.
+  # pzstd writes independent frames, plain zstd would write just one.
+  if [ -x "$(command -v pzstd)" ]; then
+    ZSTPATH="${PACKDIR}/${NAME}.tar.zst"
+    echo "Recompressing into ${ZSTPATH}"
+    set -o pipefail
+    gzip -dc "${PACKPATH}" | pzstd -q -f -p "$(nproc)" -o "${ZSTPATH}.tmp"
+    mv "${ZSTPATH}.tmp" "${ZSTPATH}"
+    PACKS+=("${ZSTPATH}")
+  else
+    echo "pzstd is not installed, skipping the .tar.zst pack"
+  fi
+  # Publish these next to the packs, deploys check the copied packs with them
+  echo "Writing chunk manifests"
+  python ../deploy/stage_pack.py manifest "${PACKS[@]}"
+  # The files and hashes of the env, which validate_unpack checks deploys with
+  PREFIX="$(conda env list | awk -v name="${NAME}" '$1 == name {print $NF}')"
+  python ../deploy/env_manifest.py create "${PACKPATH}" --prefix "${PREFIX}"
 else
   echo "conda-pack is not installed, skipping step"
 fi
@@ -1,42 +1,103 @@
 import argparse
-import contextlib
-import json
+import concurrent.futures
+import fcntl
 import logging
 import os
 import subprocess
+import time
 from pathlib import Path
 
+from lockfile import Lockfile, read_git_packages
+from prefix_snapshot import snapshot_prefix
+
 logger = logging.getLogger(__name__)
 
 URL_BASE = 'https://github.com/{}.git'
+WORKERS = 8
 parser = argparse.ArgumentParser()
 parser.add_argument('env')
 parser.add_argument('--tag', action='store_true')
+parser.add_argument(
+    '--lockfile',
+    action='store_true',
+    help=(
+        'With --tag, take the package versions from the env.yaml instead '
+        'of from the active environment.'
+    ),
+)
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=WORKERS,
+    help='How many repos to clone at the same time.',
+)
+parser.add_argument(
+    '--mirror-dir',
+    type=Path,
+    help=(
+        'Keep bare mirrors of the test repos here and make the test '
+        'checkouts from them, so later runs only download new objects.'
+    ),
+)
+parser.add_argument(
+    '--url-base',
+    default=URL_BASE,
+    help=(
+        'Format string for the repo urls, where {} is the org/name from '
+        'package-tests.txt, e.g. file:///path/to/repos/{}.git'
+    ),
+)
 
 
 def version_info():
-    conda_list = subprocess.check_output(['conda', 'list', '--json'],
-                                         universal_newlines=True)
-    info_list = json.loads(conda_list)
-    version_dict = {}
+    return {name: entry.version for name, entry in snapshot_prefix().items()}
 
-    for item in info_list:
-        version_dict[item['name']] = item['version']
 
-    return version_dict
+def lockfile_version_info(env_dir):
+    env_dir = Path(env_dir)
+    lockfile = Lockfile.from_path(
+        env_dir / 'env.yaml',
+        git_names=read_git_packages(env_dir / 'git-packages.txt'),
+    )
+    return {name: entry.version for name, entry in lockfile.items()}
 
 
-def setup_all_tests(repo_file, tags=None):
+def resolve_tag(url, tag):
+    try:
+        output = subprocess.check_output(
+            ['git', 'ls-remote', '--tags', url],
+            universal_newlines=True,
+        )
+    except subprocess.CalledProcessError as err:
+        raise RuntimeError(f'Error listing tags from {url}') from err
+    refs = set()
+    for line in output.splitlines():
+        ref = line.split()[-1]
+        refs.add(ref.removeprefix('refs/tags/').removesuffix('^{}'))
+    for name in ('v' + tag, tag):
+        if name in refs:
+            return name
+    raise RuntimeError(f'Did not find tag {tag} in {url}')
+
+
+def setup_all_tests(
+    repo_file,
+    tags=None,
+    workers=WORKERS,
+    cwd=None,
+    url_base=URL_BASE,
+    mirror_dir=None,
+):
     repo_file = Path(repo_file)
 
     with repo_file.open('r') as fd:
         repos = fd.read().strip().splitlines()
 
+    jobs = {}
     for repo in repos:
         pkg = repo.split('/')[-1]
-        if tags is None:
-            setup_one_test(repo, pkg)
-        else:
+        tag = None
+        if tags is not None:
             try:
                 tag = tags[pkg]
             except KeyError:
@@ -44,50 +105,107 @@ def setup_all_tests(repo_file, tags=None):
                     'Did not find package %s in environment, cannot use tag',
                     pkg,
                 )
-                setup_one_test(repo, pkg)
+        jobs[pkg] = (repo, tag)
+
+    start = time.monotonic()
+    timings = {}
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                setup_one_test, repo, pkg, tag=tag, cwd=cwd,
+                url_base=url_base, mirror_dir=mirror_dir,
+            ): pkg
+            for pkg, (repo, tag) in jobs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            pkg = futures[future]
+            try:
+                timings[pkg] = future.result()
+            except RuntimeError as err:
+                errors[pkg] = err
+                print(f'{pkg}: {err}')
             else:
-                setup_one_test(repo, pkg, tag=tag)
-
-
-def setup_one_test(repo, pkg, tag=None):
-    url = URL_BASE.format(repo)
+                print(f'{pkg}: ready in {timings[pkg]:.1f}s')
+    print_timings(timings, time.monotonic() - start)
+    if errors:
+        raise RuntimeError(
+            f'Test setup failed for {", ".join(sorted(errors))}'
+        ) from next(iter(errors.values()))
+
+
+def print_timings(timings, total):
+    print('Test setup timing:')
+    for pkg, elapsed in sorted(timings.items(), key=lambda item: -item[1]):
+        print(f'  {pkg:<30} {elapsed:6.1f}s')
+    print(f'  {"total (wall clock)":<30} {total:6.1f}s')
+
+
+def run_git(args, cwd=None):
+    proc = subprocess.run(
+        ['git'] + args,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    if proc.returncode != 0:
+        # Only show git's output on failure, the parallel output is unreadable
+        print(proc.stdout)
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def update_mirror(url, mirror_path):
+    mirror_path = Path(mirror_path)
+    mirror_path.parent.mkdir(parents=True, exist_ok=True)
+    # Another test run on this host may be updating the same mirror
+    with open(mirror_path.with_name(mirror_path.name + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if mirror_path.exists():
+                run_git(['remote', 'set-url', 'origin', url], cwd=mirror_path)
+                run_git(['remote', 'update', '--prune'], cwd=mirror_path)
+            else:
+                run_git(['clone', '--mirror', url, str(mirror_path)])
+        except subprocess.CalledProcessError as err:
+            raise RuntimeError(f'Error updating mirror of {url}') from err
+
+
+def setup_one_test(
+    repo,
+    pkg,
+    tag=None,
+    cwd=None,
+    url_base=URL_BASE,
+    mirror_dir=None,
+):
+    start = time.monotonic()
+    url = url_base.format(repo)
+    if mirror_dir is None:
+        source = url
+        clone_args = ['clone', '--depth', '1']
+    else:
+        source = str(Path(mirror_dir).resolve() / f'{repo}.git')
+        update_mirror(url, source)
+        # Borrow the mirror's objects instead of copying them
+        clone_args = ['clone', '--shared']
+    if tag is not None:
+        # Fetch just the tag, which may or may not have a v prefix
+        clone_args += ['--branch', resolve_tag(source, tag)]
+    repo_dir = pkg if cwd is None else Path(cwd) / pkg
     try:
-        subprocess.run(['git', 'clone', url, '--depth', '1'],
-                       check=True)
+        run_git(clone_args + [source, pkg], cwd=cwd)
+        if mirror_dir is not None:
+            run_git(['remote', 'set-url', 'origin', url], cwd=repo_dir)
     except subprocess.CalledProcessError as err:
-        raise RuntimeError(f'Error cloning from {url}') from err
+        raise RuntimeError(f'Error cloning from {source}') from err
 
-    if tag is not None:
-        print('Checking out package tag')
-        with pushd(pkg):
-            try:
-                subprocess.run(
-                    ['git', 'fetch', '--tags'],
-                    check=True,
-                )
-                tag_prefix = subprocess.check_output(
-                    ['git', 'tag', '-l'],
-                    universal_newlines=True,
-                ).strip().split('\n')[-1][0]
-                if tag_prefix.isdigit():
-                    tag_prefix = ''
-                subprocess.run(
-                    ['git', 'checkout', tag_prefix + tag],
-                    check=True,
-                )
-            except subprocess.CalledProcessError as err:
-                raise RuntimeError('Error checking out tag') from err
     # Set up submodules after tag to keep it synced to the tag
-    with pushd(pkg):
-        subprocess.run(['git', 'submodule', 'update', '--init', '--recursive'])
-
-
-@contextlib.contextmanager
-def pushd(new_dir):
-    previous_dir = os.getcwd()
-    os.chdir(new_dir)
-    yield
-    os.chdir(previous_dir)
+    try:
+        run_git(['submodule', 'update', '--init', '--recursive'], cwd=repo_dir)
+    except subprocess.CalledProcessError:
+        logger.warning('Error setting up submodules for %s', pkg)
+    return time.monotonic() - start
 
 
 def main(args):
@@ -97,7 +215,10 @@ def main(args):
     repo_file = pcds_envs / 'envs' / args.env / 'package-tests.txt'
 
     if args.tag:
-        tags = version_info()
+        if args.lockfile:
+            tags = lockfile_version_info(repo_file.parent)
+        else:
+            tags = version_info()
 
         if len(tags) == 0:
             print('No packages in current environment to test, quitting')
@@ -106,8 +227,14 @@ def main(args):
         tags = None
 
     os.mkdir('tests')
-    with pushd('tests'):
-        setup_all_tests(repo_file, tags=tags)
+    setup_all_tests(
+        repo_file,
+        tags=tags,
+        workers=args.workers,
+        cwd='tests',
+        url_base=args.url_base,
+        mirror_dir=args.mirror_dir,
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+import subprocess
+
+import pytest
+
+from check_master_tags import get_master_tag, head_tag, ls_remote
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch):
+    for var in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{var}_NAME', 'pcds-envs tests')
+        monkeypatch.setenv(f'GIT_{var}_EMAIL', 'tests@example.com')
+
+
+def git(*args, cwd=None):
+    subprocess.check_output(['git'] + list(args), cwd=cwd)
+
+
+@pytest.fixture
+def server(tmp_path):
+    """A bare pcdshub/pkg repo and a clone to push to it from."""
+    bare = tmp_path / 'srv' / 'pcdshub' / 'pkg.git'
+    bare.mkdir(parents=True)
+    git('init', '-q', '--bare', str(bare))
+    work = tmp_path / 'work'
+    git('clone', '-q', str(bare), str(work))
+    git('commit', '-q', '--allow-empty', '-m', 'first', cwd=work)
+    return f'file://{tmp_path}/srv/{{}}.git', work
+
+
+def push(work, *tags):
+    git('push', '-q', 'origin', 'HEAD', *tags, cwd=work)
+
+
+def test_annotated_tag_at_head(server):
+    url_base, work = server
+    git('tag', '-a', 'v1.0.0', '-m', 'v1.0.0', cwd=work)
+    push(work, 'v1.0.0')
+    assert get_master_tag('pcdshub/pkg', url_base) == 'v1.0.0'
+
+
+def test_newest_of_several_tags_at_head(server):
+    url_base, work = server
+    git('tag', 'v1.9.0', cwd=work)
+    git('tag', '-a', 'v1.10.0', '-m', 'v1.10.0', cwd=work)
+    push(work, 'v1.9.0', 'v1.10.0')
+    assert get_master_tag('pcdshub/pkg', url_base) == 'v1.10.0'
+
+
+def test_commits_after_tag(server):
+    url_base, work = server
+    git('tag', '-a', 'v1.0.0', '-m', 'v1.0.0', cwd=work)
+    git('commit', '-q', '--allow-empty', '-m', 'second', cwd=work)
+    push(work, 'v1.0.0')
+    assert get_master_tag('pcdshub/pkg', url_base) == ''
+
+
+def test_no_tags(server):
+    url_base, work = server
+    push(work)
+    assert get_master_tag('pcdshub/pkg', url_base) == ''
+
+
+def test_missing_repo(server):
+    url_base, _ = server
+    with pytest.raises(RuntimeError, match='Could not list refs'):
+        ls_remote(url_base.format('pcdshub/missing'), retries=1)
+
+
+def test_head_tag_peeled():
+    refs = (
+        'aaa\tHEAD\n'
+        'bbb\trefs/tags/v1.0.0\n'
+        'aaa\trefs/tags/v1.0.0^{}\n'
+        'ccc\trefs/tags/v0.9.0\n'
+    )
+    assert head_tag(refs) == 'v1.0.0'
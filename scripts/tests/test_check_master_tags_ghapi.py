@@ -0,0 +1,115 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('ghapi')
+
+from check_master_tags_ghapi import (graphql_statuses,  # noqa: E402
+                                     graphql_tag_status,
+                                     latest_tag_from_graphql)
+
+# Hand-made responses in the shape the github graphql api returns for
+# REPO_QUERY, one per batch of two repos. The tags and oids are made up.
+RESPONSES = Path(__file__).parent / 'data' / 'graphql_tag_status.json'
+REPOS = ['pcdshub/pcdsdevices', 'pcdshub/pcdsutils', 'pcdshub/untagged']
+NOT_FOUND = {
+    'data': {'r0': None},
+    'errors': [{
+        'type': 'NOT_FOUND',
+        'path': ['r0'],
+        'message': "Could not resolve to a Repository with the name 'pcdshub/gone'.",
+    }],
+}
+
+
+class GraphQLHandler(BaseHTTPRequestHandler):
+    """Answer each query with the next of the server's responses."""
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.queries.append(json.loads(body)['query'])
+        self.server.auth.append(self.headers.get('Authorization'))
+        data = json.dumps(self.server.responses.pop(0)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def graphql_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GraphQLHandler)
+    server.responses = []
+    server.queries = []
+    server.auth = []
+    server.url = f'http://127.0.0.1:{server.server_port}/graphql'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_latest_tag_from_graphql():
+    first, second = json.loads(RESPONSES.read_text())
+    # Annotated tag, peeled to the commit
+    assert latest_tag_from_graphql(first['data']['r0']) == 'v8.1.0'
+    # Lightweight tag
+    assert latest_tag_from_graphql(first['data']['r1']) == 'v2.4.0'
+    # Commits after the last tag
+    assert latest_tag_from_graphql(second['data']['r0']) is False
+
+
+def test_graphql_tag_status(graphql_server):
+    graphql_server.responses = json.loads(RESPONSES.read_text())
+    status = graphql_tag_status(
+        REPOS, url=graphql_server.url, token='secret', batch_size=2,
+    )
+    assert status == {
+        'pcdshub/pcdsdevices': 'v8.1.0',
+        'pcdshub/pcdsutils': 'v2.4.0',
+        'pcdshub/untagged': False,
+    }
+    first, second = graphql_server.queries
+    assert 'r0: repository(owner: "pcdshub", name: "pcdsdevices")' in first
+    assert 'r1: repository(owner: "pcdshub", name: "pcdsutils")' in first
+    assert 'r0: repository(owner: "pcdshub", name: "untagged")' in second
+    assert graphql_server.auth == ['bearer secret', 'bearer secret']
+
+
+def test_graphql_tag_status_missing_repo(graphql_server):
+    graphql_server.responses = [NOT_FOUND]
+    with pytest.raises(RuntimeError, match='Could not resolve'):
+        graphql_tag_status(['pcdshub/gone'], url=graphql_server.url)
+
+
+def test_graphql_statuses_cache(graphql_server, tmp_path, monkeypatch):
+    monkeypatch.setenv('PCDS_ENVS_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.delenv('GITHUB_TOKEN', raising=False)
+    first, second = json.loads(RESPONSES.read_text())
+    repos = REPOS[:2]
+    graphql_server.responses = [first]
+    statuses = graphql_statuses(repos, False, 600, graphql_server.url, 25)
+    assert statuses == {'pcdshub/pcdsdevices': 'v8.1.0', 'pcdshub/pcdsutils': 'v2.4.0'}
+    # Reused for the same endpoint, even offline
+    assert graphql_statuses(repos, True, 600, graphql_server.url, 25) == statuses
+    assert len(graphql_server.queries) == 1
+    # Another endpoint has its own answers
+    other_url = graphql_server.url.replace('127.0.0.1', 'localhost')
+    with pytest.raises(RuntimeError, match='No cached tag status'):
+        graphql_statuses(repos, True, 600, other_url, 25)
+    untagged = {
+        'r0': second['data']['r0'],
+        'r1': {**first['data']['r1'], 'refs': {'nodes': []}},
+    }
+    graphql_server.responses = [{'data': untagged}]
+    assert graphql_statuses(repos, False, 600, other_url, 25) == {
+        'pcdshub/pcdsdevices': False, 'pcdshub/pcdsutils': False,
+    }
+    assert graphql_statuses(repos, True, 600, graphql_server.url, 25) == statuses
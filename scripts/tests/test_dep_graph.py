@@ -0,0 +1,92 @@
+import copy
+import random
+
+import pytest
+
+from dep_graph import CoreAttribution, DependencyGraph
+
+CORE = ['core-a', 'core-e', 'core-f', 'core-g', 'core-h']
+EDGES = [
+    # A diamond below core-a, with core-e also using one side
+    ('core-a', 'b'),
+    ('core-a', 'c'),
+    ('b', 'd'),
+    ('c', 'd'),
+    ('core-e', 'c'),
+    # A cycle used by two core packages through different members
+    ('x', 'y'),
+    ('y', 'x'),
+    ('core-f', 'y'),
+    ('core-g', 'z'),
+    ('z', 'x'),
+    ('x', 'w'),
+    # A core package using another core package does not count as using
+    # that package's dependencies
+    ('core-h', 'core-a'),
+    ('core-h', 'w'),
+]
+
+
+def old_core_required(reverse_deps_cache, core_packages, pkg):
+    """The chain walk release_notes_table.main used before CoreAttribution."""
+    core_required = set()
+    unresolved_chains = [[pkg]]
+    while unresolved_chains:
+        for chain in copy.copy(unresolved_chains):
+            unresolved_chains.remove(chain)
+            deps = sorted(reverse_deps_cache.get(chain[0], []))
+            if not deps:
+                continue
+            for dep in deps:
+                if dep in chain:
+                    continue
+                new_chain = [dep] + chain
+                if dep in core_packages:
+                    core_required.add(dep)
+                else:
+                    unresolved_chains.append(new_chain)
+    return core_required
+
+
+def make_graph(edges):
+    graph = DependencyGraph()
+    for package, requirement in edges:
+        graph.add_edge(package, requirement)
+    return graph
+
+
+def test_core_requirers():
+    graph = make_graph(EDGES)
+    attribution = CoreAttribution(graph.reverse, CORE)
+    assert attribution.core_requirers('d') == ['core-a', 'core-e']
+    assert attribution.core_requirers('b') == ['core-a']
+    assert attribution.core_requirers('x') == ['core-f', 'core-g']
+    assert attribution.core_requirers('y') == ['core-f', 'core-g']
+    assert attribution.core_requirers('w') == ['core-f', 'core-g', 'core-h']
+    assert attribution.core_requirers('core-a') == ['core-h']
+    assert attribution.core_requirers('unknown') == []
+    assert attribution.first_requirers('d') == ['b', 'c']
+
+
+def check_matches_chain_walk(edges, core):
+    graph = make_graph(edges)
+    attribution = CoreAttribution(graph.reverse, core)
+    packages = set(graph.forward) | set(graph.reverse)
+    for pkg in sorted(packages - set(core)):
+        expected = old_core_required(graph.reverse, core, pkg)
+        assert set(attribution.core_requirers(pkg)) == expected, pkg
+
+
+def test_matches_chain_walk():
+    check_matches_chain_walk(EDGES, CORE)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_chain_walk_random(seed):
+    rng = random.Random(seed)
+    nodes = [f'pkg{num}' for num in range(12)]
+    core = rng.sample(nodes, 3)
+    edges = [
+        (rng.choice(nodes), rng.choice(nodes)) for _ in range(24)
+    ]
+    check_matches_chain_walk(edges, core)
@@ -0,0 +1,90 @@
+from importlib.metadata import PathDistribution
+
+import pytest
+
+import get_extras
+from get_extras import DistributionIndex, resolve_extras, write_extras
+from name_mapping import NameMapping
+
+INSTALLED = {
+    'pcdsdevices': [
+        "pytest ; extra == 'test'",
+        "ophyd[sim] ; extra == 'test'",
+        "numpy ; extra == 'test'",
+        "pcdsutils ; extra == 'test'",
+        "line_profiler ; extra == 'test'",
+        "sphinx ; extra == 'doc'",
+        "happi ; extra == 'doc'",
+        "python-ldap ; extra == 'doc'",
+    ],
+    'ophyd': ["caproto ; extra == 'sim'"],
+    'numpy': [],
+}
+
+
+def make_dist(site, name, requires):
+    dist_info = site / f'{name}-1.0.0.dist-info'
+    dist_info.mkdir(parents=True)
+    extras = sorted({req.rpartition('== ')[2].strip("'") for req in requires})
+    lines = [f'Name: {name}', 'Version: 1.0.0']
+    lines += [f'Provides-Extra: {extra}' for extra in extras]
+    lines += [f'Requires-Dist: {req}' for req in requires]
+    (dist_info / 'METADATA').write_text('\n'.join(lines) + '\n')
+    return PathDistribution(dist_info)
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    monkeypatch.setenv('PCDS_ENVS_CACHE', str(tmp_path / 'cache'))
+    env_dir = tmp_path / 'envs' / 'pcds'
+    env_dir.mkdir(parents=True)
+    (env_dir / 'install-extras.txt').write_text('pcdsdevices\n')
+    (env_dir / 'pip-packages.txt').write_text(
+        '# pypi as new as possible\nPcdsUtils>=1.0  # any spelling\n'
+    )
+    monkeypatch.setattr(
+        get_extras, 'get_extras_path',
+        lambda base: tmp_path / 'envs' / base / 'install-extras.txt',
+    )
+    monkeypatch.setattr(
+        get_extras, 'get_pip_packages_path',
+        lambda base: tmp_path / 'envs' / base / 'pip-packages.txt',
+    )
+    # happi was last installed by pip, sphinx has another name on conda
+    mapping = NameMapping({'sphinx': 'sphinx-conda'}, {'happi'})
+    monkeypatch.setattr(get_extras, 'get_name_mapping', lambda base: mapping)
+    index = DistributionIndex(
+        make_dist(tmp_path / 'site', name, requires)
+        for name, requires in INSTALLED.items()
+    )
+    return env_dir, index
+
+
+def test_resolve_extras_one_pass(env):
+    _, index = env
+    extras = resolve_extras('pcds', index=index, use_cache=False)
+    # Nothing conda installs is left for pip, and the pip-packages.txt pins
+    # and installed packages are in neither list
+    assert extras == {
+        'conda': ['caproto', 'pytest', 'sphinx-conda'],
+        'pip': ['happi[doc]', 'line_profiler[test]'],
+    }
+
+
+def test_write_extras(env, tmp_path):
+    env_dir, index = env
+    write_extras(resolve_extras('pcds', index=index, use_cache=False), env_dir)
+    conda = (env_dir / 'extras_conda.txt').read_text()
+    assert conda == 'caproto\npytest\nsphinx-conda\n'
+    assert (env_dir / 'extras_pip.txt').read_text() == 'happi[doc]\nline_profiler[test]\n'
+
+
+def test_resolve_extras_cache(env):
+    env_dir, index = env
+    first = resolve_extras('pcds', index=index)
+    assert resolve_extras('pcds', index=index) == first
+    # A new pin in pip-packages.txt must not reuse the cached lists
+    (env_dir / 'pip-packages.txt').write_text('pytest\n')
+    second = resolve_extras('pcds', index=index)
+    assert 'pytest' not in second['conda']
+    assert 'caproto' in second['conda']
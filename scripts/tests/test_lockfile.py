@@ -0,0 +1,150 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from lockfile import (GitObjectReader, LockEntry, Lockfile, diff_lockfiles,
+                      parse_spec_line, read_git_packages)
+
+ENVS = Path(__file__).resolve().parent.parent.parent / 'envs'
+ENV_YAML = """\
+name: base
+channels:
+  - conda-forge
+  - pcds-tag
+dependencies:
+  # conda packages
+  - numpy=1.26.4=py312heda63a1_0
+  - ophyd=1.9.0=pyhd8ed1ab_0
+  - pip=24.0=pyhd8ed1ab_0
+  - pip:
+    # pypi packages
+    - tenacity==9.1.2
+    - git+https://github.com/pcdshub/pmps-ui.git@v2.0.0
+  - zlib=1.3.1=hb9d3cd8_2
+prefix: /cds/group/pcds/pyps/conda/py312/envs/pcds-6.0.0
+"""
+GIT_PACKAGES = 'pmpsui git+https://github.com/pcdshub/pmps-ui.git@v1.0.0\n'
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch):
+    for var in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{var}_NAME', 'pcds-envs tests')
+        monkeypatch.setenv(f'GIT_{var}_EMAIL', 'tests@example.com')
+
+
+def git(*args, cwd=None):
+    return subprocess.check_output(
+        ['git'] + list(args), cwd=cwd, universal_newlines=True,
+    ).strip()
+
+
+@pytest.fixture
+def git_names(tmp_path):
+    path = tmp_path / 'git-packages.txt'
+    path.write_text('# name url\n' + GIT_PACKAGES)
+    return read_git_packages(path)
+
+
+def test_parse_spec_line(git_names):
+    assert parse_spec_line('numpy=1.26.4=py312heda63a1_0', pip=False) == LockEntry(
+        'numpy', '1.26.4', 'py312heda63a1_0',
+    )
+    assert parse_spec_line('tenacity==9.1.2', pip=True) == LockEntry(
+        'tenacity', '9.1.2', source='pip',
+    )
+    # The ref in git-packages.txt does not need to match
+    git_spec = 'git+https://github.com/pcdshub/pmps-ui.git@v2.0.0'
+    assert parse_spec_line(git_spec, pip=True, git_names=git_names) == LockEntry(
+        'pmpsui', '2.0.0', source='pip',
+    )
+    assert parse_spec_line(git_spec, pip=True).name == 'pmps-ui'
+
+
+def test_lockfile_entries(git_names):
+    lockfile = Lockfile(ENV_YAML, git_names)
+    assert list(lockfile) == [
+        'numpy', 'ophyd', 'pip', 'tenacity', 'pmpsui', 'zlib',
+    ]
+    assert lockfile['zlib'] == LockEntry('zlib', '1.3.1', 'hb9d3cd8_2')
+    assert lockfile['tenacity'].source == 'pip'
+
+
+@pytest.mark.parametrize('text', [ENV_YAML, ENV_YAML.rstrip('\n')])
+def test_lockfile_round_trip(text, tmp_path):
+    path = tmp_path / 'env.yaml'
+    Lockfile(text).write(path)
+    assert path.read_bytes() == text.encode()
+
+
+@pytest.mark.parametrize(
+    'env_yaml', sorted(ENVS.glob('*/env.yaml')), ids=lambda path: path.parent.name,
+)
+def test_repo_lockfiles_round_trip(env_yaml):
+    text = env_yaml.read_text()
+    lockfile = Lockfile.from_path(env_yaml)
+    assert len(lockfile) > 0
+    assert str(lockfile) == text
+
+
+def test_replace_spec(git_names, tmp_path):
+    lockfile = Lockfile(ENV_YAML, git_names)
+    entry = lockfile.replace_spec('ophyd', 'ophyd=1.10.0=pyhd8ed1ab_0')
+    assert entry == LockEntry('ophyd', '1.10.0', 'pyhd8ed1ab_0')
+    lockfile.replace_spec(
+        'pmpsui', 'git+https://github.com/pcdshub/pmps-ui.git@v2.1.0',
+    )
+    assert lockfile['pmpsui'] == LockEntry('pmpsui', '2.1.0', source='pip')
+    path = tmp_path / 'env.yaml'
+    lockfile.write(path)
+    # Only the replaced lines change, comments and order are kept
+    expected = ENV_YAML.replace(
+        'ophyd=1.9.0=pyhd8ed1ab_0', 'ophyd=1.10.0=pyhd8ed1ab_0',
+    ).replace('pmps-ui.git@v2.0.0', 'pmps-ui.git@v2.1.0')
+    assert path.read_text() == expected
+    assert Lockfile(path.read_text(), git_names) == lockfile
+
+
+def test_diff_lockfiles():
+    old = Lockfile(ENV_YAML)
+    new_text = (
+        ENV_YAML
+        .replace('numpy=1.26.4=py312heda63a1_0', 'numpy=2.0.0=py312h1_0')
+        .replace('zlib=1.3.1=hb9d3cd8_2', 'zlib=1.3.1=hb9d3cd8_3')
+        .replace('  - ophyd=1.9.0=pyhd8ed1ab_0\n', '')
+        .replace('    - tenacity==9.1.2\n', '    - tenacity==9.1.2\n    - pcdsutils==0.15.0\n')
+    )
+    new = Lockfile(new_text)
+    changes = diff_lockfiles(old, new)
+    assert list(changes) == ['numpy', 'ophyd', 'pcdsutils', 'zlib']
+    assert changes['numpy'] == (old['numpy'], new['numpy'])
+    assert changes['ophyd'] == (old['ophyd'], None)
+    assert changes['pcdsutils'] == (None, LockEntry('pcdsutils', '0.15.0', source='pip'))
+    # A rebuild of the same version is a change too
+    assert changes['zlib'][1].build == 'hb9d3cd8_3'
+    assert diff_lockfiles(old, Lockfile(ENV_YAML)) == {}
+
+
+def test_git_object_reader(tmp_path):
+    repo = tmp_path / 'repo'
+    env_yaml = repo / 'envs' / 'pcds' / 'env.yaml'
+    env_yaml.parent.mkdir(parents=True)
+    git('init', '-q', str(repo))
+    env_yaml.write_text(ENV_YAML)
+    git('add', '.', cwd=repo)
+    git('commit', '-q', '-m', 'first', cwd=repo)
+    git('tag', 'v1', cwd=repo)
+    updated = ENV_YAML.replace('zlib=1.3.1=hb9d3cd8_2', 'zlib=1.3.2=hb9d3cd8_0')
+    env_yaml.write_text(updated)
+    git('commit', '-q', '-a', '-m', 'second', cwd=repo)
+
+    with GitObjectReader(cwd=env_yaml.parent) as reader:
+        assert reader.read('v1', env_yaml) == ENV_YAML.encode()
+        assert reader.read('HEAD', env_yaml) == updated.encode()
+        assert reader.read('HEAD', repo / 'missing.txt') is None
+        # Still in sync after a missing file
+        assert reader.read_lockfile('v1', env_yaml)['zlib'].version == '1.3.1'
+        assert reader.read_lockfile('HEAD', env_yaml)['zlib'].version == '1.3.2'
+        with pytest.raises(RuntimeError, match='Did not find'):
+            reader.read_lockfile('v1', repo / 'envs' / 'other' / 'env.yaml')
@@ -0,0 +1,88 @@
+import subprocess
+
+import pytest
+
+from test_setup import setup_all_tests
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch):
+    for var in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{var}_NAME', 'pcds-envs tests')
+        monkeypatch.setenv(f'GIT_{var}_EMAIL', 'tests@example.com')
+
+
+def git(*args, cwd=None):
+    return subprocess.check_output(
+        ['git'] + list(args), cwd=cwd, universal_newlines=True,
+    ).strip()
+
+
+def commit_and_tag(work, tag):
+    (work / 'version.txt').write_text(tag)
+    git('add', 'version.txt', cwd=work)
+    git('commit', '-q', '-m', tag, cwd=work)
+    git('tag', '-a', tag, '-m', tag, cwd=work)
+    git('push', '-q', 'origin', 'HEAD', tag, cwd=work)
+    return git('rev-parse', 'HEAD', cwd=work)
+
+
+@pytest.fixture
+def server(tmp_path):
+    """A bare pcdshub/pkg repo with a tagged commit, and a clone to push from."""
+    srv = tmp_path / 'srv'
+    bare = srv / 'pcdshub' / 'pkg.git'
+    bare.mkdir(parents=True)
+    git('init', '-q', '--bare', str(bare))
+    work = tmp_path / 'work'
+    git('clone', '-q', str(bare), str(work))
+    repo_file = tmp_path / 'package-tests.txt'
+    repo_file.write_text('pcdshub/pkg\n')
+    return srv, work, repo_file
+
+
+def test_setup_from_mirror(server, tmp_path):
+    srv, work, repo_file = server
+    url_base = f'file://{srv}/{{}}.git'
+    mirror_dir = tmp_path / 'mirrors'
+    first = commit_and_tag(work, 'v1.0.0')
+    commit_and_tag(work, 'v1.1.0')
+
+    tests = tmp_path / 'tests'
+    tests.mkdir()
+    setup_all_tests(
+        repo_file, tags={'pkg': '1.0.0'}, cwd=tests,
+        url_base=url_base, mirror_dir=mirror_dir,
+    )
+    checkout = tests / 'pkg'
+    assert git('rev-parse', 'HEAD', cwd=checkout) == first
+    assert git('remote', 'get-url', 'origin', cwd=checkout) == url_base.format(
+        'pcdshub/pkg'
+    )
+    assert (mirror_dir / 'pcdshub' / 'pkg.git').is_dir()
+
+    # A tag pushed later is picked up by updating the mirror
+    newest = commit_and_tag(work, 'v1.2.0')
+    tests_again = tmp_path / 'tests_again'
+    tests_again.mkdir()
+    setup_all_tests(
+        repo_file, tags={'pkg': '1.2.0'}, cwd=tests_again,
+        url_base=url_base, mirror_dir=mirror_dir,
+    )
+    assert git('rev-parse', 'HEAD', cwd=tests_again / 'pkg') == newest
+
+
+def test_setup_missing_repo(server, tmp_path, capsys):
+    srv, work, repo_file = server
+    commit_and_tag(work, 'v1.0.0')
+    repo_file.write_text('pcdshub/pkg\npcdshub/missing\n')
+    tests = tmp_path / 'tests'
+    tests.mkdir()
+    with pytest.raises(RuntimeError, match='missing'):
+        setup_all_tests(
+            repo_file, cwd=tests, url_base=f'file://{srv}/{{}}.git',
+            mirror_dir=tmp_path / 'mirrors',
+        )
+    # The other repo is still set up and the timing report still printed
+    assert (tests / 'pkg' / 'version.txt').is_file()
+    assert 'Test setup timing' in capsys.readouterr().out
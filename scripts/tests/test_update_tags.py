@@ -0,0 +1,244 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import update_tags
+from caching import MetadataCache
+
+CONDA_JSON = 'application/json'
+PYPI_JSON = 'application/vnd.pypi.simple.v1+json'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answer from the server's routes, a dict of path to (content type, body).
+
+    Paths in the server's etags dict are sent with that ETag, and answered
+    with "304 Not Modified" when the request already has it.
+    """
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        etag = self.server.etags.get(self.path)
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.server.not_modified.append(self.path)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        try:
+            content_type, body = self.server.routes[self.path]
+        except KeyError:
+            self.send_response(404)
+            content_type, body = CONDA_JSON, {'error': 'not found'}
+        else:
+            self.send_response(200)
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        data = body.encode()
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """
+    A local server standing in for the anaconda api and pypi.
+
+    The update_tags globals are pointed at it, as --api-url, --conda-url and
+    --pypi-url do.
+    """
+    monkeypatch.setenv('PCDS_ENVS_CACHE', str(tmp_path / 'cache'))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.routes = {}
+    server.requests = []
+    server.etags = {}
+    server.not_modified = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    monkeypatch.setattr(update_tags, 'ANACONDA_API', url)
+    monkeypatch.setattr(update_tags, 'CONDA_URL', f'{url}/conda')
+    monkeypatch.setattr(update_tags, 'PYPI_SIMPLE', f'{url}/simple')
+    monkeypatch.setattr(update_tags, 'client', None)
+    monkeypatch.setattr(update_tags, 'pypi_index', None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def add_conda(server, channel, name, versions):
+    server.routes[f'/package/{channel}/{name}'] = (
+        CONDA_JSON, {'versions': versions},
+    )
+
+
+def add_repodata(server, channel, subdir, versions, etag=None):
+    """Serve a channel subdir's repodata.json with these name: versions."""
+    packages = {}
+    for name, name_versions in versions.items():
+        for num, ver in enumerate(name_versions):
+            packages[f'{name}-{ver}-{num}.conda'] = {'name': name, 'version': ver}
+    # Older packages are only in "packages", newer ones in "packages.conda"
+    half = len(packages) // 2
+    filenames = sorted(packages)
+    repodata = {
+        'info': {'subdir': subdir},
+        'packages': {fn: packages[fn] for fn in filenames[:half]},
+        'packages.conda': {fn: packages[fn] for fn in filenames[half:]},
+    }
+    path = f'/conda/{channel}/{subdir}/repodata.json'
+    server.routes[path] = (CONDA_JSON, repodata)
+    if etag is not None:
+        server.etags[path] = etag
+    return path
+
+
+def serve_channels(server, etag=None):
+    add_repodata(server, 'conda-forge', 'noarch', {
+        'numpy': ['1.9.0', 'not a version'],
+        'ophyd': ['1.9.0'],
+    }, etag=etag)
+    add_repodata(server, 'conda-forge', 'linux-64', {
+        'numpy': ['1.10.0', '1.26.4'],
+        'weird': ['also not a version'],
+    }, etag=etag)
+    add_repodata(server, 'pcds-tag', 'noarch', {
+        'numpy': ['9.9.9'],
+        'pcdsdevices': ['8.1.0', '8.0.0'],
+    }, etag=etag)
+    add_repodata(server, 'pcds-tag', 'linux-64', {}, etag=etag)
+
+
+def add_pypi(server, name, filenames, yanked=()):
+    files = [{'filename': filename, 'hashes': {}} for filename in filenames]
+    files += [
+        {'filename': filename, 'hashes': {}, 'yanked': 'broken'}
+        for filename in yanked
+    ]
+    server.routes[f'/simple/{name}/'] = (
+        PYPI_JSON, {'meta': {'api-version': '1.0'}, 'name': name, 'files': files},
+    )
+
+
+def test_resolve_versions(stand_in):
+    add_conda(stand_in, 'conda-forge', 'numpy', ['1.26.4', '2.0.0', 'not-a-version'])
+    # pcds-tag is only checked when conda-forge does not have the package
+    add_conda(stand_in, 'pcds-tag', 'numpy', ['9.9.9'])
+    add_conda(stand_in, 'pcds-tag', 'pcdsdevices', ['8.0.0', '8.1.0'])
+    add_pypi(
+        stand_in,
+        'pip-only',
+        ['pip_only-1.0.0-py3-none-any.whl', 'pip-only-1.1.0.tar.gz',
+         'pip_only-2.0.0rc1-py3-none-any.whl'],
+        yanked=['pip_only-1.2.0-py3-none-any.whl'],
+    )
+    packages = ['numpy', 'pcdsdevices', 'pip-only']
+    assert update_tags.resolve_versions(packages, workers=2) == {
+        'numpy': '2.0.0',
+        'pcdsdevices': '8.1.0',
+        'pip-only': '1.1.0',
+    }
+    assert '/package/lcls-ii/numpy' not in stand_in.requests
+
+
+def test_resolve_versions_html(stand_in):
+    # A simple index without the json api, as served by e.g. older mirrors
+    stand_in.routes['/simple/html-only/'] = ('text/html', '''<!DOCTYPE html>
+<html><body>
+<a href="/files/html_only-1.0.0-py3-none-any.whl#sha256=00">html_only-1.0.0-py3-none-any.whl</a>
+<a href="/files/html_only-1.1.0.tar.gz#sha256=11">html_only-1.1.0.tar.gz</a>
+<a href="/files/html_only-1.2.0.tar.gz#sha256=22" data-yanked="">html_only-1.2.0.tar.gz</a>
+<a href="/files/html_only-1.3.0.tar.gz#sha256=33" data-yanked="broken build">html_only-1.3.0.tar.gz</a>
+</body></html>
+''')
+    assert update_tags.resolve_versions(['html-only'], workers=1) == {
+        'html-only': '1.1.0',
+    }
+
+
+def test_resolve_versions_missing(stand_in):
+    with pytest.raises(RuntimeError, match='not found on pypi'):
+        update_tags.resolve_versions(['missing'], workers=1)
+
+
+def test_resolve_versions_cache(stand_in, monkeypatch):
+    add_conda(stand_in, 'conda-forge', 'numpy', ['1.26.4'])
+    with MetadataCache('channel-versions', ttl=3600) as cache:
+        key_prefix = update_tags.cache_key_prefix()
+        update_tags.resolve_versions(
+            ['numpy'], cache=cache, key_prefix=key_prefix,
+        )
+        add_conda(stand_in, 'conda-forge', 'numpy', ['2.0.0'])
+        cached = update_tags.resolve_versions(
+            ['numpy'], cache=cache, key_prefix=key_prefix,
+        )
+        assert cached == {'numpy': '1.26.4'}
+        # Another server or mode must not reuse these answers
+        assert update_tags.cache_key_prefix(channel_index=True) != key_prefix
+        monkeypatch.setattr(
+            update_tags, 'ANACONDA_API',
+            update_tags.ANACONDA_API.replace('127.0.0.1', 'localhost'),
+        )
+        monkeypatch.setattr(update_tags, 'client', None)
+        fresh = update_tags.resolve_versions(
+            ['numpy'], cache=cache, key_prefix=update_tags.cache_key_prefix(),
+        )
+        assert fresh == {'numpy': '2.0.0'}
+    assert stand_in.requests.count('/package/conda-forge/numpy') == 2
+
+
+def test_channel_index(stand_in):
+    serve_channels(stand_in)
+    index = update_tags.ChannelIndex(channels=['conda-forge', 'pcds-tag'])
+    # conda-forge comes first, and versions are compared as versions
+    assert index.latest_version('numpy') == '1.26.4'
+    assert index.latest_version('ophyd') == '1.9.0'
+    assert index.latest_version('pcdsdevices') == '8.1.0'
+    # Versions that do not parse are skipped
+    assert index.versions['conda-forge']['numpy'] == ['1.9.0', '1.10.0', '1.26.4']
+    assert index.latest_version('weird') == '0.0.0'
+    with pytest.raises(RuntimeError, match='not found in any channel'):
+        index.latest_version('missing')
+
+
+def test_channel_index_etag(stand_in):
+    serve_channels(stand_in, etag='"v1"')
+    update_tags.ChannelIndex(channels=['conda-forge', 'pcds-tag'])
+    assert stand_in.not_modified == []
+    index = update_tags.ChannelIndex(channels=['conda-forge', 'pcds-tag'])
+    assert len(stand_in.not_modified) == 4
+    assert index.latest_version('numpy') == '1.26.4'
+    # A changed channel is downloaded again
+    add_repodata(
+        stand_in, 'conda-forge', 'linux-64', {'numpy': ['2.0.0']}, etag='"v2"',
+    )
+    index = update_tags.ChannelIndex(channels=['conda-forge', 'pcds-tag'])
+    assert len(stand_in.not_modified) == 7
+    assert index.latest_version('numpy') == '2.0.0'
+
+
+def test_channel_index_offline(stand_in):
+    serve_channels(stand_in)
+    # Nothing is cached yet, so nothing is found
+    index = update_tags.ChannelIndex(channels=['conda-forge'], offline=True)
+    assert stand_in.requests == []
+    with pytest.raises(RuntimeError, match='not found in any channel'):
+        index.latest_version('numpy')
+    update_tags.ChannelIndex(channels=['conda-forge', 'pcds-tag'])
+    requests_made = len(stand_in.requests)
+    stand_in.routes.clear()
+    index = update_tags.ChannelIndex(
+        channels=['conda-forge', 'pcds-tag'], offline=True,
+    )
+    assert len(stand_in.requests) == requests_made
+    assert index.latest_version('numpy') == '1.26.4'
+    assert index.latest_version('pcdsdevices') == '8.1.0'
@@ -1,22 +1,63 @@
 import argparse
 import re
 import subprocess
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
 from binstar_client import Binstar
 from binstar_client.errors import BinstarError
 from packaging import version
+from requests.adapters import HTTPAdapter
+
+from caching import MetadataCache, cache_dir, read_json, write_json
+from pypi_index import PyPIIndex
 
 CHANNELS = ['conda-forge', 'pcds-tag', 'lcls-ii']
+ANACONDA_API = 'https://api.anaconda.org'
+CONDA_URL = 'https://conda.anaconda.org'
+# Platforms to include in the channel index
+SUBDIRS = ['noarch', 'linux-64']
+PYPI_SIMPLE = 'https://pypi.org/simple'
+# Number of packages to look up at once
+WORKERS = 8
+# Seconds to reuse a looked-up version for
+CHANNEL_TTL = 3600
 client = None
+pypi_index = None
+sessions = {}
+sessions_lock = threading.Lock()
 
 
 def get_client() -> Binstar:
     global client
-    if client is None:
-        client = Binstar()
-    return client
+    with sessions_lock:
+        if client is None:
+            client = Binstar(domain=ANACONDA_API)
+            pool_connections(client.session)
+        return client
+
+
+def pool_connections(session: requests.Session) -> None:
+    """Let every worker thread keep its own connection open in a session."""
+    adapter = HTTPAdapter(pool_maxsize=WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def get_session(url: str) -> requests.Session:
+    """Get the pooled session shared by all requests to the url's host."""
+    host = urllib.parse.urlsplit(url).netloc
+    with sessions_lock:
+        try:
+            return sessions[host]
+        except KeyError:
+            session = requests.Session()
+            pool_connections(session)
+            sessions[host] = session
+            return session
 
 
 def latest_version(package):
@@ -33,6 +74,10 @@ def latest_version(package):
             break
     if versions_list is None:
         raise RuntimeError(f"{package} not found in any channel: {CHANNELS}")
+    return pick_latest(versions_list)
+
+
+def pick_latest(versions_list):
     latest_version = "0.0.0"
     for item_version in versions_list:
         try:
@@ -45,24 +90,170 @@ def latest_version(package):
     return latest_version
 
 
-pypi_version_re = re.compile(r'-(\d\.\d\.\d).tar.gz')
-
-
-def pypi_latest_version_no_search(package):
-    req = requests.get(f'https://pypi.org/simple/{package}')
-    matches = set(pypi_version_re.findall(req.text))
-    if not matches:
-        raise RuntimeError(f'{package} not found on pypi.')
-    latest_version = '0.0.0'
-    for ver in matches:
+def sort_versions(versions_list):
+    """Sort the valid versions from oldest to newest, dropping the rest."""
+    parsed = {}
+    for item_version in versions_list:
         try:
-            if version.parse(ver) > version.parse(latest_version):
-                latest_version = ver
+            parsed[item_version] = version.parse(item_version)
         except version.InvalidVersion:
-            # Some packages can have malformed version numbers
-            # Just ignore these and move on
             pass
-    return latest_version
+    return sorted(parsed, key=parsed.get)
+
+
+class ChannelIndex:
+    """
+    Answer latest_version lookups from each channel's repodata.
+
+    Instead of one api call per package per channel, this downloads each
+    channel's repodata once per subdir and reduces it to a small
+    name -> sorted versions index. The index is cached on disk along with
+    the ETag of the download, so later runs only download the repodata
+    again if it changed, and offline runs can use the cached copy.
+
+    Only the SUBDIRS platforms are checked, so packages that only exist
+    for other platforms are not found here.
+
+    Parameters
+    ----------
+    channels : list of str
+        The channels to check, in priority order.
+    variant : str
+        Which repodata file to use, repodata or current_repodata. The
+        latter is much smaller but only has the newest builds.
+    offline : bool
+        If True, only use the cached indices. Missing indices are treated
+        as empty.
+    """
+    def __init__(self, channels=CHANNELS, variant='repodata', offline=False):
+        self.channels = channels
+        self.variant = variant
+        self.offline = offline
+        keys = [(ch, subdir) for ch in channels for subdir in SUBDIRS]
+        print(f'Loading {variant} for {", ".join(channels)}')
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            indices = executor.map(lambda key: self.load(*key), keys)
+            by_key = dict(zip(keys, indices))
+        self.versions = {}
+        for ch in channels:
+            names = {}
+            for subdir in SUBDIRS:
+                for name, versions_list in by_key[ch, subdir].items():
+                    names.setdefault(name, []).extend(versions_list)
+            self.versions[ch] = {
+                name: sort_versions(versions_list)
+                for name, versions_list in names.items()
+            }
+
+    def load(self, channel, subdir):
+        """Get the name -> versions index for one channel subdir."""
+        path = cache_dir('repodata', channel, subdir) / f'{self.variant}.json'
+        cached = read_json(path)
+        if self.offline:
+            if cached is None:
+                print(f'No cached {self.variant} for {channel}/{subdir}')
+                return {}
+            return cached['versions']
+        url = f'{CONDA_URL}/{channel}/{subdir}/{self.variant}.json'
+        headers = {}
+        if cached is not None and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        response = get_session(url).get(url, headers=headers)
+        if response.status_code == 304:
+            return cached['versions']
+        response.raise_for_status()
+        repodata = response.json()
+        names = {}
+        for key in ('packages', 'packages.conda'):
+            for info in repodata.get(key, {}).values():
+                names.setdefault(info['name'], set()).add(info['version'])
+        versions = {name: sort_versions(found) for name, found in names.items()}
+        write_json(path, {'etag': response.headers.get('ETag'), 'versions': versions})
+        return versions
+
+    def latest_version(self, package):
+        for ch in self.channels:
+            try:
+                versions_list = self.versions[ch][package]
+            except KeyError:
+                continue
+            if versions_list:
+                return versions_list[-1]
+            return "0.0.0"
+        raise RuntimeError(f"{package} not found in any channel: {self.channels}")
+
+
+def get_pypi_index() -> PyPIIndex:
+    global pypi_index
+    if pypi_index is None:
+        session = get_session(PYPI_SIMPLE)
+        with sessions_lock:
+            if pypi_index is None:
+                pypi_index = PyPIIndex(PYPI_SIMPLE, session=session)
+    return pypi_index
+
+
+def pypi_latest_version_no_search(package):
+    return get_pypi_index().latest_version(package)
+
+
+def resolve_version(package, index=None):
+    """
+    Check the conda channels in priority order, then pypi.
+
+    If a ChannelIndex is provided, use it instead of querying the api.
+    """
+    try:
+        if index is None:
+            return latest_version(package)
+        return index.latest_version(package)
+    except Exception:
+        return pypi_latest_version_no_search(package)
+
+
+def cache_key_prefix(channel_index=False, variant='repodata'):
+    """
+    The start of the cache keys for answers from the current servers.
+
+    Answers depend on which servers were asked and how, so runs against a
+    local stand-in server or in another mode must not reuse each other's.
+    """
+    if channel_index:
+        source = f'{CONDA_URL} {variant}'
+    else:
+        source = ANACONDA_API
+    return f'{source} {PYPI_SIMPLE} '
+
+
+def resolve_versions(
+    packages,
+    workers=WORKERS,
+    index=None,
+    cache=None,
+    key_prefix='',
+):
+    """
+    Find the latest version of every package, several at a time.
+
+    If a MetadataCache is provided, recent answers are reused from it,
+    stored under key_prefix followed by the package name. The results are
+    in the same order as the packages.
+    """
+    def resolve(package):
+        if cache is None:
+            return resolve_version(package, index)
+        return cache.fetch(
+            key_prefix + package,
+            lambda: resolve_version(package, index),
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        latest = executor.map(resolve, packages)
+        versions_dict = {}
+        for package, version_str in zip(packages, latest):
+            versions_dict[package] = version_str
+            print(f'Latest version of {package} is {version_str}')
+    return versions_dict
 
 
 def update_specs(path, versions_dict, dry_run=False):
@@ -102,6 +293,16 @@ def update_specs(path, versions_dict, dry_run=False):
 
 
 def main(args):
+    global ANACONDA_API, CONDA_URL, PYPI_SIMPLE, WORKERS, pypi_index
+    ANACONDA_API = args.api_url
+    CONDA_URL = args.conda_url.rstrip('/')
+    PYPI_SIMPLE = args.pypi_url.rstrip('/')
+    WORKERS = args.workers
+    pypi_index = PyPIIndex(
+        PYPI_SIMPLE,
+        session=get_session(PYPI_SIMPLE),
+        offline=args.offline,
+    )
     env = args.env
 
     here = Path(__file__).resolve().parent
@@ -129,14 +330,22 @@ def main(args):
                                              universal_newlines=True)
         print(conda_info)
 
-    versions_dict = {}
-    for package in packages:
-        try:
-            latest = latest_version(package)
-        except Exception:
-            latest = pypi_latest_version_no_search(package)
-        versions_dict[package] = latest
-        print(f'Latest version of {package} is {latest}')
+    if args.channel_index or args.offline:
+        index = ChannelIndex(variant=args.index_variant, offline=args.offline)
+    else:
+        index = None
+    with MetadataCache(
+        'channel-versions',
+        ttl=args.ttl,
+        offline=args.offline,
+    ) as cache:
+        versions_dict = resolve_versions(
+            packages,
+            workers=args.workers,
+            index=index,
+            cache=None if args.no_cache else cache,
+            key_prefix=cache_key_prefix(args.channel_index, args.index_variant),
+        )
 
     print('Updating specs. Make sure to verify and commit')
     update_specs(conda_packages, versions_dict, dry_run=args.dryrun)
@@ -149,5 +358,60 @@ if __name__ == '__main__':
     parser.add_argument('env')
     parser.add_argument('--dryrun', action='store_true')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=WORKERS,
+        help='How many packages to look up at once.',
+    )
+    parser.add_argument(
+        '--channel-index',
+        action='store_true',
+        help=(
+            'Download each channel index once and look up every package in '
+            'it, instead of making an api call per package per channel.'
+        ),
+    )
+    parser.add_argument(
+        '--index-variant',
+        choices=('repodata', 'current_repodata'),
+        default='repodata',
+        help='Which channel index file to use with --channel-index.',
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help=(
+            'Use the last known versions without any network access. '
+            'Packages that were never looked up fall back to the channel '
+            'indices and pypi pages cached by earlier runs.'
+        ),
+    )
+    parser.add_argument(
+        '--ttl',
+        type=float,
+        default=CHANNEL_TTL,
+        help='How many seconds to reuse a looked-up version for.',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Look up every version again, ignoring the last known answers.',
+    )
+    parser.add_argument(
+        '--api-url',
+        default=ANACONDA_API,
+        help='The anaconda.org api server to query, e.g. a local stand-in.',
+    )
+    parser.add_argument(
+        '--conda-url',
+        default=CONDA_URL,
+        help='The conda channel server for --channel-index.',
+    )
+    parser.add_argument(
+        '--pypi-url',
+        default=PYPI_SIMPLE,
+        help='The pypi simple index to fall back to, e.g. a local stand-in.',
+    )
 
     main(parser.parse_args())